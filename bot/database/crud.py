@@ -1,90 +1,278 @@
-from bot.database.models import SessionLocal, User, Message, Subscription, Summary, SystemPrompt
-from sqlalchemy import select, desc, func, delete, update
+from bot.database.models import (
+    engine, SessionLocal, ReadSessionLocal, User, Message, Subscription, Summary, SystemPrompt, UsageCounter, BroadcastCampaign,
+    StatAggregate, ScheduledJob, FsmState
+)
+from sqlalchemy import select, desc, func, delete, update, exists, literal, true, and_, or_, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from dataclasses import dataclass, field
+from bot.services.metrics_service import timed_db_call
 import datetime
 from loguru import logger
 
-async def save_message_db(user_id, role, content):
+# INSERT ... ON CONFLICT в диалекте текущей базы (у SQLite и PostgreSQL одинаковый интерфейс)
+insert = sqlite.insert if engine.dialect.name == 'sqlite' else postgresql.insert
+
+@dataclass
+class UserContext:
+    """Всё, что нужно для обработки одного сообщения пользователя"""
+    user_id: int
+    is_premium: bool = False
+    used: int = 0
+    messages: list = field(default_factory=list)
+    summary: str = None
+    system_prompt: str = None
+
+@timed_db_call
+async def save_message_db(user_id, role, content, token_count=None):
     """Сохраняет сообщение в базу данных и обновляет время активности пользователя"""
     async with SessionLocal() as session:
-        user = await session.get(User, user_id)
-        if not user:
-            user = User(user_id=user_id, last_active=datetime.datetime.utcnow())
-            session.add(user)
-        else:
-            user.last_active = datetime.datetime.utcnow()
-        msg = Message(user_id=user_id, role=role, content=content)
-        session.add(msg)
+        now = datetime.datetime.utcnow()
+        stmt = insert(User).values(user_id=user_id, last_active=now)
+        stmt = stmt.on_conflict_do_update(index_elements=[User.user_id], set_={'last_active': now})
+        await session.execute(stmt)
+        session.add(Message(user_id=user_id, role=role, content=content, token_count=token_count))
         await session.commit()
 
+@timed_db_call
+async def save_messages_batch_db(entries):
+    """
+    Сохраняет пачку сообщений одной транзакцией
+
+    Для каждого пользователя из пачки создаётся запись в users или обновляется last_active;
+    написавший пользователь снова получает рассылки, даже если раньше блокировал бота.
+
+    Args:
+        entries: Список словарей с ключами user_id, role, content, token_count, created_at
+
+    Returns:
+        list: ID пользователей, впервые появившихся в БД
+    """
+    if not entries:
+        return []
+    last_active = {}
+    for entry in entries:
+        last_active[entry['user_id']] = max(entry['created_at'], last_active.get(entry['user_id'], entry['created_at']))
+    async with SessionLocal() as session:
+        existing = set((await session.execute(
+            select(User.user_id).where(User.user_id.in_(list(last_active)))
+        )).scalars())
+        stmt = insert(User).values([
+            {'user_id': user_id, 'last_active': active} for user_id, active in last_active.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={'last_active': stmt.excluded.last_active, 'is_blocked': False}
+        )
+        await session.execute(stmt)
+        await session.execute(insert(Message), entries)
+        await session.commit()
+    return [user_id for user_id in last_active if user_id not in existing]
+
+@timed_db_call
 async def get_last_messages(user_id, limit=10):
     """Получает последние сообщения пользователя"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         result = await session.execute(
-            select(Message).where(Message.user_id==user_id).order_by(desc(Message.created_at)).limit(limit)
+            select(Message).where(Message.user_id==user_id).order_by(desc(Message.created_at), desc(Message.id)).limit(limit)
         )
         return list(reversed(result.scalars().all()))
 
-async def save_summary_db(user_id, summary):
-    """Сохраняет резюме диалога в базу данных"""
+@timed_db_call
+async def load_user_context(user_id, limit=10, include_subscription=True, include_usage=True, include_system_prompt=True):
+    """
+    Загружает контекст пользователя за одну сессию БД
+
+    Подписка, счётчик квоты за текущие сутки, последнее резюме и системный промпт
+    выбираются одним запросом через скалярные подзапросы, история сообщений — вторым.
+
+    Args:
+        user_id: ID пользователя
+        limit: Количество последних сообщений для краткосрочной памяти
+        include_subscription: Проверять ли подписку (не нужно, если есть реестр подписок в памяти)
+        include_usage: Читать ли счётчик квоты из usage_counters (не нужно, если он уже в памяти)
+        include_system_prompt: Загружать ли системный промпт (не нужен, если он уже закэширован)
+
+    Returns:
+        UserContext: Контекст пользователя
+    """
+    now = datetime.datetime.utcnow()
+    has_subscription = exists().where(
+        Subscription.user_id==user_id, Subscription.is_active==True, Subscription.expires_at > now
+    )
+    # Тот же счётчик, что ведёт quota_service: учитываются только отвеченные запросы
+    used = (
+        select(UsageCounter.count)
+        .where(UsageCounter.user_id==user_id, UsageCounter.day==now.date())
+        .scalar_subquery()
+    )
+    summary = (
+        select(Summary.content).where(Summary.user_id==user_id)
+        .order_by(desc(Summary.created_at), desc(Summary.id)).limit(1).scalar_subquery()
+    )
+    columns = [
+        used if include_usage else literal(0),
+        summary,
+        has_subscription if include_subscription else literal(False),
+    ]
+    if include_system_prompt:
+        columns.append(
+            select(SystemPrompt.content).order_by(desc(SystemPrompt.id)).limit(1).scalar_subquery()
+        )
+    async with ReadSessionLocal() as session:
+        row = (await session.execute(select(*columns))).one()
+        result = await session.execute(
+            select(Message.role, Message.content, Message.token_count)
+            .where(Message.user_id==user_id).order_by(desc(Message.created_at), desc(Message.id)).limit(limit)
+        )
+        messages = [
+            {"role": role, "content": content, "tokens": tokens}
+            for role, content, tokens in reversed(result.all())
+        ]
+    return UserContext(
+        user_id=user_id,
+        is_premium=bool(row[2]),
+        used=row[0] or 0,
+        messages=messages,
+        summary=row[1],
+        system_prompt=row[3] if include_system_prompt else None,
+    )
+
+@timed_db_call
+async def save_summary_db(user_id, summary, last_message=None):
+    """
+    Сохраняет текущее резюме диалога пользователя (одна строка на пользователя)
+
+    Args:
+        user_id: ID пользователя
+        summary: Текст резюме
+        last_message: Последнее учтённое сообщение (строка с id и created_at); если None — отметка не меняется
+    """
     async with SessionLocal() as session:
         # Проверяем, существует ли пользователь
         user = await session.get(User, user_id)
         if not user:
             user = User(user_id=user_id, last_active=datetime.datetime.utcnow())
             session.add(user)
-            
-        s = Summary(user_id=user_id, content=summary)
-        session.add(s)
+            await session.flush()
+        
+        values = {'content': summary, 'created_at': datetime.datetime.utcnow()}
+        if last_message is not None:
+            values['last_message_id'] = last_message.id
+            values['last_message_at'] = last_message.created_at
+        stmt = insert(Summary).values(user_id=user_id, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=[Summary.user_id], set_=values)
+        await session.execute(stmt)
         await session.commit()
-        logger.info(f"Сохранено новое резюме для пользователя {user_id}")
+        logger.info(f"Сохранено резюме для пользователя {user_id}")
 
+@timed_db_call
+async def get_summary_state_db(user_id):
+    """
+    Получает текущее резюме пользователя и водяную отметку последнего учтённого в нём сообщения
+
+    Returns:
+        tuple: (content, watermark), где watermark — (created_at, id) или None, если отметки нет
+    """
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Summary.content, Summary.last_message_at, Summary.last_message_id).where(Summary.user_id==user_id)
+        )
+        row = result.first()
+        if row is None:
+            return None, None
+        watermark = (row.last_message_at, row.last_message_id or 0) if row.last_message_at else None
+        return row.content, watermark
+
+def _after_watermark(watermark):
+    """
+    Условие «сообщение новее водяной отметки» в порядке (created_at, id), как у истории
+
+    Только по id сравнивать нельзя: после полной очистки messages SQLite выдаёт id с 1.
+    """
+    if watermark is None:
+        return true()
+    created_at, message_id = watermark
+    return or_(Message.created_at > created_at, and_(Message.created_at == created_at, Message.id > message_id))
+
+@timed_db_call
+async def count_messages_after_db(user_id, watermark):
+    """Считает сообщения пользователя новее водяной отметки (None — все сообщения)"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(func.count(Message.id)).where(Message.user_id==user_id, _after_watermark(watermark))
+        )
+        return result.scalar() or 0
+
+@timed_db_call
+async def get_messages_after_db(user_id, watermark, limit):
+    """
+    Получает последние limit сообщений пользователя новее водяной отметки
+
+    Returns:
+        list: Строки (id, role, content, created_at) в хронологическом порядке
+    """
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Message.id, Message.role, Message.content, Message.created_at)
+            .where(Message.user_id==user_id, _after_watermark(watermark))
+            .order_by(desc(Message.created_at), desc(Message.id)).limit(limit)
+        )
+        return list(reversed(result.all()))
+
+@timed_db_call
 async def get_last_summary_db(user_id):
     """Получает последнее резюме диалога пользователя"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         result = await session.execute(
-            select(Summary).where(Summary.user_id==user_id).order_by(desc(Summary.created_at)).limit(1)
+            select(Summary).where(Summary.user_id==user_id).order_by(desc(Summary.created_at), desc(Summary.id)).limit(1)
         )
         s = result.scalar()
         return s.content if s else None
 
+@timed_db_call
 async def get_user_subscription(user_id):
     """Проверяет наличие активной подписки у пользователя"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         result = await session.execute(
             select(Subscription).where(Subscription.user_id==user_id, Subscription.is_active==True, Subscription.expires_at > datetime.datetime.utcnow())
         )
         return result.scalar()
 
+@timed_db_call
+async def get_active_subscriptions():
+    """
+    Получает все действующие подписки
+
+    Returns:
+        list: Пары (user_id, expires_at)
+    """
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Subscription.user_id, Subscription.expires_at).where(
+                Subscription.is_active==True, Subscription.expires_at > datetime.datetime.utcnow()
+            )
+        )
+        return result.all()
+
+@timed_db_call
 async def add_subscription(user_id, expires_at):
-    """Добавляет или обновляет подписку пользователя"""
+    """Добавляет или продлевает подписку пользователя"""
     async with SessionLocal() as session:
-        # Проверяем, существует ли пользователь
-        user = await session.get(User, user_id)
-        if not user:
-            user = User(user_id=user_id, last_active=datetime.datetime.utcnow())
-            session.add(user)
-            await session.flush()
-        
-        # Проверяем, есть ли уже подписка
-        result = await session.execute(
-            select(Subscription).where(Subscription.user_id==user_id)
+        # Пользователь мог ещё ни разу не написать боту
+        await session.execute(
+            insert(User).values(user_id=user_id, last_active=datetime.datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=[User.user_id])
         )
-        subscription = result.scalar()
-        
-        if subscription:
-            # Обновляем существующую подписку
-            subscription.is_active = True
-            subscription.expires_at = expires_at
-            logger.info(f"Обновлена подписка для пользователя {user_id} до {expires_at}")
-        else:
-            # Создаем новую подписку
-            subscription = Subscription(user_id=user_id, is_active=True, expires_at=expires_at)
-            session.add(subscription)
-            logger.info(f"Создана новая подписка для пользователя {user_id} до {expires_at}")
-            
+        # Новый срок — новое уведомление перед его окончанием
+        values = {'is_active': True, 'expires_at': expires_at, 'notified_at': None}
+        stmt = insert(Subscription).values(user_id=user_id, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=[Subscription.user_id], set_=values).returning(Subscription)
+        subscription = (await session.execute(stmt)).scalar_one()
         await session.commit()
+        logger.info(f"Подписка пользователя {user_id} действует до {expires_at}")
         return subscription
 
+@timed_db_call
 async def get_expiring_subscriptions(days_before=3):
     """
     Получает список подписок, которые истекают в ближайшие дни
@@ -93,9 +281,9 @@ async def get_expiring_subscriptions(days_before=3):
         days_before: За сколько дней до истечения срока уведомлять
         
     Returns:
-        list: Список подписок, которые скоро истекут
+        list: Список подписок, которые скоро истекут и о которых ещё не уведомляли
     """
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         # Вычисляем даты для проверки
         now = datetime.datetime.utcnow()
         future = now + datetime.timedelta(days=days_before)
@@ -105,29 +293,217 @@ async def get_expiring_subscriptions(days_before=3):
             select(Subscription).where(
                 Subscription.is_active==True,
                 Subscription.expires_at > now,
-                Subscription.expires_at <= future
+                Subscription.expires_at <= future,
+                Subscription.notified_at.is_(None)
             )
         )
         
         return result.scalars().all()
 
+@timed_db_call
+async def mark_subscriptions_notified(subscription_ids):
+    """Отмечает, что уведомление об окончании подписок отправлено"""
+    if not subscription_ids:
+        return
+    async with SessionLocal() as session:
+        await session.execute(
+            update(Subscription)
+            .where(Subscription.id.in_(subscription_ids))
+            .values(notified_at=datetime.datetime.utcnow())
+        )
+        await session.commit()
+
+@timed_db_call
 async def get_user_message_count(user_id):
     """Получает количество сообщений пользователя за последние 24 часа"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         result = await session.execute(
             select(func.count(Message.id)).where(Message.user_id==user_id, Message.created_at > datetime.datetime.utcnow() - datetime.timedelta(days=1))
         )
         return result.scalar() or 0
 
+@timed_db_call
+async def get_usage_counter_db(user_id):
+    """
+    Получает счётчик использования пользователя
+
+    Returns:
+        tuple: (day, count) или None, если счётчика ещё нет
+    """
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(UsageCounter.day, UsageCounter.count).where(UsageCounter.user_id==user_id)
+        )
+        return result.first()
+
+@timed_db_call
+async def save_usage_counter_db(user_id, day, count):
+    """Сохраняет счётчик использования пользователя (upsert по user_id)"""
+    async with SessionLocal() as session:
+        stmt = insert(UsageCounter).values(user_id=user_id, day=day, count=count)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UsageCounter.user_id],
+            set_={'day': stmt.excluded.day, 'count': stmt.excluded.count}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+@timed_db_call
 async def get_all_users():
     """Получает список всех пользователей, отсортированный по времени последней активности"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         result = await session.execute(select(User).order_by(desc(User.last_active)))
         return result.scalars().all()
 
+def _user_filters(subscribers_only=False, active_since=None):
+    conditions = []
+    if subscribers_only:
+        conditions.append(exists().where(
+            Subscription.user_id == User.user_id,
+            Subscription.expires_at > datetime.datetime.utcnow()
+        ))
+    if active_since is not None:
+        conditions.append(User.last_active >= active_since)
+    return conditions
+
+@timed_db_call
+async def get_users_page(cursor=None, backward=False, limit=20, subscribers_only=False, active_since=None):
+    """
+    Возвращает страницу пользователей, отсортированных по последней активности (новые первыми)
+
+    Страницы выбираются по ключу (last_active, user_id) от границы предыдущей страницы,
+    поэтому время запроса не зависит от номера страницы и размера таблицы.
+
+    Args:
+        cursor: Пара (user_id, last_active) последней строки текущей страницы для следующей
+            страницы или первой строки для предыдущей; None — первая страница
+        backward: Листать назад (к более активным пользователям)
+        limit: Размер страницы
+        subscribers_only: Только пользователи с действующей подпиской
+        active_since: Только активные начиная с этого момента (datetime)
+
+    Returns:
+        tuple: (список пар (user_id, last_active) в порядке показа, есть ли ещё страница в этом направлении)
+    """
+    conditions = _user_filters(subscribers_only, active_since)
+    if cursor is not None:
+        user_id, last_active = cursor
+        if backward:
+            conditions.append(or_(
+                User.last_active > last_active,
+                and_(User.last_active == last_active, User.user_id > user_id)
+            ))
+        else:
+            conditions.append(or_(
+                User.last_active < last_active,
+                and_(User.last_active == last_active, User.user_id < user_id)
+            ))
+    order = (User.last_active, User.user_id) if backward else (desc(User.last_active), desc(User.user_id))
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(User.user_id, User.last_active).where(*conditions).order_by(*order).limit(limit + 1)
+        )
+        rows = [tuple(row) for row in result]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+@timed_db_call
+async def count_users(subscribers_only=False, active_since=None):
+    """Считает пользователей с теми же фильтрами, что и get_users_page"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(func.count()).select_from(User).where(*_user_filters(subscribers_only, active_since))
+        )
+        return result.scalar()
+
+@timed_db_call
+async def get_user_ids_after(after_user_id, limit):
+    """
+    Возвращает следующую порцию ID пользователей, не блокировавших бота
+
+    Выборка по ключу (user_id > after_user_id) не зависит от размера таблицы,
+    в отличие от OFFSET, и устойчива к добавлению новых пользователей.
+    """
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(User.user_id)
+            .where(User.user_id > after_user_id, User.is_blocked == False)
+            .order_by(User.user_id)
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+@timed_db_call
+async def mark_users_blocked(user_ids):
+    """Отмечает пользователей, заблокировавших бота"""
+    if not user_ids:
+        return
+    async with SessionLocal() as session:
+        await session.execute(update(User).where(User.user_id.in_(user_ids)).values(is_blocked=True))
+        await session.commit()
+
+@timed_db_call
+async def create_campaign(text):
+    """Создаёт черновик рассылки и возвращает его ID"""
+    async with SessionLocal() as session:
+        campaign = BroadcastCampaign(text=text, status='draft')
+        session.add(campaign)
+        await session.commit()
+        return campaign.id
+
+@timed_db_call
+async def get_campaign(campaign_id):
+    async with ReadSessionLocal() as session:
+        return await session.get(BroadcastCampaign, campaign_id)
+
+@timed_db_call
+async def get_running_campaigns():
+    """Рассылки, прерванные остановкой бота"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(BroadcastCampaign).where(BroadcastCampaign.status == 'running').order_by(BroadcastCampaign.id)
+        )
+        return result.scalars().all()
+
+@timed_db_call
+async def update_campaign(campaign_id, **values):
+    """
+    Обновляет поля рассылки (статус, прогресс, сообщение со статусом)
+
+    Returns:
+        bool: Была ли рассылка обновлена
+    """
+    async with SessionLocal() as session:
+        result = await session.execute(
+            update(BroadcastCampaign).where(BroadcastCampaign.id == campaign_id).values(**values)
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+@timed_db_call
+async def start_campaign_db(campaign_id, status_chat_id, status_message_id):
+    """
+    Переводит черновик рассылки в работу
+
+    Returns:
+        bool: False, если рассылка уже запущена или отменена (повторное нажатие кнопки)
+    """
+    async with SessionLocal() as session:
+        result = await session.execute(
+            update(BroadcastCampaign)
+            .where(BroadcastCampaign.id == campaign_id, BroadcastCampaign.status == 'draft')
+            .values(status='running', status_chat_id=status_chat_id, status_message_id=status_message_id)
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+@timed_db_call
 async def get_stats():
     """Получает статистику использования бота"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         users = await session.execute(select(func.count(User.user_id)))
         subs = await session.execute(select(func.count(Subscription.id)).where(Subscription.is_active==True, Subscription.expires_at > datetime.datetime.utcnow()))
         msgs = await session.execute(select(func.count(Message.id)).where(Message.created_at > datetime.datetime.utcnow() - datetime.timedelta(days=1)))
@@ -137,38 +513,242 @@ async def get_stats():
             'messages_today': msgs.scalar() or 0
         }
 
+@timed_db_call
+async def add_stat_aggregates_db(counts):
+    """
+    Прибавляет значения к агрегатам статистики одной транзакцией
+
+    Args:
+        counts: Словарь (metric, period) -> прибавка
+    """
+    if not counts:
+        return
+    async with SessionLocal() as session:
+        stmt = insert(StatAggregate).values([
+            {'metric': metric, 'period': period, 'value': value} for (metric, period), value in counts.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[StatAggregate.period, StatAggregate.metric],
+            set_={'value': StatAggregate.value + stmt.excluded.value}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+@timed_db_call
+async def get_stat_aggregates_db(periods):
+    """Возвращает агрегаты за указанные периоды: словарь (metric, period) -> значение"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(StatAggregate.metric, StatAggregate.period, StatAggregate.value)
+            .where(StatAggregate.period.in_(periods))
+        )
+        return {(metric, period): value for metric, period, value in result}
+
+@timed_db_call
+async def get_active_user_ids_since(since):
+    """ID пользователей, активных начиная с момента since (по индексу last_active)"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(select(User.user_id).where(User.last_active >= since))
+        return list(result.scalars())
+
+@timed_db_call
+async def get_job_last_run(name):
+    """Время последнего запуска фоновой задачи или None"""
+    async with ReadSessionLocal() as session:
+        job = await session.get(ScheduledJob, name)
+        return job.last_run_at if job else None
+
+@timed_db_call
+async def save_job_run(name, last_run_at, status, error=None):
+    """Сохраняет время и результат запуска фоновой задачи"""
+    async with SessionLocal() as session:
+        stmt = insert(ScheduledJob).values(name=name, last_run_at=last_run_at, last_status=status, last_error=error)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ScheduledJob.name],
+            set_={'last_run_at': last_run_at, 'last_status': status, 'last_error': error}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+@timed_db_call
 async def get_system_prompt_db():
     """Получает текущий системный промпт"""
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         result = await session.execute(select(SystemPrompt).order_by(desc(SystemPrompt.id)).limit(1))
         s = result.scalar()
         return s.content if s else None
 
+@timed_db_call
+async def get_system_prompt_with_version_db():
+    """
+    Получает текущий системный промпт вместе с его версией
+
+    Версией служит id строки: каждая смена промпта добавляет новую строку.
+
+    Returns:
+        tuple: (content, version), для пустой таблицы — (None, 0)
+    """
+    async with ReadSessionLocal() as session:
+        result = await session.execute(select(SystemPrompt).order_by(desc(SystemPrompt.id)).limit(1))
+        s = result.scalar()
+        return (s.content, s.id) if s else (None, 0)
+
+@timed_db_call
+async def get_system_prompt_version_db():
+    """Возвращает версию текущего системного промпта (дешёвый запрос по первичному ключу)"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(select(func.max(SystemPrompt.id)))
+        return result.scalar() or 0
+
+@timed_db_call
 async def set_system_prompt_db(prompt):
-    """Устанавливает новый системный промпт"""
+    """Устанавливает новый системный промпт и возвращает его версию"""
     async with SessionLocal() as session:
         s = SystemPrompt(content=prompt)
         session.add(s)
         await session.commit()
         logger.info("Установлен новый системный промпт")
+        return s.id
+
+async def _delete_chunk(session, model, key_columns, where, limit):
+    """Удаляет до limit строк по условию одним запросом и возвращает их количество"""
+    chunk = select(*key_columns).where(*where).limit(limit)
+    key = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
+    result = await session.execute(delete(model).where(key.in_(chunk)))
+    await session.commit()
+    return result.rowcount
 
-async def delete_old_messages(days=30):
-    """Удаляет сообщения старше указанного количества дней"""
+@timed_db_call
+async def delete_old_messages_chunk(cutoff, limit):
+    """Удаляет порцию сообщений, созданных раньше cutoff"""
     async with SessionLocal() as session:
-        cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=days)
-        
-        # Получаем количество сообщений для удаления
-        count_result = await session.execute(
-            select(func.count(Message.id)).where(Message.created_at < cutoff_date)
+        # Старые сообщения лежат в начале таблицы по id, поэтому выборка порции останавливается быстро
+        return await _delete_chunk(session, Message, [Message.id], [Message.created_at < cutoff], limit)
+
+@timed_db_call
+async def get_old_messages_chunk_db(cutoff, limit):
+    """Возвращает порцию сообщений, созданных раньше cutoff, по возрастанию id (словари со всеми полями)"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Message.id, Message.user_id, Message.role, Message.content, Message.token_count, Message.created_at)
+            .where(Message.created_at < cutoff)
+            .order_by(Message.id)
+            .limit(limit)
         )
-        count = count_result.scalar() or 0
-        
-        # Удаляем сообщения
-        if count > 0:
-            await session.execute(
-                delete(Message).where(Message.created_at < cutoff_date)
+        return [dict(row._mapping) for row in result]
+
+@timed_db_call
+async def delete_messages_by_ids_db(ids):
+    """Удаляет сообщения по списку id и возвращает количество удалённых"""
+    if not ids:
+        return 0
+    async with SessionLocal() as session:
+        result = await session.execute(delete(Message).where(Message.id.in_(ids)))
+        await session.commit()
+        return result.rowcount
+
+@timed_db_call
+async def insert_messages_keep_ids_db(rows):
+    """
+    Возвращает сообщения в таблицу с исходными id (восстановление из архива)
+
+    Сообщение, которое уже есть в таблице (тот же пользователь, время и текст), пропускается.
+    Если его id занят другим сообщением (SQLite выдаёт id повторно после очистки таблицы),
+    сообщение вставляется с новым id.
+
+    Returns:
+        int: Сколько сообщений добавлено
+    """
+    if not rows:
+        return 0
+    async with SessionLocal() as session:
+        result = await session.execute(
+            select(Message.user_id, Message.created_at, Message.content).where(
+                Message.user_id.in_({row['user_id'] for row in rows}),
+                Message.created_at.in_({row['created_at'] for row in rows})
             )
-            await session.commit()
-            logger.info(f"Удалено {count} сообщений старше {days} дней")
-        
-        return count 
\ No newline at end of file
+        )
+        present = set(result.tuples())
+        result = await session.execute(select(Message.id).where(Message.id.in_([row['id'] for row in rows])))
+        taken_ids = set(result.scalars())
+        keep_ids, new_ids = [], []
+        for row in rows:
+            key = (row['user_id'], row['created_at'], row['content'])
+            if key in present:
+                continue
+            present.add(key)
+            if row['id'] in taken_ids:
+                new_ids.append({column: value for column, value in row.items() if column != 'id'})
+            else:
+                taken_ids.add(row['id'])
+                keep_ids.append(row)
+        if keep_ids:
+            await session.execute(insert(Message).values(keep_ids))
+        if new_ids:
+            await session.execute(insert(Message), new_ids)
+        await session.commit()
+        return len(keep_ids) + len(new_ids)
+
+@timed_db_call
+async def delete_stale_summaries_chunk(cutoff, limit):
+    """Удаляет порцию резюме пользователей, неактивных с момента cutoff"""
+    async with SessionLocal() as session:
+        inactive = select(User.user_id).where(User.last_active < cutoff)
+        return await _delete_chunk(session, Summary, [Summary.id], [Summary.user_id.in_(inactive)], limit)
+
+@timed_db_call
+async def delete_finished_campaigns_chunk(cutoff, limit):
+    """Удаляет порцию завершённых или отменённых рассылок, созданных раньше cutoff"""
+    async with SessionLocal() as session:
+        return await _delete_chunk(session, BroadcastCampaign, [BroadcastCampaign.id], [
+            BroadcastCampaign.status.in_(['done', 'cancelled']),
+            BroadcastCampaign.created_at < cutoff
+        ], limit)
+
+@timed_db_call
+async def delete_hourly_stats_chunk(cutoff, limit):
+    """Удаляет порцию почасовых агрегатов статистики за часы раньше cutoff (дневные остаются)"""
+    cutoff_period = cutoff.strftime('%Y-%m-%dT%H')
+    async with SessionLocal() as session:
+        key_columns = [StatAggregate.period, StatAggregate.metric]
+        return await _delete_chunk(session, StatAggregate, key_columns, [
+            StatAggregate.period < cutoff_period,
+            StatAggregate.period.like('%T%')
+        ], limit)
+
+@timed_db_call
+async def get_fsm_record_db(key, fresh_since):
+    """Возвращает (state, data) по ключу FSM, если запись обновлялась не раньше fresh_since, иначе None"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(FsmState.state, FsmState.data)
+            .where(FsmState.key == key, FsmState.updated_at >= fresh_since)
+        )
+        return result.first()
+
+@timed_db_call
+async def get_fsm_keys_db(fresh_since):
+    """Возвращает ключи FSM с записями, обновлёнными не раньше fresh_since"""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(select(FsmState.key).where(FsmState.updated_at >= fresh_since))
+        return result.scalars().all()
+
+@timed_db_call
+async def save_fsm_field_db(key, **values):
+    """Сохраняет state или data по ключу FSM и продлевает время жизни записи"""
+    values['updated_at'] = datetime.datetime.utcnow()
+    async with SessionLocal() as session:
+        stmt = insert(FsmState).values(key=key, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=[FsmState.key], set_=values)
+        await session.execute(stmt)
+        # Пустая запись не нужна: так состояние завершённых диалогов не копится в таблице
+        await session.execute(
+            delete(FsmState).where(FsmState.key == key, FsmState.state.is_(None), or_(FsmState.data.is_(None), FsmState.data == '{}'))
+        )
+        await session.commit()
+
+@timed_db_call
+async def delete_expired_fsm_states_chunk(cutoff, limit):
+    """Удаляет порцию состояний FSM, не обновлявшихся с момента cutoff"""
+    async with SessionLocal() as session:
+        return await _delete_chunk(session, FsmState, [FsmState.key], [FsmState.updated_at < cutoff], limit)
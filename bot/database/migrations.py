@@ -0,0 +1,160 @@
+"""
+Версионные миграции схемы базы данных
+
+create_all создаёт только отсутствующие таблицы и индексы новых таблиц, но не меняет
+уже существующие, поэтому изменения схемы для старых файлов bot.db описываются здесь.
+Каждая миграция должна быть идемпотентной: на свежей базе create_all уже создал всё
+нужное, и миграция просто отмечается как применённая.
+"""
+from sqlalchemy import select, insert, delete, inspect, text
+from loguru import logger
+from bot.database.models import Base, Timestamp, SchemaMigration, SchemaSetting, use_epoch_timestamps
+
+def _create_index(conn, name, table, columns):
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+def _add_hot_path_indexes(conn):
+    """Составные индексы для выборок по пользователю, упорядоченных по времени"""
+    _create_index(conn, 'ix_messages_user_id_created_at', 'messages', ['user_id', 'created_at'])
+    _create_index(conn, 'ix_summaries_user_id_created_at', 'summaries', ['user_id', 'created_at'])
+    _create_index(conn, 'ix_subscriptions_user_id_expires_at', 'subscriptions', ['user_id', 'expires_at'])
+
+def _has_column(conn, table, column):
+    return any(c['name'] == column for c in inspect(conn).get_columns(table))
+
+def _single_summary_per_user(conn):
+    """Одно текущее резюме на пользователя с отметкой последнего учтённого сообщения"""
+    if not _has_column(conn, 'summaries', 'last_message_id'):
+        conn.execute(text("ALTER TABLE summaries ADD COLUMN last_message_id INTEGER DEFAULT 0"))
+    conn.execute(text(
+        "DELETE FROM summaries WHERE id NOT IN (SELECT MAX(id) FROM summaries GROUP BY user_id)"
+    ))
+    # Старые резюме считаем покрывающими все сообщения, написанные до их создания
+    conn.execute(text(
+        "UPDATE summaries SET last_message_id = ("
+        "SELECT COALESCE(MAX(messages.id), 0) FROM messages "
+        "WHERE messages.user_id = summaries.user_id AND messages.created_at <= summaries.created_at"
+        ") WHERE last_message_id IS NULL OR last_message_id = 0"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_summaries_user_id ON summaries (user_id)"))
+
+def _add_message_token_count(conn):
+    """Количество токенов в сообщении, посчитанное при записи"""
+    if not _has_column(conn, 'messages', 'token_count'):
+        conn.execute(text("ALTER TABLE messages ADD COLUMN token_count INTEGER"))
+
+def _add_user_is_blocked(conn):
+    """Отметка пользователей, заблокировавших бота"""
+    if not _has_column(conn, 'users', 'is_blocked'):
+        conn.execute(text("ALTER TABLE users ADD COLUMN is_blocked BOOLEAN NOT NULL DEFAULT FALSE"))
+
+def _add_users_activity_index(conn):
+    """Индекс для постраничного вывода пользователей по последней активности"""
+    _create_index(conn, 'ix_users_last_active_user_id', 'users', ['last_active', 'user_id'])
+
+def _backfill_stat_aggregates(conn):
+    """Заполняет агрегаты статистики по уже сохранённым сообщениям"""
+    if conn.dialect.name != 'sqlite':
+        return
+    # Время может храниться и строкой, и числом секунд Unix (DB_EPOCH_TIMESTAMPS)
+    created = "CASE WHEN typeof(created_at) = 'integer' THEN datetime(created_at, 'unixepoch') ELSE created_at END"
+    for period in ("strftime('%Y-%m-%d', ts)", "strftime('%Y-%m-%dT%H', ts)"):
+        conn.execute(text(
+            f"INSERT OR IGNORE INTO stat_aggregates (metric, period, value) "
+            f"SELECT 'messages_' || role, {period}, COUNT(*) "
+            f"FROM (SELECT role, {created} AS ts FROM messages) GROUP BY role, {period}"
+        ))
+        conn.execute(text(
+            f"INSERT OR IGNORE INTO stat_aggregates (metric, period, value) "
+            f"SELECT 'active_users', {period}, COUNT(DISTINCT user_id) "
+            f"FROM (SELECT user_id, {created} AS ts FROM messages WHERE role = 'user') GROUP BY {period}"
+        ))
+
+def _add_subscription_notified_at(conn):
+    """Отметка отправленного уведомления об окончании подписки"""
+    if not _has_column(conn, 'subscriptions', 'notified_at'):
+        conn.execute(text("ALTER TABLE subscriptions ADD COLUMN notified_at TIMESTAMP"))
+
+def _single_subscription_per_user(conn):
+    """Одна строка подписки на пользователя: по ней add_subscription делает upsert"""
+    # Из повторов оставляем подписку с самым поздним сроком
+    conn.execute(text(
+        "DELETE FROM subscriptions WHERE id <> ("
+        "SELECT s.id FROM subscriptions s WHERE s.user_id = subscriptions.user_id "
+        "ORDER BY s.expires_at DESC NULLS LAST, s.id DESC LIMIT 1"
+        ")"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_subscriptions_user_id ON subscriptions (user_id)"))
+
+def _add_summary_watermark_time(conn):
+    """Время последнего учтённого в резюме сообщения: водяная отметка не зависит от повторных id"""
+    if not _has_column(conn, 'summaries', 'last_message_at'):
+        conn.execute(text("ALTER TABLE summaries ADD COLUMN last_message_at TIMESTAMP"))
+    # Если отмеченного сообщения уже нет, резюме покрывает всё, что написано до его сохранения
+    conn.execute(text(
+        "UPDATE summaries SET last_message_at = COALESCE(("
+        "SELECT messages.created_at FROM messages "
+        "WHERE messages.id = summaries.last_message_id AND messages.user_id = summaries.user_id"
+        "), created_at) WHERE last_message_at IS NULL AND last_message_id > 0"
+    ))
+
+# Список миграций: (версия, описание, функция). Версии только растут, применённые не меняются.
+MIGRATIONS = [
+    (1, "Составные индексы messages, summaries, subscriptions", _add_hot_path_indexes),
+    (2, "Одно резюме на пользователя с водяной отметкой", _single_summary_per_user),
+    (3, "Количество токенов в messages", _add_message_token_count),
+    (4, "Отметка заблокировавших бота в users", _add_user_is_blocked),
+    (5, "Индекс users по активности для постраничного вывода", _add_users_activity_index),
+    (6, "Агрегаты статистики по истории сообщений", _backfill_stat_aggregates),
+    (7, "Отметка уведомления в subscriptions", _add_subscription_notified_at),
+    (8, "Одна подписка на пользователя", _single_subscription_per_user),
+    (9, "Время водяной отметки резюме", _add_summary_watermark_time),
+]
+
+def _sync_timestamp_format(conn):
+    """Приводит хранимые значения Timestamp к формату, выбранному в DB_EPOCH_TIMESTAMPS"""
+    if conn.dialect.name != 'sqlite':
+        return
+    wanted = 'epoch' if use_epoch_timestamps(conn.dialect) else 'datetime'
+    current = conn.execute(
+        select(SchemaSetting.value).where(SchemaSetting.key == 'timestamp_format')
+    ).scalar() or 'datetime'
+    if current == wanted:
+        return
+
+    logger.info(f"Converting stored timestamps from {current} to {wanted}")
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if not isinstance(column.type, Timestamp):
+                continue
+            if wanted == 'epoch':
+                conn.execute(text(
+                    f"UPDATE {table.name} SET {column.name} = CAST(strftime('%s', {column.name}) AS INTEGER) "
+                    f"WHERE typeof({column.name}) = 'text'"
+                ))
+            else:
+                conn.execute(text(
+                    f"UPDATE {table.name} SET {column.name} = datetime({column.name}, 'unixepoch') "
+                    f"WHERE typeof({column.name}) = 'integer'"
+                ))
+
+    conn.execute(delete(SchemaSetting).where(SchemaSetting.key == 'timestamp_format'))
+    conn.execute(insert(SchemaSetting).values(key='timestamp_format', value=wanted))
+
+def run_migrations(conn):
+    """
+    Применяет к базе все ещё не применённые миграции
+
+    Вызывается из init_db внутри той же транзакции, что и create_all.
+
+    Args:
+        conn: Синхронное соединение SQLAlchemy
+    """
+    applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {name}")
+        migrate(conn)
+        conn.execute(insert(SchemaMigration).values(version=version, name=name))
+    _sync_timestamp_format(conn)
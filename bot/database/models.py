@@ -1,46 +1,225 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, func
+from sqlalchemy import (
+    Column, Integer, BigInteger, String, DateTime, Date, Boolean, ForeignKey, Text, Index, TypeDecorator, event, func,
+    false
+)
+from sqlalchemy.engine import make_url
+import calendar
 import datetime
-from bot.config import DB_PATH
+from bot.config import (
+    DATABASE_URL, DB_IS_SQLITE, DB_EPOCH_TIMESTAMPS, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT, DB_CACHE_SIZE,
+    DB_MMAP_SIZE, DB_AUTO_VACUUM, DB_WRITE_POOL_SIZE, DB_READ_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE, DB_STATEMENT_CACHE_SIZE
+)
 
-DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
-engine = create_async_engine(DATABASE_URL, echo=False)
+def _make_sqlite_engine(pool_size, read_only=False):
+    """Создаёт движок SQLite, который настраивает каждое новое соединение"""
+    new_engine = create_async_engine(DATABASE_URL, echo=False, pool_size=pool_size, max_overflow=0)
+
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Действует только для пустой базы; существующая переводится при первой очистке
+        cursor.execute(f"PRAGMA auto_vacuum={DB_AUTO_VACUUM}")
+        cursor.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+        cursor.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    return new_engine
+
+def _make_postgres_engine(pool_size, read_only=False):
+    """Создаёт движок PostgreSQL (asyncpg) с пулом соединений"""
+    url = make_url(DATABASE_URL)
+    # Кэш подготовленных запросов SQLAlchemy и asyncpg: при pgbouncer в режиме транзакций оба должны быть 0
+    url = url.update_query_dict({'prepared_statement_cache_size': str(DB_STATEMENT_CACHE_SIZE)})
+    new_engine = create_async_engine(
+        url,
+        echo=False,
+        pool_size=pool_size,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        # Соединение, оборванное сервером или балансировщиком, заменяется до выдачи из пула
+        pool_pre_ping=True,
+        connect_args={'statement_cache_size': DB_STATEMENT_CACHE_SIZE},
+    )
+    if read_only:
+        new_engine = new_engine.execution_options(postgresql_readonly=True)
+    return new_engine
+
+def _make_engine(pool_size, read_only=False):
+    if DB_IS_SQLITE:
+        return _make_sqlite_engine(pool_size, read_only)
+    return _make_postgres_engine(pool_size, read_only)
+
+# Запись и чтение идут через разные пулы: в режиме WAL чтение истории и статистики
+# не ждёт, пока писатель закончит вставку сообщений (в PostgreSQL читатель работает в read-only транзакциях)
+engine = _make_engine(DB_WRITE_POOL_SIZE)
+read_engine = _make_engine(DB_READ_POOL_SIZE, read_only=True)
 Base = declarative_base()
 SessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+ReadSessionLocal = sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
+
+def use_epoch_timestamps(dialect):
+    """Хранится ли время как целое число секунд Unix для данного диалекта"""
+    return DB_EPOCH_TIMESTAMPS and dialect.name == 'sqlite'
+
+class Timestamp(TypeDecorator):
+    """
+    Время в UTC без часового пояса
+
+    По умолчанию хранится как обычный DateTime. При DB_EPOCH_TIMESTAMPS в SQLite
+    хранится целым числом секунд Unix: такие значения занимают меньше места
+    в таблице и индексах и сравниваются как числа.
+    """
+    impl = DateTime
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if use_epoch_timestamps(dialect):
+            return dialect.type_descriptor(Integer())
+        return dialect.type_descriptor(DateTime())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not use_epoch_timestamps(dialect):
+            return value
+        return calendar.timegm(value.utctimetuple())
+
+    def process_result_value(self, value, dialect):
+        if value is None or not use_epoch_timestamps(dialect):
+            return value
+        return datetime.datetime.utcfromtimestamp(value)
+
+# ID пользователей и чатов Telegram не помещаются в 32 бита: в PostgreSQL это BIGINT.
+# В SQLite INTEGER и так 64-битный, схема существующих файлов не меняется
+TelegramId = BigInteger().with_variant(Integer(), 'sqlite')
 
 class User(Base):
     __tablename__ = 'users'
-    user_id = Column(Integer, primary_key=True, index=True)
-    last_active = Column(DateTime, default=datetime.datetime.utcnow)
+    user_id = Column(TelegramId, primary_key=True, index=True, autoincrement=False)
+    last_active = Column(Timestamp, default=datetime.datetime.utcnow)
+    # Пользователь заблокировал бота: рассылки его пропускают, пока он снова не напишет
+    is_blocked = Column(Boolean, default=False, nullable=False, server_default=false())
+    __table_args__ = (
+        Index('ix_users_last_active_user_id', 'last_active', 'user_id'),
+    )
 
 class Message(Base):
     __tablename__ = 'messages'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(TelegramId, ForeignKey('users.user_id'))
     role = Column(String)
     content = Column(Text)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Количество токенов в content, считается один раз при записи
+    token_count = Column(Integer)
+    created_at = Column(Timestamp, default=datetime.datetime.utcnow)
+    __table_args__ = (
+        Index('ix_messages_user_id_created_at', 'user_id', 'created_at'),
+    )
 
 class Subscription(Base):
     __tablename__ = 'subscriptions'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(TelegramId, ForeignKey('users.user_id'))
     is_active = Column(Boolean, default=False)
-    expires_at = Column(DateTime)
+    expires_at = Column(Timestamp)
+    # Когда отправлено уведомление о скором окончании; сбрасывается при продлении
+    notified_at = Column(Timestamp)
+    __table_args__ = (
+        Index('ix_subscriptions_user_id_expires_at', 'user_id', 'expires_at'),
+        Index('ux_subscriptions_user_id', 'user_id', unique=True),
+    )
 
 class Summary(Base):
     __tablename__ = 'summaries'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(TelegramId, ForeignKey('users.user_id'))
     content = Column(Text)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(Timestamp, default=datetime.datetime.utcnow)
+    # Последнее сообщение, уже учтённое в резюме: (created_at, id). Сравнивается по времени,
+    # потому что SQLite выдаёт id заново после полной очистки таблицы messages
+    last_message_id = Column(Integer, default=0)
+    last_message_at = Column(Timestamp)
+    __table_args__ = (
+        Index('ix_summaries_user_id_created_at', 'user_id', 'created_at'),
+        Index('ux_summaries_user_id', 'user_id', unique=True),
+    )
 
 class SystemPrompt(Base):
     __tablename__ = 'system_prompt'
     id = Column(Integer, primary_key=True)
     content = Column(Text)
 
+class UsageCounter(Base):
+    __tablename__ = 'usage_counters'
+    user_id = Column(TelegramId, primary_key=True, autoincrement=False)
+    day = Column(Date)
+    count = Column(Integer, default=0)
+
+class BroadcastCampaign(Base):
+    __tablename__ = 'broadcast_campaigns'
+    id = Column(Integer, primary_key=True)
+    text = Column(Text)
+    # draft -> running -> done; draft или running -> cancelled
+    status = Column(String, default='draft')
+    # Последний обработанный user_id: рассылка идёт по возрастанию user_id и после перезапуска продолжается с него
+    last_user_id = Column(TelegramId, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    # Сообщение администратора, в котором показывается ход рассылки
+    status_chat_id = Column(TelegramId)
+    status_message_id = Column(Integer)
+    created_at = Column(Timestamp, default=datetime.datetime.utcnow)
+    finished_at = Column(Timestamp)
+
+class StatAggregate(Base):
+    __tablename__ = 'stat_aggregates'
+    # Период в UTC: 'YYYY-MM-DD' для суток или 'YYYY-MM-DDTHH' для часа. Стоит первым
+    # в первичном ключе, чтобы выборка за несколько периодов шла по ключу
+    period = Column(String, primary_key=True)
+    # Имя метрики: new_users, messages_user, messages_assistant, active_users, subscriptions_new, ...
+    metric = Column(String, primary_key=True)
+    value = Column(Integer, default=0)
+
+class ScheduledJob(Base):
+    __tablename__ = 'scheduled_jobs'
+    name = Column(String, primary_key=True)
+    # Время последнего запуска: по нему после перезапуска определяется, не пропущен ли запуск
+    last_run_at = Column(Timestamp)
+    last_status = Column(String)
+    last_error = Column(Text)
+
+class FsmState(Base):
+    __tablename__ = 'fsm_states'
+    # Ключ aiogram вида fsm:<chat_id>:<user_id>
+    key = Column(String, primary_key=True)
+    state = Column(String)
+    # Данные состояния в JSON
+    data = Column(Text)
+    # По нему истекают брошенные состояния (FSM_STATE_TTL)
+    updated_at = Column(Timestamp, default=datetime.datetime.utcnow, index=True)
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_at = Column(Timestamp, default=datetime.datetime.utcnow)
+
+class SchemaSetting(Base):
+    __tablename__ = 'schema_settings'
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
 async def init_db():
+    # Импорт здесь, так как миграции используют модели из этого модуля
+    from bot.database.migrations import run_migrations
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all) 
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(run_migrations)
@@ -1,17 +1,29 @@
 from aiogram import Router, F
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.filters import Command
-from bot.config import ADMIN_IDS
-from bot.database.crud import get_all_users, get_stats, add_subscription, delete_old_messages
+from bot.config import ADMIN_IDS, ARCHIVE_MESSAGES
+from bot.database.crud import get_users_page, count_users, create_campaign, start_campaign_db, update_campaign
 from bot.services.memory_service import set_system_prompt
+from bot.services.payment_service import grant_subscription, subscription_registry
+from bot.services.model_router import routing_stats
+from bot.services.moderation_service import moderation_cache
+from bot.services.broadcast_service import start_campaign
+from bot.services.stats_service import get_stats_series
+from bot.services.retention_service import (
+    run_retention, messages_policy, get_auto_vacuum_mode, convert_to_incremental_vacuum
+)
+from bot.services.archive_service import iter_archived_messages, restore_user_messages
 from aiogram.exceptions import TelegramForbiddenError
 import datetime
+import functools
 import os
+import time
 from loguru import logger
 
 router = Router()
 
 def admin_only(func):
+    @functools.wraps(func)
     async def wrapper(message: Message, *args, **kwargs):
         if message.from_user.id not in ADMIN_IDS:
             await message.answer("Доступ запрещён.")
@@ -27,12 +39,15 @@ async def admin_panel(message: Message):
         "🔑 <b>Админ-панель</b>\n\n"
         "<b>Основные команды:</b>\n"
         "/stats - Статистика использования\n"
-        "/users - Список пользователей\n"
+        "/users [subs] [DAYS] - Список пользователей\n"
         "/broadcast - Отправить сообщение всем\n\n"
         "<b>Настройки бота:</b>\n"
         "/set_prompt - Изменить системный промпт\n"
         "/show_prompt - Показать текущий промпт\n"
-        "/clean_db - Очистить старые сообщения\n\n"
+        "/clean_db - Очистить старые сообщения\n"
+        "/vacuum - Перевести базу в режим возврата места (один раз)\n"
+        "/archive ID - Выгрузить архив сообщений пользователя\n"
+        "/restore ID - Вернуть архив пользователя в базу\n\n"
         "<b>Управление подписками:</b>\n"
         "/add_subscription ID DAYS - Выдать подписку\n"
         "/check_sub ID - Проверить подписку пользователя"
@@ -47,10 +62,13 @@ async def broadcast(message: Message):
         await message.answer("Укажите текст для рассылки после команды.")
         return
     
+    # Текст сохраняется в черновик рассылки, кнопки ссылаются на его ID
+    campaign_id = await create_campaign(text)
+    
     # Создаем клавиатуру для подтверждения
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"broadcast_confirm_{message.message_id}")],
-        [InlineKeyboardButton(text="❌ Отменить", callback_data="broadcast_cancel")]
+        [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"broadcast_confirm_{campaign_id}")],
+        [InlineKeyboardButton(text="❌ Отменить", callback_data=f"broadcast_cancel_{campaign_id}")]
     ])
     
     await message.answer(
@@ -66,71 +84,111 @@ async def broadcast_confirm(callback_query):
         await callback_query.answer("Доступ запрещён.")
         return
     
-    message_id = int(callback_query.data.split("_")[2])
-    original_message = await callback_query.bot.get_message(
-        callback_query.message.chat.id, 
-        message_id
-    )
-    
-    text = original_message.text.partition(' ')[2]
-    users = await get_all_users()
-    count = 0
-    failed = 0
+    campaign_id = int(callback_query.data.split("_")[2])
     
-    # Показываем статус отправки
-    status_message = await callback_query.message.edit_text(
-        "Отправка сообщений...\nОбработано: 0 из {total}".format(total=len(users)),
-        reply_markup=None
-    )
+    # Статус рассылки показывается в этом же сообщении
+    status_message = callback_query.message
+    if not await start_campaign_db(campaign_id, status_message.chat.id, status_message.message_id):
+        await callback_query.answer("Рассылка уже запущена или отменена.")
+        return
     
-    for i, user in enumerate(users):
-        try:
-            await callback_query.bot.send_message(user.user_id, text)
-            count += 1
-        except TelegramForbiddenError:
-            failed += 1
-        except Exception as e:
-            logger.error(f"Error sending broadcast to {user.user_id}: {e}")
-            failed += 1
-            
-        # Обновляем статус каждые 10 пользователей
-        if i % 10 == 0:
-            await status_message.edit_text(
-                f"Отправка сообщений...\nОбработано: {i+1} из {len(users)}"
-            )
+    await status_message.edit_text("Отправка сообщений...", reply_markup=None)
+    await callback_query.answer()
     
-    await status_message.edit_text(
-        f"✅ Рассылка завершена.\n"
-        f"Доставлено: {count}\n"
-        f"Не доставлено: {failed}"
-    )
+    # Рассылка идёт в фоне и переживает перезапуск бота
+    start_campaign(callback_query.bot, campaign_id)
 
-@router.callback_query(lambda c: c.data == "broadcast_cancel")
+@router.callback_query(lambda c: c.data.startswith("broadcast_cancel"))
 async def broadcast_cancel(callback_query):
     if callback_query.from_user.id not in ADMIN_IDS:
         await callback_query.answer("Доступ запрещён.")
         return
     
+    # Старые кнопки были без ID рассылки
+    parts = callback_query.data.split("_")
+    if len(parts) > 2:
+        await update_campaign(int(parts[2]), status='cancelled', finished_at=datetime.datetime.utcnow())
+    
     await callback_query.message.edit_text("❌ Рассылка отменена.", reply_markup=None)
     await callback_query.answer()
 
+USERS_PAGE_SIZE = 20
+# Формат времени в callback_data кнопок листания (с микросекундами, чтобы граница страницы была точной)
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+async def _render_users_page(cursor=None, backward=False, subscribers_only=False, days=0):
+    """Собирает текст и кнопки страницы /users"""
+    active_since = datetime.datetime.utcnow() - datetime.timedelta(days=days) if days else None
+    users, has_more = await get_users_page(cursor, backward, USERS_PAGE_SIZE, subscribers_only, active_since)
+    if not users:
+        return None, None
+    total = await count_users(subscribers_only, active_since)
+    
+    # Назад можно листать, если мы пришли не с первой страницы, вперёд — если есть ещё строки
+    has_prev = has_more if backward else cursor is not None
+    has_next = cursor is not None if backward else has_more
+    
+    filters = []
+    if subscribers_only:
+        filters.append("только подписчики")
+    if days:
+        filters.append(f"активные за {days} дн.")
+    title = f"👥 <b>Пользователи{' (' + ', '.join(filters) + ')' if filters else ''}:</b>"
+    text = '\n'.join([
+        f"ID: {user_id} — Активность: {last_active.strftime('%d.%m %H:%M') if last_active else '—'}"
+        for user_id, last_active in users
+    ])
+    
+    def page_button(label, direction, edge):
+        edge_id, edge_active = edge
+        edge_time = edge_active.strftime(CURSOR_TIME_FORMAT) if edge_active else ""
+        return InlineKeyboardButton(
+            text=label,
+            callback_data=f"users_{direction}_{int(subscribers_only)}_{days}_{edge_time}_{edge_id}"
+        )
+    
+    buttons = []
+    if has_prev:
+        buttons.append(page_button("⬅️ Назад", "p", users[0]))
+    if has_next:
+        buttons.append(page_button("Вперёд ➡️", "n", users[-1]))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    
+    return f"{title}\n\n{text}\n\nВсего пользователей: {total}", keyboard
+
 @router.message(Command("users"))
 @admin_only
 async def users_list(message: Message):
-    users = await get_all_users()
-    if not users:
+    # /users [subs] [DAYS] — только подписчики и/или активные за последние DAYS дней
+    args = message.text.split()[1:]
+    subscribers_only = "subs" in args
+    days = next((int(arg) for arg in args if arg.isdigit()), 0)
+    
+    text, keyboard = await _render_users_page(subscribers_only=subscribers_only, days=days)
+    if text is None:
         await message.answer("Пользователей пока нет.")
         return
     
-    # Ограничиваем вывод 20 пользователями
-    users = users[:20]
-    text = '\n'.join([f"ID: {u.user_id} — Активность: {u.last_active.strftime('%d.%m %H:%M')}" for u in users])
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+@router.callback_query(lambda c: c.data.startswith("users_"))
+async def users_page(callback_query):
+    if callback_query.from_user.id not in ADMIN_IDS:
+        await callback_query.answer("Доступ запрещён.")
+        return
+    
+    _, direction, subscribers_only, days, edge_time, edge_id = callback_query.data.split("_")
+    edge_active = datetime.datetime.strptime(edge_time, CURSOR_TIME_FORMAT) if edge_time else None
     
-    await message.answer(
-        f"👥 <b>Последние {len(users)} пользователей:</b>\n\n{text}\n\n"
-        f"Всего пользователей: {len(await get_all_users())}",
-        parse_mode="HTML"
+    text, keyboard = await _render_users_page(
+        (int(edge_id), edge_active), direction == "p", subscribers_only == "1", int(days)
     )
+    if text is None:
+        await callback_query.answer("Больше пользователей нет.")
+        return
+    
+    await callback_query.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await callback_query.answer()
 
 @router.message(Command("set_prompt"))
 @admin_only
@@ -149,31 +207,74 @@ async def set_prompt_cmd(message: Message):
 @router.message(Command("show_prompt"))
 @admin_only
 async def show_prompt_cmd(message: Message):
-    from bot.services.memory_service import get_system_prompt
+    from bot.services.memory_service import get_system_prompt, get_system_prompt_version
     prompt = await get_system_prompt()
     
     if not prompt:
         await message.answer("Системный промпт не задан.")
         return
         
-    await message.answer(f"📝 <b>Текущий системный промпт:</b>\n\n{prompt}", parse_mode="HTML")
+    await message.answer(
+        f"📝 <b>Текущий системный промпт (версия {get_system_prompt_version()}):</b>\n\n{prompt}",
+        parse_mode="HTML"
+    )
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+def _sparkline(values):
+    """Рисует ряд значений строкой из блочных символов"""
+    top = max(values) or 1
+    return "".join(SPARK_CHARS[round(value / top * (len(SPARK_CHARS) - 1))] for value in values)
+
+def _trend_line(label, values):
+    """Сегодня, суммы за 7 и 30 дней и график за последние 7 дней"""
+    return f"{label}: сегодня {values[-1]}, 7 дн. {sum(values[-7:])}, 30 дн. {sum(values)}  {_sparkline(values[-7:])}"
 
 @router.message(Command("stats"))
 @admin_only
 async def stats(message: Message):
-    stats_data = await get_stats()
+    # Все числа берутся из счётчиков в памяти и готовых агрегатов за 30 дней
+    series = await get_stats_series(30)
+    registry_stats = subscription_registry.stats()
+    subscribers = registry_stats['active']
+    
+    def values(metric):
+        return series['series'].get(metric, [0] * len(series['days']))
     
     # Форматируем дату для красивого вывода
     current_date = datetime.datetime.now().strftime("%d.%m.%Y")
     
     stats_text = (
         f"📊 <b>Статистика на {current_date}</b>\n\n"
-        f"👥 Пользователей: {stats_data['users']}\n"
-        f"💳 Активных подписчиков: {stats_data['subscribers']}\n"
-        f"💬 Сообщений за день: {stats_data['messages_today']}\n\n"
-        f"Коэффициент конверсии: {round(stats_data['subscribers']/max(1, stats_data['users'])*100, 1)}%"
+        f"👥 Пользователей: {series['users_total']}\n"
+        f"💳 Активных подписчиков: {subscribers}\n"
+        f"💬 Сообщений за час: {series['hour'].get('messages_user', 0)}\n\n"
+        f"Коэффициент конверсии: {round(subscribers/max(1, series['users_total'])*100, 1)}%\n\n"
+        f"<b>Динамика (UTC):</b>\n"
+        f"{_trend_line('🆕 Новые пользователи', values('new_users'))}\n"
+        f"{_trend_line('🙋 Активные пользователи', values('active_users'))}\n"
+        f"{_trend_line('💬 Сообщения пользователей', values('messages_user'))}\n"
+        f"{_trend_line('🤖 Ответы бота', values('messages_assistant'))}\n"
+        f"{_trend_line('💳 Новые подписки', values('subscriptions_new'))}\n"
+        f"{_trend_line('⌛ Истекшие подписки', values('subscriptions_expired'))}\n"
+        f"{_trend_line('🖼 Изображения', values('images_generated'))}\n\n"
+        f"🗂 Реестр подписок: {registry_stats['active']} активных, "
+        f"проверок с подпиской {registry_stats['found']}, без подписки {registry_stats['not_found']}"
     )
     
+    moderation_stats = moderation_cache.stats()
+    stats_text += (
+        f"\n🛡 Кеш модерации: {moderation_stats['size']} записей, "
+        f"попаданий {moderation_stats['hits']}, промахов {moderation_stats['misses']}"
+    )
+    # Маршрутизация по задержке: как часто основная модель не успевала и кто отвечал быстрее
+    for tier, routing in routing_stats.snapshot().items():
+        stats_text += (
+            f"\n🔀 Запросы {tier}: {routing['requests']}, "
+            f"хеджировано {round(routing['hedge_rate']*100, 1)}%, "
+            f"запасная модель быстрее в {round(routing['fallback_win_rate']*100, 1)}%"
+        )
+    
     await message.answer(stats_text, parse_mode="HTML")
 
 @router.message(Command("add_subscription"))
@@ -198,7 +299,7 @@ async def add_subscription_cmd(message: Message):
             return
             
         expires_at = datetime.datetime.utcnow() + datetime.timedelta(days=days)
-        await add_subscription(user_id, expires_at)
+        await grant_subscription(user_id, expires_at)
         
         # Форматируем дату окончания подписки
         expires_formatted = expires_at.strftime("%d.%m.%Y %H:%M")
@@ -233,14 +334,11 @@ async def check_subscription_cmd(message: Message):
         
     try:
         user_id = int(parts[1])
-        from bot.services.payment_service import check_subscription
+        from bot.services.payment_service import get_subscription_expires_at
         
-        is_subscribed = await check_subscription(user_id)
-        if is_subscribed:
-            # Получаем информацию о подписке
-            from bot.database.crud import get_user_subscription
-            sub = await get_user_subscription(user_id)
-            expires_at = sub.expires_at.strftime("%d.%m.%Y %H:%M")
+        expires_at = await get_subscription_expires_at(user_id)
+        if expires_at:
+            expires_at = expires_at.strftime("%d.%m.%Y %H:%M")
             
             await message.answer(
                 f"✅ У пользователя {user_id} есть активная подписка\n"
@@ -275,8 +373,9 @@ async def clean_db_cmd(message: Message):
     
     await message.answer(
         f"⚠️ <b>Внимание!</b>\n\n"
-        f"Вы собираетесь удалить все сообщения старше {days} дней.\n"
-        f"Эта операция необратима. Подтвердите действие.",
+        f"Вы собираетесь {'перенести в архив' if ARCHIVE_MESSAGES else 'удалить'} все сообщения старше {days} дней.\n"
+        f"{'Архив можно посмотреть командой /archive ID.' if ARCHIVE_MESSAGES else 'Эта операция необратима.'} "
+        f"Подтвердите действие.",
         parse_mode="HTML",
         reply_markup=keyboard
     )
@@ -288,21 +387,79 @@ async def clean_confirm(callback_query):
         return
     
     days = int(callback_query.data.split("_")[2])
+    action, done = ("Перенос в архив", "Перенесено") if ARCHIVE_MESSAGES else ("Удаление", "Удалено")
     
     # Показываем статус
     status_message = await callback_query.message.edit_text(
-        "🔄 Удаление старых сообщений...",
+        f"🔄 {action} старых сообщений...",
         reply_markup=None
     )
     
-    # Удаляем старые сообщения
-    deleted_count = await delete_old_messages(days)
+    await callback_query.answer()
+    
+    last_update = 0.0
+    
+    async def show_progress(policy, deleted):
+        # Telegram не любит частые правки одного сообщения — обновляем не чаще раза в 2 секунды
+        nonlocal last_update
+        if time.monotonic() - last_update < 2:
+            return
+        last_update = time.monotonic()
+        try:
+            await status_message.edit_text(f"🔄 {action} старых сообщений...\n{done}: {deleted}")
+        except Exception as e:
+            logger.debug(f"Could not update clean_db status: {e}")
+    
+    # Удаляем старые сообщения порциями и возвращаем место файлу базы
+    results = await run_retention([messages_policy(days)], show_progress)
     
     await status_message.edit_text(
         f"✅ Очистка завершена.\n"
-        f"Удалено {deleted_count} сообщений старше {days} дней."
+        f"{'Перенесено в архив' if ARCHIVE_MESSAGES else 'Удалено'} {results.get('messages', 0)} сообщений старше {days} дней."
     )
 
+@router.message(Command("vacuum"))
+@admin_only
+async def vacuum_cmd(message: Message):
+    mode = await get_auto_vacuum_mode()
+    if mode is None:
+        await message.answer("Команда нужна только для SQLite.")
+        return
+    if mode == 2:
+        await message.answer("✅ База уже возвращает место после очистки, VACUUM не нужен.")
+        return
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Подтвердить", callback_data="vacuum_confirm")],
+        [InlineKeyboardButton(text="❌ Отменить", callback_data="clean_cancel")]
+    ])
+    await message.answer(
+        "⚠️ <b>Внимание!</b>\n\n"
+        "База создана без возврата места после очистки. Чтобы включить его, нужен один полный VACUUM: "
+        "он переписывает весь файл базы, и всё это время бот не сможет сохранять сообщения. "
+        "Запускайте в часы минимальной нагрузки.",
+        parse_mode="HTML",
+        reply_markup=keyboard
+    )
+
+@router.callback_query(lambda c: c.data == "vacuum_confirm")
+async def vacuum_confirm(callback_query):
+    if callback_query.from_user.id not in ADMIN_IDS:
+        await callback_query.answer("Доступ запрещён.")
+        return
+    
+    status_message = await callback_query.message.edit_text("🔄 Выполняется VACUUM...", reply_markup=None)
+    await callback_query.answer()
+    
+    started = time.monotonic()
+    try:
+        await convert_to_incremental_vacuum()
+    except Exception as e:
+        logger.error(f"VACUUM failed: {e}")
+        await status_message.edit_text(f"❌ Ошибка VACUUM: {e}")
+        return
+    await status_message.edit_text(f"✅ VACUUM завершён за {time.monotonic() - started:.0f} с. Место теперь возвращается после каждой очистки.")
+
 @router.callback_query(lambda c: c.data == "clean_cancel")
 async def clean_cancel(callback_query):
     if callback_query.from_user.id not in ADMIN_IDS:
@@ -310,4 +467,37 @@ async def clean_cancel(callback_query):
         return
     
     await callback_query.message.edit_text("❌ Операция отменена.", reply_markup=None)
-    await callback_query.answer() 
\ No newline at end of file
+    await callback_query.answer()
+
+@router.message(Command("archive"))
+@admin_only
+async def archive_cmd(message: Message):
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Использование: /archive USER_ID")
+        return
+    user_id = int(parts[1])
+    
+    # Архив читается поблочно, в файл попадают только сообщения этого пользователя
+    lines = []
+    async for row in iter_archived_messages(user_id):
+        lines.append(f"[{row['created_at'].strftime('%d.%m.%Y %H:%M')}] {row['role']}: {row['content']}")
+    if not lines:
+        await message.answer(f"В архиве нет сообщений пользователя {user_id}.")
+        return
+    
+    await message.answer_document(
+        BufferedInputFile("\n".join(lines).encode("utf-8"), filename=f"archive_{user_id}.txt"),
+        caption=f"🗄 Архив пользователя {user_id}: {len(lines)} сообщений"
+    )
+
+@router.message(Command("restore"))
+@admin_only
+async def restore_cmd(message: Message):
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Использование: /restore USER_ID")
+        return
+    
+    restored = await restore_user_messages(int(parts[1]))
+    await message.answer(f"✅ Восстановлено сообщений: {restored}")
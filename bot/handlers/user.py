@@ -1,11 +1,22 @@
 from aiogram import Router, F
 from aiogram.types import Message, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import CommandStart, Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.markdown import hbold
-from bot.services.openai_service import ask_gpt, generate_image, is_prompt_safe
-from bot.services.memory_service import save_message, get_short_memory, save_summary, get_last_summary
+from bot.services.openai_service import (
+    ask_gpt, ask_gpt_stream, generate_image, chat_error_reply, ChatFailedError, QueueFullError,
+    PRIORITY_PREMIUM, PRIORITY_FREE
+)
+from bot.services.moderation_service import is_prompt_safe
+from bot.services.memory_service import save_message, get_user_context, get_last_summary
 from bot.services.payment_service import check_subscription, get_user_limits, generate_payment_link
-from bot.config import FREE_USER_LIMIT
+from bot.services.quota_service import record_usage
+from bot.services.stream_service import StreamingReply
+from bot.services.summary_service import schedule_summary
+from bot.services.inbox_service import UserInbox
+from bot.services.metrics_service import stage_seconds, registry
+from bot.config import FREE_USER_LIMIT, STREAM_REPLIES, MODERATE_CHAT_MESSAGES, INBOX_DEBOUNCE_MS, INBOX_MAX_BURST
 import asyncio
 import datetime
 from loguru import logger
@@ -28,8 +39,9 @@ subscribe_button = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-# Состояние для генерации изображений
-image_generation_state = {}
+class ImageGeneration(StatesGroup):
+    """Ожидание описания изображения после /image"""
+    waiting_prompt = State()
 
 @router.message(CommandStart())
 async def cmd_start(message: Message):
@@ -79,7 +91,7 @@ async def cmd_limit(message: Message):
         await message.answer("У тебя активна подписка! Ты можешь отправлять неограниченное количество сообщений 🎉")
         return
         
-    used, limit = await get_user_limits(user_id)
+    used, limit = await get_user_limits(user_id, is_premium=False)
     remaining = max(0, limit - used)
     
     await message.answer(
@@ -126,7 +138,7 @@ async def cmd_subscribe(message: Message):
 
 @router.message(Command("image"))
 @router.message(F.text == "🖼 Создать изображение")
-async def cmd_image(message: Message):
+async def cmd_image(message: Message, state: FSMContext):
     """Обрабатывает запрос на генерацию изображения"""
     user_id = message.from_user.id
     
@@ -140,7 +152,7 @@ async def cmd_image(message: Message):
         return
     
     # Устанавливаем состояние ожидания промпта для изображения
-    image_generation_state[user_id] = True
+    await state.set_state(ImageGeneration.waiting_prompt)
     
     await message.answer(
         "Опиши изображение, которое хочешь создать. Будь максимально конкретным.\n\n"
@@ -148,6 +160,48 @@ async def cmd_image(message: Message):
         reply_markup=main_keyboard
     )
 
+@router.message(ImageGeneration.waiting_prompt, F.text)
+async def handle_image_prompt(message: Message, state: FSMContext):
+    """Генерирует изображение по описанию, присланному после /image"""
+    user_id = message.from_user.id
+    # Состояние сбрасываем сразу: следующее сообщение снова пойдёт в диалог
+    await state.clear()
+    
+    # Проверяем промпт на безопасность
+    priority = PRIORITY_PREMIUM if await check_subscription(user_id) else PRIORITY_FREE
+    try:
+        is_safe = await is_prompt_safe(message.text, priority)
+    except QueueFullError as e:
+        await message.answer(chat_error_reply(user_id, e), reply_markup=main_keyboard)
+        return
+    if not is_safe:
+        await message.answer(
+            "Извини, но этот запрос нарушает правила безопасности. "
+            "Пожалуйста, попробуй другой запрос без неприемлемого содержания.",
+            reply_markup=main_keyboard
+        )
+        return
+
+    # Отправляем сообщение о начале генерации
+    await message.answer("Генерирую изображение, это может занять до 30 секунд...")
+
+    # Показываем, что бот печатает
+    await message.bot.send_chat_action(chat_id=user_id, action="upload_photo")
+
+    # Генерируем изображение
+    success, result = await generate_image(user_id, message.text)
+
+    if success:
+        # Отправляем изображение
+        await message.answer_photo(
+            result,
+            caption=f"Изображение по запросу: {message.text}",
+            reply_markup=main_keyboard
+        )
+    else:
+        # Отправляем сообщение об ошибке
+        await message.answer(f"Не удалось создать изображение: {result}", reply_markup=main_keyboard)
+
 @router.message()
 async def handle_message(message: Message):
     user_id = message.from_user.id
@@ -157,47 +211,29 @@ async def handle_message(message: Message):
         await message.answer("Я понимаю только текстовые сообщения. Пожалуйста, напиши текст.", reply_markup=main_keyboard)
         return
     
-    # Проверяем, ожидаем ли мы промпт для генерации изображения
-    if user_id in image_generation_state and image_generation_state[user_id]:
-        # Удаляем состояние
-        image_generation_state.pop(user_id)
-        
-        # Проверяем промпт на безопасность
-        is_safe = await is_prompt_safe(message.text)
-        if not is_safe:
-            await message.answer(
-                "Извини, но этот запрос нарушает правила безопасности. "
-                "Пожалуйста, попробуй другой запрос без неприемлемого содержания.",
-                reply_markup=main_keyboard
-            )
-            return
-        
-        # Отправляем сообщение о начале генерации
-        await message.answer("Генерирую изображение, это может занять до 30 секунд...")
-        
-        # Показываем, что бот печатает
-        await message.bot.send_chat_action(chat_id=user_id, action="upload_photo")
-        
-        # Генерируем изображение
-        success, result = await generate_image(user_id, message.text)
-        
-        if success:
-            # Отправляем изображение
-            await message.answer_photo(
-                result,
-                caption=f"Изображение по запросу: {message.text}",
-                reply_markup=main_keyboard
-            )
-        else:
-            # Отправляем сообщение об ошибке
-            await message.answer(f"Не удалось создать изображение: {result}", reply_markup=main_keyboard)
-        
-        return
+    # Обычные сообщения обрабатываются очередью пользователя: по одному ходу за раз,
+    # серия сообщений подряд получает один ответ
+    inbox.submit(user_id, message)
+
+async def answer_turn(user_id, messages):
+    """
+    Отвечает на один ход диалога — одно сообщение или серию сообщений подряд
+
+    Args:
+        user_id: ID пользователя
+        messages: Сообщения хода в порядке поступления
+    """
+    # Отвечаем на последнее сообщение серии, а модели передаём весь текст хода
+    message = messages[-1]
+    text = "\n".join(m.text for m in messages)
+    
+    # Загружаем подписку, лимиты и контекст диалога
+    with stage_seconds.time('context'):
+        context = await get_user_context(user_id)
     
     # Проверяем подписку и лимиты для обычных сообщений
-    if not await check_subscription(user_id):
-        used, limit = await get_user_limits(user_id)
-        if used >= limit:
+    if not context.is_premium:
+        if context.used >= FREE_USER_LIMIT:
             await message.answer(
                 "Подожди немного… Ты исчерпал лимит на сегодня.\n\n"
                 "Оформи подписку, чтобы продолжить общение без ограничений!", 
@@ -205,43 +241,81 @@ async def handle_message(message: Message):
             )
             return
     
+    # Проверка обычных сообщений идёт через общий пакетный запрос и кеш модерации
+    safe = True
+    if MODERATE_CHAT_MESSAGES:
+        priority = PRIORITY_PREMIUM if context.is_premium else PRIORITY_FREE
+        try:
+            with stage_seconds.time('moderation'):
+                safe = await is_prompt_safe(text, priority)
+        except QueueFullError as e:
+            await message.answer(chat_error_reply(user_id, e), reply_markup=main_keyboard)
+            return
+    if not safe:
+        await message.answer(
+            "Извини, но это сообщение нарушает правила безопасности. "
+            "Пожалуйста, переформулируй его.",
+            reply_markup=main_keyboard
+        )
+        return
+    
     # Сохраняем сообщение пользователя
-    await save_message(user_id, 'user', message.text)
+    with stage_seconds.time('save_message'):
+        await save_message(user_id, 'user', text)
     
-    # Получаем контекст
-    short_mem = await get_short_memory(user_id)
-    summary = await get_last_summary(user_id)
+    # Контекст загружен до сохранения, поэтому текущее сообщение не дублируется в истории
+    short_mem = context.messages
+    summary = context.summary
     
     # Имитация набора текста
-    await message.bot.send_chat_action(chat_id=user_id, action="typing")
+    with stage_seconds.time('chat_action'):
+        await message.bot.send_chat_action(chat_id=user_id, action="typing")
+    
+    if not STREAM_REPLIES:
+        # Расчет времени "обдумывания" в зависимости от длины сообщения
+        thinking_time = min(1.5, 0.5 + len(text) / 500)
+        await asyncio.sleep(thinking_time)
     
-    # Расчет времени "обдумывания" в зависимости от длины сообщения
-    thinking_time = min(1.5, 0.5 + len(message.text) / 500)
-    await asyncio.sleep(thinking_time)
+    async def notify_queue_position(position):
+        await message.answer(f"⏳ Сейчас много запросов, ты {position}-й в очереди. Отвечу, как только освободится место.")
     
     # Получаем ответ от GPT
     try:
-        reply = await ask_gpt(user_id, message.text, short_mem, summary)
+        if STREAM_REPLIES:
+            # Показываем ответ по мере генерации, в БД сохраняем только итоговый текст
+            stream = StreamingReply(message, reply_markup=main_keyboard)
+            # Генерация и правки сообщения в Telegram идут вперемешку, поэтому это один этап
+            with stage_seconds.time('reply_stream'):
+                async for delta in ask_gpt_stream(user_id, text, short_mem, summary, context, notify_queue_position):
+                    await stream.feed(delta)
+                reply = await stream.finish()
+        else:
+            with stage_seconds.time('openai_reply'):
+                reply = await ask_gpt(user_id, text, short_mem, summary, context, notify_queue_position)
+            
+            # Отправляем ответ
+            with stage_seconds.time('telegram_send'):
+                await message.answer(reply, reply_markup=main_keyboard)
+    except ChatFailedError as e:
+        # Запрос отклонён или не удался: ход не засчитывается в лимит, а текст ошибки не попадает в историю
+        await message.answer(e.reply, reply_markup=main_keyboard)
+        return
+    except Exception as e:
+        await message.answer("Извини, произошла ошибка. Попробуй еще раз через минуту.", reply_markup=main_keyboard)
+        logger.error(f"Error in message handler: {e}")
+        return
+    
+    # В лимит засчитывается только полученный ответ и ход целиком, а не каждое сообщение серии
+    with stage_seconds.time('save_reply'):
+        if not context.is_premium:
+            await record_usage(user_id)
         
         # Сохраняем ответ ассистента
         await save_message(user_id, 'assistant', reply)
-        
-        # Отправляем ответ
-        await message.answer(reply, reply_markup=main_keyboard)
-        
-        # Создаем summary после каждых 10 сообщений
-        messages_count = len(short_mem)
-        if messages_count % 10 == 0 and messages_count > 0:
-            try:
-                # Создаем summary на основе последних сообщений
-                summary_prompt = f"Создай краткое резюме этого диалога в 1-2 предложениях:\n"
-                for msg in short_mem:
-                    summary_prompt += f"{msg['role']}: {msg['content']}\n"
-                
-                summary_text = await ask_gpt(user_id, summary_prompt, [], None)
-                await save_summary(user_id, summary_text)
-            except Exception as e:
-                logger.error(f"Error creating summary: {e}")
-    except Exception as e:
-        await message.answer("Извини, произошла ошибка. Попробуй еще раз через минуту.", reply_markup=main_keyboard)
-        logger.error(f"Error in message handler: {e}") 
\ No newline at end of file
+    
+    # Резюме обновляется в фоне и не задерживает ответ
+    schedule_summary(user_id)
+
+inbox = UserInbox(answer_turn, INBOX_DEBOUNCE_MS / 1000, INBOX_MAX_BURST)
+registry.gauge('bot_inbox_pending_messages', "Сообщений в очередях пользователей", lambda: inbox.pending)
+registry.gauge('bot_inbox_active_users', "Пользователей, которым сейчас готовится ответ", lambda: inbox.active)
@@ -1,14 +1,24 @@
 import asyncio
 import os
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from bot.config import BOT_TOKEN, NOTIFY_BEFORE_EXPIRATION
+from bot.config import (
+    BOT_TOKEN, BOT_MODE, BOT_WORKERS, NOTIFY_SCHEDULE, RETENTION_SCHEDULE, FSM_CLEANUP_SCHEDULE, SCHEDULER_JITTER
+)
 from bot.handlers import user, admin
 from bot.database import models
-from bot.services.memory_service import set_system_prompt
-from bot.database.crud import get_expiring_subscriptions
+from bot.services.memory_service import set_system_prompt, get_system_prompt, stop_journal
+from bot.services.payment_service import load_subscriptions
+from bot.services.context_service import load_tokenizer
+from bot.services.broadcast_service import resume_campaigns, watch_campaigns
+from bot.services.stats_service import load_stats, stop_stats
+from bot.services.retention_service import run_retention
+from bot.services.notification_service import send_expiry_notices
+from bot.services.scheduler_service import Job, job_scheduler
+from bot.services.webhook_service import run_webhook
+from bot.services.fsm_storage import SQLiteStorage, create_storage
+from bot.services.metrics_service import instrument_dispatcher, start_metrics_server, stop_metrics_server
+from bot.workers import WorkerPool
 from loguru import logger
-import datetime
 
 # Настройка логирования
 logger.add("bot.log", rotation="10 MB", level="INFO")
@@ -20,58 +30,39 @@ async def load_default_prompt():
         if os.path.exists(prompt_path):
             with open(prompt_path, "r", encoding="utf-8") as file:
                 prompt = file.read().strip()
-                if prompt:
+                # Заодно прогреваем кэш промпта; новую версию пишем только если текст изменился
+                if prompt and prompt != await get_system_prompt():
                     await set_system_prompt(prompt)
                     logger.info("Default system prompt loaded")
+        else:
+            await get_system_prompt()
     except Exception as e:
         logger.error(f"Error loading default prompt: {e}")
 
-async def check_expiring_subscriptions(bot):
-    """
-    Проверяет подписки, которые скоро истекут, и отправляет уведомления пользователям
-    """
-    try:
-        # Получаем подписки, которые истекают в ближайшие дни
-        expiring_subs = await get_expiring_subscriptions(NOTIFY_BEFORE_EXPIRATION)
-        
-        for sub in expiring_subs:
-            # Форматируем дату окончания подписки
-            expires_at = sub.expires_at.strftime("%d.%m.%Y")
-            
-            # Отправляем уведомление
-            try:
-                await bot.send_message(
-                    sub.user_id,
-                    f"⚠️ <b>Внимание!</b>\n\n"
-                    f"Твоя подписка истекает {expires_at}.\n"
-                    f"Чтобы продолжить пользоваться всеми преимуществами, "
-                    f"не забудь продлить подписку командой /subscribe.",
-                    parse_mode="HTML"
-                )
-                logger.info(f"Sent expiration notification to user {sub.user_id}")
-            except Exception as e:
-                logger.error(f"Failed to send expiration notification to user {sub.user_id}: {e}")
-    except Exception as e:
-        logger.error(f"Error checking expiring subscriptions: {e}")
+def create_dispatcher():
+    """Создаёт диспетчер с обработчиками и хранилищем состояний"""
+    dp = Dispatcher(storage=create_storage())
+    dp.include_router(user.router)
+    dp.include_router(admin.router)
+    instrument_dispatcher(dp, [user.router, admin.router])
+    return dp
 
-async def scheduled_tasks(bot):
-    """Выполняет регулярные задачи по расписанию"""
-    while True:
-        try:
-            # Проверяем подписки раз в день в 10:00
-            now = datetime.datetime.now()
-            if now.hour == 10 and now.minute < 5:  # Выполняем между 10:00 и 10:05
-                await check_expiring_subscriptions(bot)
-                # Ждем час после выполнения, чтобы не запускать задачу повторно
-                await asyncio.sleep(3600)
-            else:
-                # Проверяем каждые 5 минут
-                await asyncio.sleep(300)
-        except Exception as e:
-            logger.error(f"Error in scheduled tasks: {e}")
-            await asyncio.sleep(300)
+def register_jobs(bot, storage):
+    """Регистрирует периодические задачи бота"""
+    job_scheduler.add(Job(
+        'expiry_notices', lambda: send_expiry_notices(bot), NOTIFY_SCHEDULE, timeout=1800, jitter=SCHEDULER_JITTER
+    ))
+    job_scheduler.add(Job(
+        'retention', run_retention, RETENTION_SCHEDULE, timeout=6 * 3600, jitter=SCHEDULER_JITTER
+    ))
+    if isinstance(storage, SQLiteStorage):
+        job_scheduler.add(Job(
+            'fsm_cleanup', storage.evict_expired, FSM_CLEANUP_SCHEDULE, timeout=600, jitter=SCHEDULER_JITTER
+        ))
 
 async def main():
+    pool = None
+    campaign_watcher = None
     try:
         # Инициализация базы данных
         logger.info("Initializing database...")
@@ -80,22 +71,54 @@ async def main():
         # Загрузка системного промпта
         await load_default_prompt()
         
+        # Загрузка реестра подписок и счётчиков статистики
+        await load_subscriptions()
+        await load_stats()
+        
+        # Загрузка токенизатора для подсчёта токенов контекста
+        load_tokenizer()
+        
+        await start_metrics_server()
+        
         # Запуск бота
         logger.info("Starting bot...")
         bot = Bot(token=BOT_TOKEN)
-        dp = Dispatcher(storage=MemoryStorage())
-        dp.include_router(user.router)
-        dp.include_router(admin.router)
+        dp = create_dispatcher()
+        if BOT_WORKERS > 1:
+            # Этот процесс только принимает обновления, обрабатывают их рабочие процессы
+            pool = WorkerPool(BOT_WORKERS)
+            pool.start()
+            dp.update.outer_middleware(pool.forward)
         
-        # Запускаем фоновые задачи
-        asyncio.create_task(scheduled_tasks(bot))
+        # Запускаем задачи по расписанию и продолжаем прерванные рассылки
+        register_jobs(bot, dp.storage)
+        await job_scheduler.start()
+        await resume_campaigns(bot)
+        if pool is not None:
+            # Рассылки, запущенные админом в рабочем процессе, отправляются отсюда
+            campaign_watcher = asyncio.create_task(watch_campaigns(bot))
         
-        # Запуск поллинга
-        logger.info("Bot started")
-        await dp.start_polling(bot)
+        # Запуск поллинга или вебхука
+        logger.info(f"Bot started in {BOT_MODE} mode")
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Error starting bot: {e}")
         raise
+    finally:
+        if campaign_watcher is not None:
+            campaign_watcher.cancel()
+        await job_scheduler.stop()
+        if pool is not None:
+            await pool.stop()
+        # Дожидаемся ответов на уже принятые сообщения и сбрасываем в БД всё, что не записал журнал
+        await user.inbox.drain()
+        await stop_journal()
+        await stop_stats()
+        await stop_metrics_server()
 
 if __name__ == '__main__':
     asyncio.run(main()) 
\ No newline at end of file
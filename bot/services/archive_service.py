@@ -0,0 +1,148 @@
+"""
+Холодный архив сообщений
+
+Сообщения, вышедшие из окна хранения, переносятся в файлы ARCHIVE_DIR/messages-YYYY-MM.jsonl.gz
+(месяц — по created_at). Файл только дополняется: каждая порция записывается отдельным
+gzip-блоком, а файлы вместе образуют корректный gzip-поток. Рядом лежит индекс
+messages-YYYY-MM.idx.jsonl: по строке на блок со смещением, длиной и списком user_id,
+поэтому история одного пользователя читается без распаковки всего архива.
+"""
+from bot.database.crud import get_old_messages_chunk_db, delete_messages_by_ids_db, insert_messages_keep_ids_db
+from bot.config import ARCHIVE_DIR
+import asyncio
+import datetime
+import glob
+import gzip
+import json
+import os
+from loguru import logger
+
+# Сколько восстановленных сообщений вставлять одной транзакцией
+RESTORE_BATCH_SIZE = 500
+
+def _paths(period):
+    base = os.path.join(ARCHIVE_DIR, f"messages-{period}")
+    return f"{base}.jsonl.gz", f"{base}.idx.jsonl"
+
+def _append_block(period, rows):
+    """Дописывает порцию строк одним gzip-блоком и добавляет запись в индекс"""
+    segment_path, index_path = _paths(period)
+    lines = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+    block = gzip.compress(lines.encode('utf-8'))
+    with open(segment_path, 'ab') as segment:
+        offset = segment.tell()
+        segment.write(block)
+        segment.flush()
+        os.fsync(segment.fileno())
+    entry = {
+        'offset': offset,
+        'length': len(block),
+        'count': len(rows),
+        'first_id': rows[0]['id'],
+        'last_id': rows[-1]['id'],
+        'users': sorted({row['user_id'] for row in rows}),
+    }
+    # Индекс пишется после блока: при сбое между ними блок просто не будет найден
+    with open(index_path, 'a', encoding='utf-8') as index:
+        index.write(json.dumps(entry) + "\n")
+        index.flush()
+        os.fsync(index.fileno())
+
+def _write_archive(rows):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    periods = {}
+    for row in rows:
+        created_at = row['created_at']
+        periods.setdefault(created_at.strftime('%Y-%m'), []).append(
+            dict(row, created_at=created_at.isoformat())
+        )
+    for period, period_rows in periods.items():
+        _append_block(period, period_rows)
+
+async def archive_old_messages_chunk(cutoff, limit):
+    """
+    Переносит порцию сообщений старше cutoff в архив и удаляет их из таблицы
+
+    Строки удаляются только после того, как архив записан на диск. Если бот
+    остановится между записью и удалением, порция попадёт в архив повторно;
+    при чтении повторы отбрасываются (см. _message_key).
+
+    Returns:
+        int: Сколько сообщений перенесено
+    """
+    rows = await get_old_messages_chunk_db(cutoff, limit)
+    if not rows:
+        return 0
+    await asyncio.to_thread(_write_archive, rows)
+    return await delete_messages_by_ids_db([row['id'] for row in rows])
+
+def _message_key(row):
+    """
+    Ключ, по которому отбрасываются повторы в архиве
+
+    Одного id мало: SQLite после очистки таблицы снова выдаёт id с 1, и в архиве
+    оказываются разные сообщения с одинаковым id.
+    """
+    return row['id'], row['user_id'], row['created_at']
+
+def _user_blocks(user_id):
+    """Список (путь к файлу, смещение, длина) блоков, где есть сообщения пользователя"""
+    blocks = []
+    for index_path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, "messages-*.idx.jsonl"))):
+        segment_path = index_path[:-len(".idx.jsonl")] + ".jsonl.gz"
+        with open(index_path, encoding='utf-8') as index:
+            for line in index:
+                entry = json.loads(line)
+                if user_id in entry['users']:
+                    blocks.append((segment_path, entry['offset'], entry['length']))
+    return blocks
+
+def _read_block(path, offset, length, user_id):
+    with open(path, 'rb') as segment:
+        segment.seek(offset)
+        data = gzip.decompress(segment.read(length))
+    rows = []
+    for line in data.decode('utf-8').splitlines():
+        row = json.loads(line)
+        if row['user_id'] == user_id:
+            row['created_at'] = datetime.datetime.fromisoformat(row['created_at'])
+            rows.append(row)
+    return rows
+
+async def iter_archived_messages(user_id):
+    """
+    Читает архивную историю пользователя по одному блоку за раз
+
+    Yields:
+        dict: Сообщение с полями id, user_id, role, content, token_count, created_at
+            (в порядке архивации, без повторов)
+    """
+    seen = set()
+    for path, offset, length in await asyncio.to_thread(_user_blocks, user_id):
+        for row in await asyncio.to_thread(_read_block, path, offset, length, user_id):
+            key = _message_key(row)
+            if key not in seen:
+                seen.add(key)
+                yield row
+
+async def restore_user_messages(user_id):
+    """
+    Возвращает архивные сообщения пользователя в таблицу messages
+
+    Сообщения остаются и в архиве; при следующей очистке они снова уйдут туда
+    (повтор будет отброшен при чтении). Сообщение, чей id уже занят другим
+    сообщением, получает новый id.
+
+    Returns:
+        int: Сколько сообщений восстановлено
+    """
+    restored = 0
+    batch = []
+    async for row in iter_archived_messages(user_id):
+        batch.append(row)
+        if len(batch) >= RESTORE_BATCH_SIZE:
+            restored += await insert_messages_keep_ids_db(batch)
+            batch = []
+    restored += await insert_messages_keep_ids_db(batch)
+    logger.info(f"Restored {restored} archived messages of user {user_id}")
+    return restored
@@ -0,0 +1,150 @@
+from bot.database.crud import get_campaign, get_running_campaigns, get_user_ids_after, mark_users_blocked, update_campaign
+from bot.services.rate_limiter import TokenBucket
+from bot.services.metrics_service import registry, start_background_task
+from bot.config import BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_CHUNK_SIZE, BROADCAST_POLL_INTERVAL
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest
+import asyncio
+import datetime
+from loguru import logger
+
+# Общий лимит Telegram на исходящие массовые сообщения бота (около 30 в секунду)
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+# Сколько раз повторять отправку одному пользователю после RetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Запущенные рассылки: campaign_id -> задача
+_tasks = {}
+# Рассылает ли этот процесс сам. Рабочие процессы только отмечают рассылку в БД, а
+# отправляет её главный процесс: лимит broadcast_bucket действует внутри одного процесса
+run_campaigns = True
+registry.gauge('bot_broadcasts_running', "Выполняющихся рассылок", lambda: len(_tasks))
+
+async def send_rate_limited(bot, user_id, text, **kwargs):
+    """
+    Отправляет массовое сообщение (рассылку, уведомление) одному пользователю под общим лимитом
+
+    Args:
+        kwargs: Дополнительные параметры send_message (parse_mode и т.п.)
+
+    Returns:
+        str: 'sent', 'blocked' или 'failed'
+    """
+    for _ in range(MAX_RETRY_AFTER_ATTEMPTS):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(user_id, text, **kwargs)
+            return 'sent'
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать: притормаживаем всю рассылку, а не только этого пользователя
+            logger.warning(f"Broadcast flood limit, pausing for {e.retry_after}s")
+            broadcast_bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return 'blocked'
+        except TelegramBadRequest as e:
+            # Чат удалён или не найден — писать туда больше нет смысла
+            if 'chat not found' in str(e).lower():
+                return 'blocked'
+            logger.error(f"Error sending broadcast to {user_id}: {e}")
+            return 'failed'
+        except Exception as e:
+            logger.error(f"Error sending broadcast to {user_id}: {e}")
+            return 'failed'
+    return 'failed'
+
+async def _show_progress(bot, campaign, text):
+    if not campaign.status_chat_id or not campaign.status_message_id:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=campaign.status_chat_id, message_id=campaign.status_message_id)
+    except Exception as e:
+        logger.debug(f"Could not update broadcast status: {e}")
+
+async def _run_campaign(bot, campaign_id):
+    """
+    Рассылает кампанию порциями по BROADCAST_CHUNK_SIZE пользователей
+
+    Внутри порции сообщения отправляются параллельно под общим ограничителем
+    частоты. После каждой порции прогресс сохраняется в broadcast_campaigns,
+    поэтому после перезапуска рассылка продолжается со следующей порции
+    (сообщения прерванной порции могут уйти повторно).
+    """
+    campaign = await get_campaign(campaign_id)
+    if campaign is None or campaign.status != 'running':
+        return
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    sent, failed, blocked = campaign.sent, campaign.failed, campaign.blocked
+    last_user_id = campaign.last_user_id or 0
+    logger.info(f"Broadcast {campaign_id} running from user_id > {last_user_id}")
+
+    async def send(user_id):
+        async with semaphore:
+            return await send_rate_limited(bot, user_id, campaign.text)
+
+    while True:
+        user_ids = await get_user_ids_after(last_user_id, BROADCAST_CHUNK_SIZE)
+        if not user_ids:
+            break
+        results = await asyncio.gather(*(send(user_id) for user_id in user_ids))
+        blocked_ids = [user_id for user_id, result in zip(user_ids, results) if result == 'blocked']
+        sent += results.count('sent')
+        failed += results.count('failed')
+        blocked += len(blocked_ids)
+        last_user_id = user_ids[-1]
+        await mark_users_blocked(blocked_ids)
+
+        # Рассылку могли отменить, пока шла порция
+        current = await get_campaign(campaign_id)
+        if current is None or current.status != 'running':
+            logger.info(f"Broadcast {campaign_id} cancelled")
+            return
+        await update_campaign(campaign_id, last_user_id=last_user_id, sent=sent, failed=failed, blocked=blocked)
+        await _show_progress(
+            bot, campaign,
+            f"Отправка сообщений...\nДоставлено: {sent}\nНе доставлено: {failed}\nЗаблокировали бота: {blocked}"
+        )
+
+    await update_campaign(campaign_id, status='done', finished_at=datetime.datetime.utcnow())
+    logger.info(f"Broadcast {campaign_id} done: sent {sent}, failed {failed}, blocked {blocked}")
+    await _show_progress(
+        bot, campaign,
+        f"✅ Рассылка завершена.\nДоставлено: {sent}\nНе доставлено: {failed}\nЗаблокировали бота: {blocked}"
+    )
+
+async def _run_logged(bot, campaign_id):
+    try:
+        await _run_campaign(bot, campaign_id)
+    except Exception as e:
+        # Статус остаётся running: рассылка продолжится при следующем запуске бота
+        logger.error(f"Broadcast {campaign_id} stopped: {e}")
+    finally:
+        _tasks.pop(campaign_id, None)
+
+def start_campaign(bot, campaign_id):
+    """
+    Запускает рассылку в фоне, если она ещё не запущена
+
+    В рабочем процессе ничего не делает: рассылку со статусом running подхватит
+    watch_campaigns главного процесса.
+
+    Returns:
+        bool: Запущена ли рассылка этим вызовом
+    """
+    if not run_campaigns or campaign_id in _tasks:
+        return False
+    _tasks[campaign_id] = start_background_task(_run_logged(bot, campaign_id))
+    return True
+
+async def resume_campaigns(bot):
+    """Продолжает рассылки со статусом running: прерванные остановкой бота или запущенные другим процессом"""
+    for campaign in await get_running_campaigns():
+        if start_campaign(bot, campaign.id):
+            logger.info(f"Resuming broadcast {campaign.id}")
+
+async def watch_campaigns(bot, interval=BROADCAST_POLL_INTERVAL):
+    """Периодически запускает рассылки, отмеченные в БД рабочими процессами"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await resume_campaigns(bot)
+        except Exception as e:
+            logger.error(f"Failed to check broadcasts: {e}")
@@ -0,0 +1,106 @@
+from bot.config import (
+    DEFAULT_MODEL, PREMIUM_MODEL, CONTEXT_TOKEN_BUDGET_DEFAULT, CONTEXT_TOKEN_BUDGET_PREMIUM, TOKENIZER_ENCODING
+)
+from functools import lru_cache
+from loguru import logger
+
+# Служебные токены, которые API добавляет к каждому сообщению (роль и разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Остаток бюджета, меньше которого обрезать сообщение уже нет смысла
+MIN_TRUNCATED_TOKENS = 32
+# Приблизительное число символов на токен, если токенизатор недоступен
+CHARS_PER_TOKEN = 3
+
+_encoding = None
+_encoding_loaded = False
+
+def load_tokenizer():
+    """Загружает токенизатор заранее, чтобы первая загрузка словаря не пришлась на обработку сообщения"""
+    _get_encoding()
+
+def _get_encoding():
+    """Загружает токенизатор tiktoken один раз; при ошибке используется оценка по длине"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            logger.warning(f"Tokenizer {TOKENIZER_ENCODING} unavailable, using length estimate: {e}")
+    return _encoding
+
+@lru_cache(maxsize=1024)
+def count_tokens(text):
+    """
+    Считает токены в тексте локально, без обращения к API
+
+    Результат кэшируется: системный промпт, резюме и только что сохранённое
+    сообщение пользователя при сборке контекста повторно не токенизируются.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens):
+    """Оставляет начало текста длиной не больше max_tokens токенов"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def get_token_budget(model):
+    """Возвращает бюджет токенов на контекст для модели"""
+    if model == PREMIUM_MODEL:
+        return CONTEXT_TOKEN_BUDGET_PREMIUM
+    if model == DEFAULT_MODEL:
+        return CONTEXT_TOKEN_BUDGET_DEFAULT
+    return min(CONTEXT_TOKEN_BUDGET_DEFAULT, CONTEXT_TOKEN_BUDGET_PREMIUM)
+
+def build_context(model, system_prompt, summary, history, user_message):
+    """
+    Собирает список сообщений для запроса в пределах бюджета токенов модели
+
+    Системный промпт, резюме и новое сообщение входят всегда. История добавляется
+    от новых сообщений к старым, пока хватает бюджета; сообщение, которое не
+    помещается целиком, обрезается, а более старые отбрасываются. Для сообщений
+    истории используется сохранённое количество токенов (ключ "tokens"), поэтому
+    повторно токенизируются только обрезаемое сообщение и строки без подсчёта.
+
+    Args:
+        model: Модель, для которой собирается запрос
+        system_prompt: Системный промпт или None
+        summary: Резюме предыдущих диалогов или None
+        history: Последние сообщения — словари с ключами role, content и, по возможности, tokens
+        user_message: Текст нового сообщения пользователя
+
+    Returns:
+        list: Сообщения для chat.completions
+    """
+    head = []
+    if system_prompt:
+        head.append({"role": "system", "content": system_prompt})
+    if summary:
+        head.append({"role": "system", "content": f"Summary: {summary}"})
+    remaining = get_token_budget(model) - count_tokens(user_message) - MESSAGE_OVERHEAD_TOKENS
+    remaining -= sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in head)
+
+    selected = []
+    for message in reversed(history):
+        tokens = message.get("tokens")
+        if tokens is None:
+            tokens = count_tokens(message["content"])
+        cost = tokens + MESSAGE_OVERHEAD_TOKENS
+        if cost <= remaining:
+            selected.append({"role": message["role"], "content": message["content"]})
+            remaining -= cost
+            continue
+        if remaining - MESSAGE_OVERHEAD_TOKENS >= MIN_TRUNCATED_TOKENS:
+            content = truncate_to_tokens(message["content"], remaining - MESSAGE_OVERHEAD_TOKENS)
+            selected.append({"role": message["role"], "content": content})
+        break
+
+    return head + list(reversed(selected)) + [{"role": "user", "content": user_message}]
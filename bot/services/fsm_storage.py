@@ -0,0 +1,104 @@
+from bot.database.crud import get_fsm_record_db, get_fsm_keys_db, save_fsm_field_db, delete_expired_fsm_states_chunk
+from bot.config import FSM_STORAGE, FSM_STATE_TTL, RETENTION_CHUNK_SIZE, RETENTION_CHUNK_PAUSE, WORKER_CACHE_REFRESH
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+import asyncio
+import datetime
+import json
+import time
+from loguru import logger
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_states
+
+    Общее для всех рабочих процессов и переживает перезапуск бота. Состояние,
+    которое не обновлялось ttl секунд, считается сброшенным (брошенный на
+    полпути диалог), а сами строки удаляет evict_expired по расписанию.
+
+    aiogram читает состояние на каждое обновление, а оно почти у всех пустое.
+    Поэтому в памяти хранится список ключей, у которых есть запись: для
+    остальных состояние читается без запроса к БД. Список пополняется при
+    записи и целиком перечитывается раз в refresh секунд, чтобы увидеть
+    состояния, записанные другими процессами или экземплярами бота.
+    """
+
+    def __init__(self, ttl, key_builder=None, refresh=WORKER_CACHE_REFRESH):
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.refresh = refresh
+        self._keys = set()
+        self._written = set()
+        self._keys_expire_at = 0.0
+
+    def _fresh_since(self):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+
+    async def _known(self, key):
+        """Есть ли у ключа запись в таблице (по списку ключей в памяти)"""
+        if time.monotonic() >= self._keys_expire_at:
+            self._keys_expire_at = time.monotonic() + self.refresh
+            # Ключи, записанные, пока список читается, в него ещё могут не попасть
+            self._written = set()
+            loaded = set(await get_fsm_keys_db(self._fresh_since()))
+            self._keys = loaded | self._written
+        return key in self._keys
+
+    async def _get(self, key):
+        key = self.key_builder.build(key)
+        if not await self._known(key):
+            return None
+        record = await get_fsm_record_db(key, self._fresh_since())
+        if record is None:
+            # Состояние сброшено или истекло
+            self._keys.discard(key)
+        return record
+
+    async def _save(self, key, **values):
+        key = self.key_builder.build(key)
+        await save_fsm_field_db(key, **values)
+        self._keys.add(key)
+        self._written.add(key)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self._save(key, state=state)
+
+    async def get_state(self, key):
+        record = await self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise TypeError(f"Data must be a dict, got {type(data).__name__}")
+        await self._save(key, data=json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key):
+        record = await self._get(key)
+        if not record or not record.data:
+            return {}
+        return json.loads(record.data)
+
+    async def close(self):
+        pass
+
+    async def evict_expired(self):
+        """Удаляет истёкшие состояния порциями и возвращает их количество"""
+        total = 0
+        while True:
+            deleted = await delete_expired_fsm_states_chunk(self._fresh_since(), RETENTION_CHUNK_SIZE)
+            total += deleted
+            if deleted < RETENTION_CHUNK_SIZE:
+                break
+            await asyncio.sleep(RETENTION_CHUNK_PAUSE)
+        if total:
+            logger.info(f"Evicted {total} expired FSM states")
+        return total
+
+def create_storage():
+    """Создаёт хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == 'memory':
+        # Без TTL и только в памяти процесса: для тестов и запуска в один процесс
+        return MemoryStorage()
+    return SQLiteStorage(FSM_STATE_TTL)
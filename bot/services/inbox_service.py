@@ -0,0 +1,79 @@
+from bot.services.metrics_service import stage_seconds, count_queries
+import asyncio
+from loguru import logger
+
+class UserInbox:
+    """
+    Очередь входящих сообщений по пользователям
+
+    Сообщения одного пользователя обрабатываются строго по очереди: пока идёт
+    ответ, новые сообщения копятся и образуют следующий ход. Серия сообщений,
+    пришедших с паузами меньше debounce секунд, объединяется в один ход
+    (но не больше max_burst сообщений), и на неё даётся один ответ.
+    """
+
+    def __init__(self, handler, debounce, max_burst):
+        """
+        Args:
+            handler: Корутина-функция (user_id, messages), обрабатывающая один ход
+            debounce: Сколько ждать следующего сообщения серии, сек (0 — не ждать)
+            max_burst: Максимум сообщений в одном ходе
+        """
+        self.handler = handler
+        self.debounce = debounce
+        self.max_burst = max_burst
+        self._pending = {}
+        self._arrived = {}
+        self._workers = {}
+
+    def submit(self, user_id, message):
+        """Ставит сообщение в очередь пользователя и запускает обработчик, если он не запущен"""
+        self._pending.setdefault(user_id, []).append(message)
+        self._arrived.setdefault(user_id, asyncio.Event()).set()
+        worker = self._workers.get(user_id)
+        if worker is None or worker.done():
+            self._workers[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def _collect(self, user_id):
+        """Ждёт конца серии сообщений и забирает её"""
+        arrived = self._arrived[user_id]
+        while len(self._pending[user_id]) < self.max_burst:
+            arrived.clear()
+            try:
+                await asyncio.wait_for(arrived.wait(), self.debounce)
+            except asyncio.TimeoutError:
+                break
+        batch = self._pending.pop(user_id)
+        # Лишнее сверх max_burst уходит в следующий ход
+        if len(batch) > self.max_burst:
+            self._pending[user_id] = batch[self.max_burst:]
+            batch = batch[:self.max_burst]
+        return batch
+
+    async def _run(self, user_id):
+        try:
+            while self._pending.get(user_id):
+                batch = await self._collect(user_id)
+                try:
+                    with stage_seconds.time('turn'), count_queries('turn'):
+                        await self.handler(user_id, batch)
+                except Exception as e:
+                    logger.error(f"Error processing {len(batch)} messages of user {user_id}: {e}")
+        finally:
+            self._workers.pop(user_id, None)
+            self._arrived.pop(user_id, None)
+
+    @property
+    def pending(self):
+        """Сообщений, ожидающих своего хода"""
+        return sum(len(batch) for batch in self._pending.values())
+
+    @property
+    def active(self):
+        """Пользователей, чьи сообщения сейчас обрабатываются"""
+        return len(self._workers)
+
+    async def drain(self):
+        """Дожидается обработки всех уже принятых сообщений"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
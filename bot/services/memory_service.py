@@ -1,13 +1,153 @@
 from bot.database.crud import (
-    save_message_db, get_last_messages, save_summary_db, get_last_summary_db, get_system_prompt_db, set_system_prompt_db
+    save_messages_batch_db, get_last_messages, save_summary_db, get_last_summary_db, set_system_prompt_db,
+    get_system_prompt_with_version_db, get_system_prompt_version_db, load_user_context, count_messages_after_db
 )
+from bot.services.payment_service import check_subscription
+from bot.services.quota_service import get_usage
+from bot.services.context_service import count_tokens
+from bot.services.stats_service import record_event, mark_active
+from bot.services.metrics_service import registry, start_background_task
+from bot.config import JOURNAL_FLUSH_INTERVAL_MS, JOURNAL_BATCH_SIZE, CONTEXT_HISTORY_LIMIT
+import asyncio
+import datetime
+from loguru import logger
+
+# Кэш системного промпта в памяти процесса. Версия совпадает с id строки в таблице
+# system_prompt, поэтому другой процесс может дёшево проверить, не устарела ли его копия.
+_prompt_cache = {"loaded": False, "content": None, "version": 0}
+
+class MessageJournal:
+    """
+    Журнал отложенной записи сообщений
+
+    Сообщения всех пользователей копятся в памяти и пишутся в БД одной транзакцией
+    раз в flush_interval секунд или при накоплении batch_size строк. Пока пачка
+    не записана, её сообщения видны чтению истории через pending_for.
+    """
+
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._inflight = []
+        # Удерживается на время записи пачки, чтобы чтение не увидело её ни дважды, ни ни разу
+        self.lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = start_background_task(self._run())
+
+    def add(self, user_id, role, content):
+        self._pending.append({
+            'user_id': user_id,
+            'role': role,
+            'content': content,
+            'token_count': count_tokens(content),
+            'created_at': datetime.datetime.utcnow(),
+        })
+        record_event(f"messages_{role}")
+        if role == 'user':
+            mark_active(user_id)
+        self.start()
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def has_pending(self, user_id):
+        return any(entry['user_id'] == user_id for entry in self._inflight + self._pending)
+
+    def pending_for(self, user_id):
+        """Возвращает ещё не записанные сообщения пользователя в порядке добавления"""
+        return [entry for entry in self._inflight + self._pending if entry['user_id'] == user_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Записывает накопленные сообщения одной транзакцией"""
+        async with self.lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            self._inflight = batch
+            try:
+                new_users = await save_messages_batch_db(batch)
+                if new_users:
+                    record_event('new_users', len(new_users))
+            except Exception as e:
+                logger.error(f"Failed to flush {len(batch)} journaled messages: {e}")
+                # Возвращаем пачку в начало очереди, чтобы повторить при следующей записи
+                self._pending = batch + self._pending
+            finally:
+                self._inflight = []
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает всё накопленное в БД"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+message_journal = MessageJournal(JOURNAL_FLUSH_INTERVAL_MS / 1000, JOURNAL_BATCH_SIZE)
+registry.gauge(
+    'bot_journal_pending_messages', "Сообщений в журнале, ещё не записанных в БД",
+    lambda: len(message_journal._pending) + len(message_journal._inflight)
+)
+
+async def _read_history(user_id, read):
+    """
+    Выполняет чтение истории из БД и добавляет к нему ещё не записанные сообщения
+
+    Если у пользователя нет сообщений в журнале, блокировка не нужна и чтение
+    идёт параллельно с записью.
+    """
+    if not message_journal.has_pending(user_id):
+        return await read(), []
+    async with message_journal.lock:
+        return await read(), message_journal.pending_for(user_id)
 
 async def save_message(user_id, role, content):
-    await save_message_db(user_id, role, content)
+    message_journal.add(user_id, role, content)
+
+async def stop_journal():
+    await message_journal.stop()
 
 async def get_short_memory(user_id, limit=10):
-    messages = await get_last_messages(user_id, limit)
-    return [{"role": m.role, "content": m.content} for m in messages]
+    messages, pending = await _read_history(user_id, lambda: get_last_messages(user_id, limit))
+    history = [{"role": m.role, "content": m.content} for m in messages]
+    history += [{"role": entry['role'], "content": entry['content']} for entry in pending]
+    return history[-limit:]
+
+async def count_messages_after(user_id, watermark):
+    """Считает сообщения пользователя новее водяной отметки вместе с ещё не записанными из журнала"""
+    count, pending = await _read_history(user_id, lambda: count_messages_after_db(user_id, watermark))
+    return count + len(pending)
+
+async def get_user_context(user_id, limit=CONTEXT_HISTORY_LIMIT):
+    """Загружает историю и резюме пользователя одним обращением к БД, остальное берёт из кэшей"""
+    context, pending = await _read_history(user_id, lambda: load_user_context(
+        user_id, limit, include_subscription=False, include_usage=False, include_system_prompt=False
+    ))
+    if pending:
+        context.messages += [
+            {"role": entry['role'], "content": entry['content'], "tokens": entry['token_count']} for entry in pending
+        ]
+        context.messages = context.messages[-limit:]
+    context.is_premium = await check_subscription(user_id)
+    context.used = await get_usage(user_id)
+    context.system_prompt = await get_system_prompt()
+    return context
 
 async def save_summary(user_id, summary):
     await save_summary_db(user_id, summary)
@@ -16,7 +156,34 @@ async def get_last_summary(user_id):
     return await get_last_summary_db(user_id)
 
 async def get_system_prompt():
-    return await get_system_prompt_db()
+    """Возвращает системный промпт из кэша, при первом обращении загружает его из БД"""
+    if not _prompt_cache["loaded"]:
+        await refresh_system_prompt()
+    return _prompt_cache["content"]
 
 async def set_system_prompt(prompt):
-    await set_system_prompt_db(prompt) 
\ No newline at end of file
+    """Сохраняет новый системный промпт и сразу обновляет кэш"""
+    version = await set_system_prompt_db(prompt)
+    _prompt_cache.update(loaded=True, content=prompt, version=version)
+
+async def refresh_system_prompt():
+    """Перечитывает системный промпт из БД в кэш"""
+    content, version = await get_system_prompt_with_version_db()
+    _prompt_cache.update(loaded=True, content=content, version=version)
+    logger.info(f"System prompt cache loaded, version {version}")
+
+def get_system_prompt_version():
+    """Возвращает версию закэшированного системного промпта"""
+    return _prompt_cache["version"]
+
+async def refresh_system_prompt_if_stale():
+    """
+    Сверяет версию кэша с БД и перечитывает промпт, если его сменили в другом процессе
+
+    Returns:
+        bool: True, если кэш был обновлён
+    """
+    if _prompt_cache["loaded"] and await get_system_prompt_version_db() == _prompt_cache["version"]:
+        return False
+    await refresh_system_prompt()
+    return True
@@ -0,0 +1,270 @@
+from bot.database.models import engine, read_engine
+from bot.config import METRICS_HOST, METRICS_PORT
+from aiohttp import web
+from bisect import bisect_left
+from sqlalchemy import event
+import asyncio
+import contextvars
+import functools
+import time
+from loguru import logger
+
+# Границы корзин гистограмм по умолчанию, сек
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Монотонно растущий счётчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self._values.items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+class Gauge:
+    """Значение, которое читается функцией в момент запроса /metrics и не стоит ничего в горячем пути"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, read, labels=()):
+        """
+        Args:
+            read: Функция без аргументов: число или, если заданы labels, словарь {значения меток: число}
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if not self.labels:
+            yield f"{self.name} {value}"
+            return
+        for label_values, item in value.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield f"{self.name}{_labels(self.labels, label_values)} {item}"
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+class Histogram:
+    """
+    Гистограмма с метками
+
+    Наблюдение — поиск корзины и три сложения; накопительные суммы по корзинам
+    считаются только при выдаче /metrics.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # значения меток -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *label_values):
+        """Контекстный менеджер, наблюдающий длительность блока"""
+        return _Timer(self, label_values)
+
+    def samples(self):
+        for label_values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, read, labels=()):
+        return self.register(Gauge(name, documentation, read, labels))
+
+    def render(self):
+        """Текст в формате Prometheus (text/plain; version=0.0.4)"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logger.error(f"Failed to collect metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+update_seconds = registry.histogram('bot_update_seconds', "Обработка обновления Telegram целиком", ('type',))
+handler_seconds = registry.histogram('bot_handler_seconds', "Время работы обработчика", ('handler',))
+stage_seconds = registry.histogram('bot_stage_seconds', "Этапы ответа на сообщение", ('stage',))
+db_call_seconds = registry.histogram('bot_db_call_seconds', "Вызовы функций crud", ('call',))
+db_queries = registry.histogram(
+    'bot_db_queries', "SQL-запросов на одно обновление или ход диалога", ('scope',), QUERY_BUCKETS
+)
+db_queries_total = registry.counter('bot_db_queries_total', "Всего SQL-запросов")
+openai_seconds = registry.histogram(
+    'bot_openai_request_seconds', "Запросы к OpenAI с ожиданием очереди и повторами", ('operation', 'model')
+)
+openai_errors = registry.counter('bot_openai_errors_total', "Неудачные попытки запросов к OpenAI", ('service', 'error'))
+
+# Счётчик SQL-запросов текущего обновления или хода: [количество] или None вне них
+_query_count = contextvars.ContextVar('query_count', default=None)
+
+def _count_query(*args):
+    db_queries_total.inc()
+    count = _query_count.get()
+    if count is not None:
+        count[0] += 1
+
+for _engine in {engine, read_engine}:
+    event.listen(_engine.sync_engine, 'before_cursor_execute', _count_query)
+
+registry.gauge(
+    'bot_db_pool_checked_out', "Занятых соединений в пуле БД",
+    lambda: {'write': engine.sync_engine.pool.checkedout(), 'read': read_engine.sync_engine.pool.checkedout()},
+    ('pool',)
+)
+
+class count_queries:
+    """
+    Считает SQL-запросы внутри блока (и в задачах, запущенных из него) и пишет их число в bot_db_queries
+
+    Usage:
+        with count_queries('update'):
+            ...
+    """
+
+    __slots__ = ('scope', 'count', 'token')
+
+    def __init__(self, scope):
+        self.scope = scope
+
+    def __enter__(self):
+        self.count = [0]
+        self.token = _query_count.set(self.count)
+        return self
+
+    def __exit__(self, *exc):
+        _query_count.reset(self.token)
+        db_queries.observe(self.count[0], self.scope)
+
+def start_background_task(coro):
+    """
+    Запускает фоновую задачу без счётчика SQL-запросов текущего обновления
+
+    Задача наследует контекст того, кто её создал: запущенная из обработчика,
+    она иначе добавляла бы свои запросы к счётчику этого обновления или хода.
+    """
+    context = contextvars.copy_context()
+    context.run(_query_count.set, None)
+    return context.run(asyncio.create_task, coro)
+
+def timed_db_call(func):
+    """Декоратор корутин-функций crud: длительность вызова попадает в bot_db_call_seconds{call="<имя>"}"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with db_call_seconds.time(func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+class MetricsMiddleware:
+    """
+    Middleware aiogram
+
+    Как внешний middleware диспетчера (dp.update) измеряет обработку обновления и
+    считает его SQL-запросы, как внутренний middleware роутера — время обработчика.
+    """
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        if handler_object is not None:
+            with handler_seconds.time(handler_object.callback.__name__):
+                return await handler(event, data)
+        with update_seconds.time(getattr(event, 'event_type', 'unknown')), count_queries('update'):
+            return await handler(event, data)
+
+def instrument_dispatcher(dp, routers):
+    """Подключает метрики к диспетчеру и обработчикам роутеров"""
+    middleware = MetricsMiddleware()
+    dp.update.outer_middleware(middleware)
+    for router in routers:
+        router.message.middleware(middleware)
+        router.callback_query.middleware(middleware)
+
+_runner = None
+
+async def _handle_metrics(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server(port=METRICS_PORT):
+    """Запускает HTTP-сервер с /metrics (port 0 — не запускать)"""
+    global _runner
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, port).start()
+    logger.info(f"Metrics available at http://{METRICS_HOST}:{port}/metrics")
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,126 @@
+import asyncio
+import openai
+from collections import Counter
+from loguru import logger
+
+class RoutingStats:
+    """Счётчики маршрутизации: сколько запросов хеджировано и какая модель ответила первой"""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.hedged = Counter()
+        self.fallback_wins = Counter()
+
+    def snapshot(self):
+        """Возвращает по каждому тарифу число запросов, долю хеджирования и долю побед запасной модели"""
+        result = {}
+        for tier, requests in self.requests.items():
+            hedged = self.hedged[tier]
+            result[tier] = {
+                'requests': requests,
+                'hedged': hedged,
+                'hedge_rate': hedged / requests if requests else 0.0,
+                'fallback_wins': self.fallback_wins[tier],
+                'fallback_win_rate': self.fallback_wins[tier] / hedged if hedged else 0.0,
+            }
+        return result
+
+routing_stats = RoutingStats()
+
+class FirstToken:
+    """
+    Открытый поток ответа модели, из которого уже прочитан первый фрагмент
+
+    Attributes:
+        model: Модель, которая отвечает
+        first: Первый фрагмент текста (пустая строка, если ответ пуст)
+        rest: Асинхронный итератор по оставшимся фрагментам потока
+    """
+
+    def __init__(self, model, first, rest, close):
+        self.model = model
+        self.first = first
+        self.rest = rest
+        self._close = close
+
+    async def close(self):
+        """Закрывает поток и освобождает слот в очереди запросов"""
+        await self._close()
+
+async def _discard(tasks):
+    """Отменяет проигравшие запросы и закрывает потоки тех, что успели открыться"""
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, FirstToken):
+            await result.close()
+
+def _worth_hedging(error):
+    """
+    Стоит ли после такой ошибки основной модели пробовать запасную
+
+    Только сбой связи или 5xx. Отказ очереди или предохранителя бота означает,
+    что нагрузку надо сбрасывать, а не удваивать, а на ошибку запроса (4xx,
+    включая 429) второй запрос получил бы тот же отказ или добавил бы нагрузки.
+    """
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+async def race_first_token(primary, fallback, hedge_after, tier, sent=None):
+    """
+    Получает первый фрагмент ответа, при задержке дублируя запрос к запасной модели
+
+    Если основная модель не выдала первый фрагмент за hedge_after секунд после
+    отправки запроса (или упала из-за сбоя связи или сервера), запускается запрос
+    к запасной модели. Другие ошибки основной модели пробрасываются сразу.
+    Используется тот ответ, который начался раньше, второй запрос отменяется.
+
+    Args:
+        primary: Корутина-функция, открывающая поток основной модели и возвращающая FirstToken
+        fallback: То же для запасной модели или None, если хеджирование выключено
+        hedge_after: Допустимое время до первого фрагмента, сек (0 — без хеджирования)
+        tier: Тариф пользователя для статистики
+        sent: asyncio.Event, который устанавливается, когда запрос основной модели
+            прошёл очередь; время ожидания в очереди в hedge_after не входит
+
+    Returns:
+        FirstToken: Поток модели, ответившей первой
+    """
+    routing_stats.requests[tier] += 1
+    primary_task = asyncio.create_task(primary())
+    if fallback is None or hedge_after <= 0:
+        return await primary_task
+
+    try:
+        if sent is not None:
+            sent_waiter = asyncio.create_task(sent.wait())
+            await asyncio.wait({primary_task, sent_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            sent_waiter.cancel()
+        await asyncio.wait({primary_task}, timeout=hedge_after)
+    except BaseException:
+        await _discard([primary_task])
+        raise
+    if primary_task.done() and (primary_task.exception() is None or not _worth_hedging(primary_task.exception())):
+        return primary_task.result()
+
+    routing_stats.hedged[tier] += 1
+    logger.info(f"No first token within {hedge_after}s for {tier} request, hedging to fallback model")
+    fallback_task = asyncio.create_task(fallback())
+    pending = {primary_task, fallback_task}
+    errors = {}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in (primary_task, fallback_task) if task in done and task.exception() is None]
+            for task in done:
+                if task.exception() is not None:
+                    errors[task] = task.exception()
+            if winners:
+                winner = winners[0]
+                await _discard([task for task in winners[1:]])
+                if winner is fallback_task:
+                    routing_stats.fallback_wins[tier] += 1
+                return winner.result()
+        raise errors.get(primary_task) or errors[fallback_task]
+    finally:
+        if pending:
+            await _discard(list(pending))
@@ -0,0 +1,148 @@
+from bot.services.openai_service import moderate_texts, QueueFullError, PRIORITY_PREMIUM
+from bot.config import MODERATION_BATCH_WINDOW_MS, MODERATION_BATCH_SIZE, MODERATION_CACHE_SIZE, MODERATION_CACHE_TTL
+from collections import OrderedDict
+import asyncio
+import hashlib
+import time
+from loguru import logger
+
+def _normalize(text):
+    """Приводит текст к виду, в котором одинаковые по смыслу повторы совпадают"""
+    return " ".join(text.casefold().split())
+
+def _cache_key(text):
+    return hashlib.sha256(_normalize(text).encode('utf-8')).hexdigest()
+
+class ModerationCache:
+    """
+    LRU-кеш результатов модерации с ограниченным временем жизни
+
+    Ключ — хеш нормализованного текста, значение — список нарушенных категорий.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, categories):
+        self._items[key] = (categories, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+class ModerationBatcher:
+    """
+    Объединяет одновременные проверки модерации в один запрос к API
+
+    Проверки копятся batch_window секунд (или до batch_size разных текстов),
+    затем уходят одним вызовом, и результаты раздаются ожидающим. Одинаковые
+    тексты внутри пачки проверяются один раз, повторы берутся из кеша. Пачка
+    встаёт в очередь к OpenAI с наивысшим приоритетом среди своих проверок.
+    """
+
+    def __init__(self, cache, batch_window, batch_size):
+        self.cache = cache
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._pending = {}
+        self._priority = None
+        self._timer = None
+        # Ссылки на запущенные отправки, чтобы задачи не собрал сборщик мусора
+        self._tasks = set()
+
+    async def check(self, text, priority=PRIORITY_PREMIUM):
+        """
+        Возвращает список нарушенных категорий для текста (пустой, если текст безопасен)
+
+        Raises:
+            QueueFullError: Очередь к OpenAI переполнена, а приоритет пачки ниже, чем у подписчиков
+            Exception: Ошибка API модерации
+        """
+        key = _cache_key(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        self._priority = priority if self._priority is None else min(self._priority, priority)
+        if key in self._pending:
+            future = self._pending[key][1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = (text, future)
+            if len(self._pending) >= self.batch_size:
+                self._send()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.batch_window, self._send)
+        # shield: отмена одного ожидающего не должна отменять результат для остальных
+        return await asyncio.shield(future)
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        priority, self._priority = self._priority, None
+        if batch:
+            task = asyncio.create_task(self._flush(batch, priority))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch, priority):
+        keys = list(batch)
+        try:
+            results = await moderate_texts([batch[key][0] for key in keys], priority)
+        except Exception as e:
+            for _, future in batch.values():
+                future.set_exception(e)
+                # Помечаем исключение полученным: все ожидающие могли уже отмениться
+                future.exception()
+            return
+        for key, categories in zip(keys, results):
+            self.cache.set(key, categories)
+            batch[key][1].set_result(categories)
+
+moderation_cache = ModerationCache(MODERATION_CACHE_SIZE, MODERATION_CACHE_TTL)
+moderation_batcher = ModerationBatcher(moderation_cache, MODERATION_BATCH_WINDOW_MS / 1000, MODERATION_BATCH_SIZE)
+
+async def is_prompt_safe(prompt, priority=PRIORITY_PREMIUM):
+    """
+    Проверяет текст на безопасность с помощью модерации OpenAI
+
+    Args:
+        prompt: Текст для проверки
+        priority: Приоритет проверки в очереди к OpenAI (тариф пользователя)
+
+    Returns:
+        bool: True если текст безопасен, False если нарушает правила
+
+    Raises:
+        QueueFullError: Очередь переполнена — текст не проверен, и пропускать его дальше нельзя
+    """
+    try:
+        categories = await moderation_batcher.check(prompt, priority)
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.error(f"Error in moderation API: {e}")
+        # В случае ошибки возвращаем True, чтобы не блокировать пользователя
+        return True
+
+    if categories:
+        logger.warning(f"Unsafe prompt detected. Categories: {categories}. Prompt: {prompt}")
+    return not categories
@@ -0,0 +1,42 @@
+from bot.database.crud import get_expiring_subscriptions, mark_subscriptions_notified, mark_users_blocked
+from bot.services.broadcast_service import send_rate_limited
+from bot.config import NOTIFY_BEFORE_EXPIRATION, BROADCAST_CONCURRENCY
+import asyncio
+from loguru import logger
+
+async def send_expiry_notices(bot):
+    """
+    Уведомляет пользователей, чья подписка скоро истечёт
+
+    Уведомления отправляются параллельно под общим ограничителем частоты.
+    Каждая подписка получает одно уведомление на срок действия: отметка
+    notified_at ставится после отправки и сбрасывается при продлении.
+    """
+    subscriptions = await get_expiring_subscriptions(NOTIFY_BEFORE_EXPIRATION)
+    if not subscriptions:
+        return
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def notify(subscription):
+        # Форматируем дату окончания подписки
+        expires_at = subscription.expires_at.strftime("%d.%m.%Y")
+        async with semaphore:
+            return await send_rate_limited(
+                bot,
+                subscription.user_id,
+                f"⚠️ <b>Внимание!</b>\n\n"
+                f"Твоя подписка истекает {expires_at}.\n"
+                f"Чтобы продолжить пользоваться всеми преимуществами, "
+                f"не забудь продлить подписку командой /subscribe.",
+                parse_mode="HTML"
+            )
+
+    results = await asyncio.gather(*(notify(subscription) for subscription in subscriptions))
+    # Неудачные отправки не отмечаем — они повторятся при следующем запуске
+    done = [sub for sub, result in zip(subscriptions, results) if result in ('sent', 'blocked')]
+    await mark_subscriptions_notified([sub.id for sub in done])
+    await mark_users_blocked([sub.user_id for sub, result in zip(subscriptions, results) if result == 'blocked'])
+    logger.info(
+        f"Expiry notices: {results.count('sent')} sent, {results.count('blocked')} blocked, "
+        f"{results.count('failed')} failed"
+    )
@@ -2,19 +2,236 @@ import openai
 from openai import AsyncOpenAI
 from bot.config import (
     OPENAI_API_KEY, DEFAULT_MODEL, PREMIUM_MODEL, MAX_TOKENS, TEMPERATURE, TOP_P,
-    IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY
+    IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY, OPENAI_RATE_LIMITS, OPENAI_MAX_CONCURRENCY, OPENAI_QUEUE_SHED_THRESHOLD,
+    OPENAI_RETRY_ATTEMPTS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY, OPENAI_CHAT_DEADLINE,
+    OPENAI_IMAGE_DEADLINE, OPENAI_MODERATION_DEADLINE, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT,
+    FALLBACK_MODEL, ROUTING_TTFT_PREMIUM, ROUTING_TTFT_FREE
 )
 from bot.services.payment_service import check_subscription
 from bot.services.memory_service import get_system_prompt
+from bot.services.context_service import build_context, count_tokens
+from bot.services.rate_limiter import TokenBucket
+from bot.services.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_retry
+from bot.services.model_router import FirstToken, race_first_token
+from bot.services.stats_service import record_event
+from bot.services.metrics_service import openai_seconds, registry
+from contextlib import asynccontextmanager, AsyncExitStack
+import asyncio
+import heapq
+import itertools
 import os
 import tempfile
 import uuid
 from loguru import logger
 
-# Создаем клиент OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Создаем клиент OpenAI. Встроенные повторы клиента отключены: повторами
+# управляет call_with_retry, учитывая сроки и предохранители
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
-async def ask_gpt(user_id, user_message, short_mem, summary):
+# Политики повторов и предохранители по типам запросов
+chat_retry = RetryPolicy(OPENAI_RETRY_ATTEMPTS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY, OPENAI_CHAT_DEADLINE)
+image_retry = RetryPolicy(OPENAI_RETRY_ATTEMPTS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY, OPENAI_IMAGE_DEADLINE)
+moderation_retry = RetryPolicy(
+    OPENAI_RETRY_ATTEMPTS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY, OPENAI_MODERATION_DEADLINE
+)
+chat_breaker = CircuitBreaker('chat', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+image_breaker = CircuitBreaker('images', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+moderation_breaker = CircuitBreaker('moderation', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+# Приоритеты запросов: чем меньше число, тем раньше запрос обслуживается
+PRIORITY_PREMIUM = 0
+PRIORITY_FREE = 1
+PRIORITY_BACKGROUND = 2
+
+class QueueFullError(Exception):
+    """Очередь к OpenAI переполнена, запрос с низким приоритетом отклонён"""
+
+    def __init__(self, position):
+        super().__init__(f"OpenAI queue is full, position {position}")
+        self.position = position
+
+class ChatFailedError(Exception):
+    """
+    Ответ модели не получен: запрос отклонён очередью или предохранителем либо завершился ошибкой
+
+    Attributes:
+        reply: Понятный пользователю текст об ошибке (не ответ модели — в историю он не сохраняется)
+    """
+
+    def __init__(self, reply):
+        super().__init__(reply)
+        self.reply = reply
+
+class _Ticket:
+    def __init__(self, priority, seq, model, tokens):
+        self.priority = priority
+        self.seq = seq
+        self.model = model
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OpenAIScheduler:
+    """
+    Центральная очередь запросов к OpenAI
+
+    Запрос получает слот, когда свободен один из max_concurrency слотов и в ведрах
+    его модели хватает запросов (RPM) и токенов (TPM). Ожидающие обслуживаются по
+    приоритету: подписчики раньше бесплатных пользователей, фоновые задачи последними.
+    Запрос модели, упёршейся в лимит, не задерживает запросы к другим моделям.
+    """
+
+    def __init__(self, rate_limits, max_concurrency, shed_threshold):
+        self.rate_limits = rate_limits
+        self.max_concurrency = max_concurrency
+        self.shed_threshold = shed_threshold
+        self._buckets = {}
+        self._queue = []
+        self._active = 0
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+    def _model_buckets(self, model):
+        if model not in self._buckets:
+            rpm, tpm = self.rate_limits.get(model, (0, 0))
+            self._buckets[model] = (TokenBucket(rpm / 60, rpm), TokenBucket(tpm / 60, tpm))
+        return self._buckets[model]
+
+    def share(self, parts):
+        """Оставляет этому процессу 1/parts лимитов и слотов (запуск в несколько процессов)"""
+        def part(limit):
+            # 0 — без ограничения, поэтому маленький лимит не должен округлиться до нуля
+            return max(1, limit // parts) if limit else 0
+        self.rate_limits = {model: (part(rpm), part(tpm)) for model, (rpm, tpm) in self.rate_limits.items()}
+        self.max_concurrency = max(1, self.max_concurrency // parts)
+        self._buckets.clear()
+
+    def queue_position(self, ticket):
+        """Позиция запроса в очереди с учётом приоритета (начиная с 1)"""
+        return sum(1 for other in self._queue if other < ticket) + 1
+
+    def pause(self, model, seconds):
+        """Не выдаёт слоты для модели seconds секунд (сервер сообщил о превышении лимита)"""
+        rpm, _ = self._model_buckets(model)
+        rpm.pause(seconds)
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def active(self):
+        return self._active
+
+    @asynccontextmanager
+    async def slot(self, model, tokens=0, priority=PRIORITY_FREE, on_queued=None):
+        """
+        Ждёт своей очереди и удерживает слот на время запроса к OpenAI
+
+        Args:
+            model: Модель (или 'moderation'), по которой считаются лимиты
+            tokens: Оценка токенов запроса и ответа для лимита TPM
+            priority: Приоритет запроса
+            on_queued: Корутина-функция, получающая позицию в очереди, если запрос пришлось отложить
+
+        Raises:
+            QueueFullError: Очередь переполнена, а приоритет ниже, чем у подписчиков
+        """
+        if priority > PRIORITY_PREMIUM and len(self._queue) >= self.shed_threshold:
+            raise QueueFullError(len(self._queue) + 1)
+
+        ticket = _Ticket(priority, next(self._seq), model, tokens)
+        heapq.heappush(self._queue, ticket)
+        self._dispatch()
+        try:
+            if not ticket.future.done() and on_queued is not None:
+                try:
+                    await on_queued(self.queue_position(ticket))
+                except Exception as e:
+                    logger.error(f"Error notifying about queue position: {e}")
+            await ticket.future
+        except BaseException:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release()
+            else:
+                ticket.future.cancel()
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Выдаёт слоты всем запросам, которые можно обслужить прямо сейчас"""
+        next_check = None
+        for ticket in sorted(self._queue):
+            if self._active >= self.max_concurrency:
+                break
+            rpm, tpm = self._model_buckets(ticket.model)
+            wait = max(rpm.delay(1), tpm.delay(ticket.tokens))
+            if wait > 0:
+                next_check = wait if next_check is None else min(next_check, wait)
+                continue
+            rpm.consume(1)
+            tpm.consume(ticket.tokens)
+            self._queue.remove(ticket)
+            self._active += 1
+            ticket.future.set_result(None)
+        heapq.heapify(self._queue)
+
+        # Если кто-то ждёт пополнения ведер, проверим очередь ещё раз позже
+        if next_check is not None and self._active < self.max_concurrency:
+            if self._wakeup is not None:
+                self._wakeup.cancel()
+            self._wakeup = asyncio.get_running_loop().call_later(next_check, self._dispatch)
+
+scheduler = OpenAIScheduler(OPENAI_RATE_LIMITS, OPENAI_MAX_CONCURRENCY, OPENAI_QUEUE_SHED_THRESHOLD)
+registry.gauge('bot_openai_queue_depth', "Запросов к OpenAI в очереди планировщика", lambda: scheduler.queue_depth)
+registry.gauge('bot_openai_active_requests', "Выполняющихся запросов к OpenAI", lambda: scheduler.active)
+
+def _estimate_tokens(messages):
+    """Оценка токенов запроса для лимита TPM: контекст плюс максимальная длина ответа"""
+    return sum(count_tokens(m["content"]) for m in messages) + MAX_TOKENS
+
+async def _prepare_chat_request(user_id, context):
+    """Определяет тариф пользователя и системный промпт для запроса к GPT"""
+    if context is not None:
+        return context.is_premium, context.system_prompt
+    return await check_subscription(user_id), await get_system_prompt()
+
+def chat_error_reply(user_id, error):
+    """Логирует ошибку OpenAI и возвращает понятный пользователю текст"""
+    if isinstance(error, QueueFullError):
+        logger.warning(f"OpenAI queue is full, request of user {user_id} rejected at position {error.position}")
+        return (
+            f"Сейчас очень много запросов, ты {error.position}-й в очереди. "
+            f"Попробуй еще раз через минуту или оформи подписку для приоритетной обработки."
+        )
+    if isinstance(error, CircuitOpenError):
+        logger.warning(f"OpenAI {error.name} circuit is open, request of user {user_id} rejected")
+        return "Извини, OpenAI сейчас не отвечает. Попробуй еще раз через пару минут."
+    if isinstance(error, openai.RateLimitError):
+        logger.error(f"OpenAI API rate limit exceeded for user {user_id} after {OPENAI_RETRY_ATTEMPTS} attempts")
+        return "Извини, сервер OpenAI сильно перегружен. Попробуй еще раз через пару минут."
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError)):
+        logger.error(f"OpenAI API timeout for user {user_id}")
+        return "Извини, запрос к OpenAI занял слишком много времени. Попробуй еще раз."
+    if isinstance(error, openai.APIConnectionError):
+        logger.error(f"OpenAI API connection error for user {user_id}")
+        return "Извини, возникла проблема с подключением к OpenAI. Проверь соединение с интернетом."
+    logger.error(f"Error in OpenAI API: {error}")
+    return "Извини, у меня возникла проблема с ответом. Попробуй еще раз через минуту."
+
+async def ask_gpt(user_id, user_message, short_mem, summary, context=None, on_queued=None):
     """
     Отправляет запрос к модели GPT и возвращает ответ
     
@@ -23,47 +240,149 @@ async def ask_gpt(user_id, user_message, short_mem, summary):
         user_message: Текст сообщения пользователя
         short_mem: Краткосрочная память (последние сообщения)
         summary: Резюме предыдущих диалогов
+        context: Уже загруженный UserContext (подписка и промпт берутся из него без запросов к БД)
+        on_queued: Корутина-функция, которая получит позицию в очереди, если запрос придётся отложить
         
     Returns:
         str: Ответ модели
+
+    Raises:
+        ChatFailedError: Ответ не получен
     """
-    is_premium = await check_subscription(user_id)
+    # Ответ собирается из потока, чтобы работала маршрутизация по времени до первого токена
+    parts = [delta async for delta in ask_gpt_stream(user_id, user_message, short_mem, summary, context, on_queued)]
+    return "".join(parts).strip()
+
+async def _open_chat_stream(model, messages, priority, on_queued=None, sent=None):
+    """
+    Открывает потоковый ответ модели и читает первый фрагмент
+
+    Повторяется только открытие потока: после первых фрагментов повтор дал бы другой ответ.
+
+    Returns:
+        FirstToken: Поток с уже прочитанным первым фрагментом
+    """
+
+    @asynccontextmanager
+    async def chat_slot():
+        async with scheduler.slot(model, _estimate_tokens(messages), priority, on_queued):
+            if sent is not None:
+                sent.set()
+            yield
+
+    async def open_stream():
+        return await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=MAX_TOKENS,
+            temperature=TEMPERATURE,
+            top_p=TOP_P,
+            stream=True,
+        )
+
+    # Слот удерживается до конца потока: он освобождается вместе с закрытием потока
+    with openai_seconds.time('chat_open', model):
+        stream, release = await call_with_retry(
+            open_stream, chat_retry, chat_breaker, lambda seconds: scheduler.pause(model, seconds),
+            slot=chat_slot, keep_slot=True
+        )
+    slot = AsyncExitStack()
+    slot.push_async_callback(release)
+    slot.push_async_callback(stream.close)
+    rest = stream.__aiter__()
+    try:
+        async for chunk in rest:
+            if chunk.choices and chunk.choices[0].delta.content:
+                return FirstToken(model, chunk.choices[0].delta.content, rest, slot.aclose)
+    except BaseException:
+        await slot.aclose()
+        raise
+    return FirstToken(model, "", rest, slot.aclose)
+
+async def ask_gpt_stream(user_id, user_message, short_mem, summary, context=None, on_queued=None):
+    """
+    Отправляет запрос к модели GPT в потоковом режиме
+
+    Аргументы те же, что у ask_gpt. Если основная модель не начала отвечать за
+    допустимое для тарифа время, параллельно запрашивается FALLBACK_MODEL и
+    используется ответ, который начался раньше. Если ошибка случилась посреди
+    ответа, поток просто обрывается.
+
+    Yields:
+        str: Очередной фрагмент ответа модели
+
+    Raises:
+        ChatFailedError: Запрос отклонён или не удался до первого фрагмента
+    """
+    is_premium, system_prompt = await _prepare_chat_request(user_id, context)
     model = PREMIUM_MODEL if is_premium else DEFAULT_MODEL
-    system_prompt = await get_system_prompt()
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    if summary:
-        messages.append({"role": "system", "content": f"Summary: {summary}"})
-    messages += short_mem
-    messages.append({"role": "user", "content": user_message})
+    priority = PRIORITY_PREMIUM if is_premium else PRIORITY_FREE
+    tier = 'premium' if is_premium else 'free'
+    hedge_after = ROUTING_TTFT_PREMIUM if is_premium else ROUTING_TTFT_FREE
+    sent = asyncio.Event()
+
+    def request(request_model, notify=None, sent_event=None):
+        messages = build_context(request_model, system_prompt, summary, short_mem, user_message)
+        return lambda: _open_chat_stream(request_model, messages, priority, notify, sent_event)
+
+    fallback = None
+    if FALLBACK_MODEL and FALLBACK_MODEL != model:
+        fallback = request(FALLBACK_MODEL)
+
+    started = False
     try:
-        for attempt in range(3):  # Пробуем 3 раза
-            try:
-                response = await client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=MAX_TOKENS,
-                    temperature=TEMPERATURE,
-                    top_p=TOP_P,
-                )
-                return response.choices[0].message.content.strip()
-            except openai.RateLimitError:
-                if attempt == 2:  # Если это была последняя попытка
-                    raise
-                await asyncio.sleep(20 * (attempt + 1))  # Увеличиваем время ожидания с каждой попыткой
-    except openai.RateLimitError:
-        logger.error(f"OpenAI API rate limit exceeded for user {user_id} after 3 attempts")
-        return "Извини, сервер OpenAI сильно перегружен. Попробуй еще раз через пару минут."
-    except openai.APIConnectionError:
-        logger.error(f"OpenAI API connection error for user {user_id}")
-        return "Извини, возникла проблема с подключением к OpenAI. Проверь соединение с интернетом."
-    except openai.APITimeoutError:
-        logger.error(f"OpenAI API timeout for user {user_id}")
-        return "Извини, запрос к OpenAI занял слишком много времени. Попробуй еще раз."
+        answer = await race_first_token(request(model, on_queued, sent), fallback, hedge_after, tier, sent)
+        try:
+            if answer.first:
+                started = True
+                yield answer.first
+            async for chunk in answer.rest:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    started = True
+                    yield chunk.choices[0].delta.content
+        finally:
+            await answer.close()
     except Exception as e:
-        logger.error(f"Error in OpenAI API: {e}")
-        return "Извини, у меня возникла проблема с ответом. Попробуй еще раз через минуту."
+        error_reply = chat_error_reply(user_id, e)
+        if not started:
+            raise ChatFailedError(error_reply) from e
+
+async def summarize_dialog(previous_summary, messages):
+    """
+    Дополняет резюме диалога новыми сообщениями
+
+    В отличие от ask_gpt, ошибки не превращаются в текст ответа, а пробрасываются,
+    чтобы текст ошибки не попал в резюме.
+
+    Args:
+        previous_summary: Текущее резюме или None
+        messages: Новые сообщения — строки с полями role и content
+
+    Returns:
+        str: Обновлённое резюме
+    """
+    dialog = "\n".join(f"{m.role}: {m.content}" for m in messages)
+    prompt = (
+        f"Предыдущее резюме диалога:\n{previous_summary or '(нет)'}\n\n"
+        f"Новые сообщения:\n{dialog}\n\n"
+        f"Обнови резюме с учётом новых сообщений. Сохрани важные факты о собеседнике. "
+        f"Ответь только текстом резюме, не длиннее 3-4 предложений."
+    )
+
+    async def request():
+        return await client.chat.completions.create(
+            model=DEFAULT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=300,
+            temperature=0.3,
+        )
+
+    with openai_seconds.time('summary', DEFAULT_MODEL):
+        response = await call_with_retry(
+            request, chat_retry, chat_breaker, lambda seconds: scheduler.pause(DEFAULT_MODEL, seconds),
+            slot=lambda: scheduler.slot(DEFAULT_MODEL, count_tokens(prompt) + 300, PRIORITY_BACKGROUND)
+        )
+    return response.choices[0].message.content.strip()
 
 async def generate_image(user_id, prompt, size=None):
     """
@@ -93,17 +412,25 @@ async def generate_image(user_id, prompt, size=None):
     try:
         # Генерируем изображение
         logger.info(f"Generating image for user {user_id} with prompt: {prompt}")
-        response = await client.images.generate(
-            model=IMAGE_MODEL,
-            prompt=enhanced_prompt,
-            size=image_size,
-            quality=IMAGE_QUALITY,
-            n=1,
-        )
+        async def request():
+            return await client.images.generate(
+                model=IMAGE_MODEL,
+                prompt=enhanced_prompt,
+                size=image_size,
+                quality=IMAGE_QUALITY,
+                n=1,
+            )
+        
+        with openai_seconds.time('image', IMAGE_MODEL):
+            response = await call_with_retry(
+                request, image_retry, image_breaker, lambda seconds: scheduler.pause(IMAGE_MODEL, seconds),
+                slot=lambda: scheduler.slot(IMAGE_MODEL, priority=PRIORITY_PREMIUM)
+            )
         
         # Получаем URL изображения
         image_url = response.data[0].url
         logger.info(f"Image generated successfully for user {user_id}")
+        record_event('images_generated')
         
         # Возвращаем URL изображения
         return True, image_url
@@ -111,6 +438,9 @@ async def generate_image(user_id, prompt, size=None):
     except openai.RateLimitError:
         logger.error(f"Image generation rate limit exceeded for user {user_id}")
         return False, "Превышен лимит запросов на генерацию изображений. Попробуй позже."
+    except CircuitOpenError:
+        logger.warning(f"Image generation circuit is open, request of user {user_id} rejected")
+        return False, "Сервис генерации изображений временно недоступен. Попробуй через пару минут."
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return False, f"Ошибка при генерации изображения: {str(e)}"
@@ -138,30 +468,34 @@ def enhance_image_prompt(prompt):
     
     return prompt
 
-async def is_prompt_safe(prompt):
+async def moderate_texts(texts, priority=PRIORITY_PREMIUM):
     """
-    Проверяет промпт на безопасность с помощью модерации OpenAI
-    
+    Проверяет несколько текстов одним запросом к модерации OpenAI
+
     Args:
-        prompt: Текст для проверки
-        
+        texts: Список текстов
+        priority: Приоритет запроса в очереди к OpenAI
+
     Returns:
-        bool: True если промпт безопасен, False если нарушает правила
+        list: Для каждого текста список нарушенных категорий (пустой, если текст безопасен)
+
+    Raises:
+        QueueFullError: Очередь переполнена, а приоритет ниже, чем у подписчиков
+        Exception: Ошибка API, если повторы не помогли
     """
-    try:
-        response = await client.moderations.create(input=prompt)
-        
-        # Получаем результат модерации
-        is_flagged = response.results[0].flagged
-        
-        # Если промпт помечен как небезопасный, логируем категории нарушений
-        if is_flagged:
-            categories = response.results[0].categories
-            flagged_categories = [cat for cat, flagged in categories.items() if flagged]
-            logger.warning(f"Unsafe prompt detected. Categories: {flagged_categories}. Prompt: {prompt}")
-            
-        return not is_flagged
-    except Exception as e:
-        logger.error(f"Error in moderation API: {e}")
-        # В случае ошибки возвращаем True, чтобы не блокировать пользователя
-        return True
\ No newline at end of file
+    async def request():
+        return await client.moderations.create(input=texts)
+
+    with openai_seconds.time('moderation', 'moderation'):
+        response = await call_with_retry(
+            request, moderation_retry, moderation_breaker, lambda seconds: scheduler.pause('moderation', seconds),
+            slot=lambda: scheduler.slot('moderation', priority=priority)
+        )
+    results = []
+    for result in response.results:
+        if result.flagged:
+            # categories — pydantic-модель, а не словарь
+            results.append([cat for cat, flagged in result.categories.model_dump().items() if flagged])
+        else:
+            results.append([])
+    return results
@@ -1,18 +1,118 @@
-from bot.database.crud import get_user_subscription, get_user_message_count, add_subscription
+from bot.database.crud import add_subscription, get_active_subscriptions
+from bot.services.quota_service import get_usage
+from bot.services.stats_service import record_event
 from bot.config import FREE_USER_LIMIT
 import datetime
+import heapq
 import uuid
 from loguru import logger
 
+class SubscriptionRegistry:
+    """
+    Реестр действующих подписок в памяти процесса
+
+    Словарь user_id -> expires_at даёт проверку за O(1), а куча по expires_at
+    позволяет удалять истёкшие подписки без полного прохода по словарю.
+    В реестре все действующие подписки, поэтому любая проверка отвечается из
+    памяти: счётчики показывают, сколько проверок нашли подписку и сколько нет.
+    """
+
+    def __init__(self):
+        self._expires = {}
+        self._heap = []
+        self.loaded = False
+        self.found = 0
+        self.not_found = 0
+        # (номер, всего) рабочего процесса: истечение учитывается в статистике только процессом,
+        # который обслуживает пользователя, иначе каждый процесс посчитает его заново
+        self.shard = None
+
+    def load(self, subscriptions):
+        """Заполняет реестр парами (user_id, expires_at)"""
+        if self.loaded:
+            # Подписки, истёкшие с прошлой проверки, учитываем до того, как они пропадут из реестра
+            self._purge(datetime.datetime.utcnow())
+        self._expires.clear()
+        self._heap.clear()
+        for user_id, expires_at in subscriptions:
+            self.set(user_id, expires_at)
+        self.loaded = True
+
+    def set(self, user_id, expires_at):
+        """Добавляет или продлевает подписку"""
+        self._expires[user_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, user_id))
+
+    def _purge(self, now):
+        # В куче могут лежать устаревшие записи после продления — удаляем из словаря
+        # только если срок в словаре совпадает со сроком из кучи
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._heap)
+            if self._expires.get(user_id) == expires_at:
+                del self._expires[user_id]
+                if self.shard is None or user_id % self.shard[1] == self.shard[0]:
+                    record_event('subscriptions_expired', at=expires_at)
+
+    def get_expires_at(self, user_id):
+        """Возвращает дату окончания действующей подписки или None"""
+        self._purge(datetime.datetime.utcnow())
+        expires_at = self._expires.get(user_id)
+        if expires_at is None:
+            self.not_found += 1
+        else:
+            self.found += 1
+        return expires_at
+
+    def is_active(self, user_id):
+        return self.get_expires_at(user_id) is not None
+
+    def stats(self):
+        """Возвращает размер реестра и число проверок с подпиской и без неё"""
+        self._purge(datetime.datetime.utcnow())
+        return {'active': len(self._expires), 'found': self.found, 'not_found': self.not_found}
+
+subscription_registry = SubscriptionRegistry()
+
+async def load_subscriptions():
+    """Загружает действующие подписки из БД в реестр (вызывается при старте)"""
+    subscription_registry.load(await get_active_subscriptions())
+    logger.info(f"Loaded {subscription_registry.stats()['active']} active subscriptions")
+
+async def refresh_subscriptions():
+    """Перечитывает реестр из БД: подписку могли выдать в другом процессе"""
+    subscription_registry.load(await get_active_subscriptions())
+
 async def check_subscription(user_id):
     """Проверяет наличие активной подписки у пользователя"""
-    sub = await get_user_subscription(user_id)
-    return sub and sub.is_active
+    if not subscription_registry.loaded:
+        await load_subscriptions()
+    return subscription_registry.is_active(user_id)
+
+async def get_subscription_expires_at(user_id):
+    """Возвращает дату окончания активной подписки пользователя или None"""
+    if not subscription_registry.loaded:
+        await load_subscriptions()
+    return subscription_registry.get_expires_at(user_id)
 
-async def get_user_limits(user_id):
-    """Возвращает количество использованных запросов и лимит для пользователя"""
-    used = await get_user_message_count(user_id)
-    limit = 9999 if await check_subscription(user_id) else FREE_USER_LIMIT
+async def grant_subscription(user_id, expires_at):
+    """Сохраняет подписку в БД и сразу обновляет реестр"""
+    subscription = await add_subscription(user_id, expires_at)
+    subscription_registry.set(user_id, expires_at)
+    record_event('subscriptions_new')
+    return subscription
+
+async def get_user_limits(user_id, is_premium=None):
+    """
+    Возвращает количество использованных запросов и лимит для пользователя
+
+    Args:
+        user_id: ID пользователя
+        is_premium: Уже известный статус подписки (чтобы не проверять её повторно)
+    """
+    used = await get_usage(user_id)
+    if is_premium is None:
+        is_premium = await check_subscription(user_id)
+    limit = 9999 if is_premium else FREE_USER_LIMIT
     return used, limit
 
 async def generate_payment_link(user_id, days=30, amount=299):
@@ -41,7 +141,7 @@ async def process_successful_payment(payment_id, user_id, days=30):
         expires_at = datetime.datetime.utcnow() + datetime.timedelta(days=days)
         
         # Добавляем или обновляем подписку
-        subscription = await add_subscription(user_id, expires_at)
+        subscription = await grant_subscription(user_id, expires_at)
         
         logger.info(f"Активирована подписка для пользователя {user_id} до {expires_at}")
         return True
@@ -0,0 +1,41 @@
+from bot.database.crud import get_usage_counter_db, save_usage_counter_db
+import datetime
+from loguru import logger
+
+# Счётчики использования за текущие сутки (UTC): user_id -> количество сообщений.
+# Счётчик пользователя читается из таблицы usage_counters при первом обращении за день,
+# дальше проверка лимита не обращается к БД.
+_counters = {}
+_day = None
+
+def _today():
+    """Возвращает текущие сутки и сбрасывает счётчики при смене дня"""
+    global _day
+    today = datetime.datetime.utcnow().date()
+    if today != _day:
+        _counters.clear()
+        _day = today
+    return today
+
+async def get_usage(user_id):
+    """Возвращает количество сообщений пользователя за текущие сутки"""
+    today = _today()
+    if user_id not in _counters:
+        row = await get_usage_counter_db(user_id)
+        _counters[user_id] = row.count if row and row.day == today else 0
+    return _counters[user_id]
+
+async def record_usage(user_id):
+    """
+    Учитывает одно сообщение пользователя и сохраняет счётчик в БД
+
+    Returns:
+        int: Количество сообщений за текущие сутки с учётом нового
+    """
+    used = await get_usage(user_id) + 1
+    _counters[user_id] = used
+    try:
+        await save_usage_counter_db(user_id, _day, used)
+    except Exception as e:
+        logger.error(f"Failed to persist usage counter for user {user_id}: {e}")
+    return used
@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """
+    Ограничитель частоты по алгоритму «ведро с токенами»
+
+    Ведро вмещает capacity токенов и пополняется со скоростью rate токенов в секунду.
+    Нулевая скорость означает отсутствие ограничения.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount=1):
+        """Сколько секунд ждать, пока в ведре наберётся amount токенов (0 — можно сейчас)"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def consume(self, amount=1):
+        """Забирает токены без проверки (вызывать после delay() == 0)"""
+        if not self.unlimited:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+
+    def pause(self, seconds):
+        """Опустошает ведро так, чтобы следующий токен появился не раньше чем через seconds"""
+        if not self.unlimited:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate + 1)
+
+    async def acquire(self, amount=1):
+        """Ждёт, пока в ведре наберётся amount токенов, и забирает их"""
+        while True:
+            wait = self.delay(amount)
+            if wait <= 0:
+                self.consume(amount)
+                return
+            await asyncio.sleep(wait)
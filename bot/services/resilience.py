@@ -0,0 +1,205 @@
+from bot.services.metrics_service import openai_errors
+from contextlib import AsyncExitStack
+import openai
+import asyncio
+import email.utils
+import random
+import re
+import time
+from loguru import logger
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: сервис считается недоступным, запрос не отправлялся"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"Circuit {name} is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса
+
+    После failure_threshold сбоев подряд размыкается и reset_timeout секунд сразу
+    отклоняет запросы. Затем пропускает один пробный запрос: успех замыкает цепь,
+    сбой размыкает её снова.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+
+    def before_call(self):
+        """Проверяет, можно ли сейчас обращаться к сервису"""
+        if self.state == 'closed':
+            return
+        retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+        if self.state == 'open' and retry_in <= 0:
+            self.state = 'half_open'
+        # Пробный запрос мог так и не завершиться (например, его отменили) — тогда пускаем новый
+        probe_stale = time.monotonic() - self._probe_started > self.reset_timeout
+        if self.state == 'half_open' and (not self._probe_in_flight or probe_stale):
+            self._probe_in_flight = True
+            self._probe_started = time.monotonic()
+            return
+        raise CircuitOpenError(self.name, max(retry_in, 0))
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"Circuit {self.name} closed")
+        self.state = 'closed'
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+            self.state = 'open'
+            self._opened_at = time.monotonic()
+
+class RetryPolicy:
+    """
+    Параметры повторов: число попыток, экспоненциальная задержка со случайным
+    разбросом и общий срок на вызов со всеми повторами
+    """
+
+    def __init__(self, attempts, base_delay, max_delay, deadline):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Задержка перед следующей попыткой
+
+        Если сервер сообщил, когда сбросится лимит, ждём именно столько (с небольшим
+        разбросом, чтобы клиенты не пришли одновременно), иначе — экспоненциально.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_delay) * random.uniform(1.0, 1.1)
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def _parse_duration(value):
+    """Разбирает длительность вида '20ms', '1.5s' или '6m0s' в секунды"""
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def retry_after_from_error(error):
+    """
+    Достаёт из ответа OpenAI время до сброса лимита (в секундах)
+
+    Учитываются заголовки retry-after-ms, retry-after (секунды или HTTP-дата)
+    и x-ratelimit-reset-requests / x-ratelimit-reset-tokens.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            value = headers['retry-after']
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    resets = [
+        _parse_duration(headers[name])
+        for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+        if headers.get(name)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def is_retryable(error):
+    """Временная ли это ошибка, которую имеет смысл повторить"""
+    if isinstance(error, openai.RateLimitError):
+        # Закончившиеся деньги на счету повтором не исправить
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError))
+
+def _is_outage(error):
+    # Перегрузка по лимиту не значит, что сервис лежит, — предохранитель её не считает.
+    # asyncio.TimeoutError — это истёкший срок самого вызова, а не сбой сервиса
+    # (таймауты HTTP-клиента приходят как APITimeoutError)
+    return is_retryable(error) and not isinstance(error, (openai.RateLimitError, asyncio.TimeoutError))
+
+async def call_with_retry(call, policy, breaker=None, on_retry_after=None, slot=None, keep_slot=False):
+    """
+    Выполняет запрос с повторами и предохранителем
+
+    Args:
+        call: Корутина-функция без аргументов, выполняющая одну попытку
+        policy: RetryPolicy
+        breaker: CircuitBreaker сервиса (необязательно)
+        on_retry_after: Функция, получающая время до сброса лимита, если сервер его сообщил
+        slot: Функция без аргументов, возвращающая асинхронный контекстный менеджер слота
+            планировщика. Слот занимается перед каждой попыткой; ожидание в очереди бота
+            не входит ни в срок policy.deadline, ни в таймаут попытки
+        keep_slot: Не освобождать слот после успешной попытки (например, пока читается поток)
+
+    Returns:
+        Результат call() или, если keep_slot, пара (результат, корутина-функция освобождения слота)
+
+    Raises:
+        CircuitOpenError: Предохранитель разомкнут
+        Exception: Последняя ошибка, если повторы не помогли или вышел срок
+    """
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.before_call()
+        async with AsyncExitStack() as held:
+            if slot is not None:
+                queued_at = time.monotonic()
+                await held.enter_async_context(slot())
+                deadline += time.monotonic() - queued_at
+            remaining = deadline - time.monotonic()
+            try:
+                result = await asyncio.wait_for(call(), remaining)
+            except Exception as e:
+                error = e
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                if keep_slot:
+                    return result, held.pop_all().aclose
+                return result
+
+        openai_errors.inc(breaker.name if breaker is not None else 'openai', type(error).__name__)
+        if breaker is not None:
+            if _is_outage(error):
+                breaker.record_failure()
+            elif isinstance(error, openai.APIStatusError):
+                # Ответ от сервиса получен — цепь работает, даже если запрос неудачный
+                breaker.record_success()
+        if not is_retryable(error) or attempt + 1 >= policy.attempts:
+            raise error
+        retry_after = retry_after_from_error(error)
+        if retry_after is not None and on_retry_after is not None:
+            on_retry_after(retry_after)
+        delay = policy.backoff(attempt, retry_after)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        logger.warning(f"OpenAI call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        attempt += 1
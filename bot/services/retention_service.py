@@ -0,0 +1,133 @@
+from bot.database.crud import (
+    delete_old_messages_chunk, delete_stale_summaries_chunk, delete_finished_campaigns_chunk, delete_hourly_stats_chunk
+)
+from bot.database.models import engine
+from bot.services.archive_service import archive_old_messages_chunk
+from bot.config import (
+    ARCHIVE_MESSAGES, RETENTION_MESSAGES_DAYS, RETENTION_SUMMARIES_DAYS, RETENTION_CAMPAIGNS_DAYS, RETENTION_HOURLY_STATS_DAYS,
+    RETENTION_CHUNK_SIZE, RETENTION_CHUNK_PAUSE, RETENTION_VACUUM_PAGES
+)
+import asyncio
+import datetime
+from loguru import logger
+
+class RetentionPolicy:
+    """Правило хранения: что удалять и через сколько дней"""
+
+    def __init__(self, name, label, delete_chunk, days):
+        self.name = name
+        self.label = label
+        self.delete_chunk = delete_chunk
+        self.days = days
+
+# Старые сообщения переносятся в архив, если он включён, иначе удаляются
+_messages_chunk = archive_old_messages_chunk if ARCHIVE_MESSAGES else delete_old_messages_chunk
+
+# Правила по умолчанию; days = 0 отключает правило
+POLICIES = [
+    RetentionPolicy('messages', "сообщений", _messages_chunk, RETENTION_MESSAGES_DAYS),
+    RetentionPolicy('summaries', "резюме неактивных пользователей", delete_stale_summaries_chunk, RETENTION_SUMMARIES_DAYS),
+    RetentionPolicy('campaigns', "завершённых рассылок", delete_finished_campaigns_chunk, RETENTION_CAMPAIGNS_DAYS),
+    RetentionPolicy('hourly_stats', "почасовых агрегатов", delete_hourly_stats_chunk, RETENTION_HOURLY_STATS_DAYS),
+]
+
+def messages_policy(days):
+    """Правило для удаления сообщений с заданным сроком (для /clean_db)"""
+    return RetentionPolicy('messages', "сообщений", _messages_chunk, days)
+
+# Очистка выполняется одна за раз: по расписанию или из /clean_db
+_lock = asyncio.Lock()
+
+async def _purge(policy, on_progress=None):
+    """
+    Удаляет устаревшие строки порциями по RETENTION_CHUNK_SIZE
+
+    Каждая порция — отдельная короткая транзакция, между порциями пауза,
+    чтобы запись сообщений не ждала очистку.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=policy.days)
+    total = 0
+    while True:
+        deleted = await policy.delete_chunk(cutoff, RETENTION_CHUNK_SIZE)
+        total += deleted
+        if on_progress is not None and deleted:
+            await on_progress(policy, total)
+        if deleted < RETENTION_CHUNK_SIZE:
+            return total
+        await asyncio.sleep(RETENTION_CHUNK_PAUSE)
+
+async def reclaim_space():
+    """
+    Возвращает освободившиеся страницы файлу базы и усекает WAL
+
+    Страницы возвращаются шагами по RETENTION_VACUUM_PAGES, каждый шаг — короткая
+    транзакция, между шагами пауза, чтобы запись сообщений не ждала. Работает только
+    в режиме auto_vacuum=INCREMENTAL; старую базу в него переводит convert_to_incremental_vacuum.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar() != 2:
+            logger.warning("Database is not in incremental auto_vacuum mode, free pages are not returned; "
+                           "run /vacuum once to convert it")
+        else:
+            # Через execute прагма освобождает одну страницу за шаг; executescript выполняет её до конца
+            raw = await conn.get_raw_connection()
+            free = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+            while free:
+                await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});")
+                remaining = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+                if remaining >= free:
+                    break
+                free = remaining
+                await asyncio.sleep(RETENTION_CHUNK_PAUSE)
+        await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+async def get_auto_vacuum_mode():
+    """Режим auto_vacuum базы SQLite: 0 — NONE, 1 — FULL, 2 — INCREMENTAL (None для других СУБД)"""
+    if engine.dialect.name != 'sqlite':
+        return None
+    async with engine.connect() as conn:
+        return (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+
+async def convert_to_incremental_vacuum():
+    """
+    Переводит базу в режим auto_vacuum=INCREMENTAL полным VACUUM
+
+    VACUUM переписывает весь файл и всё это время блокирует запись, поэтому
+    запускается только вручную (/vacuum), а не по расписанию.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    async with _lock:
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            logger.info("Switching database to incremental auto_vacuum (full VACUUM)")
+            await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            await conn.exec_driver_sql("VACUUM")
+            await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info("Database switched to incremental auto_vacuum")
+
+async def run_retention(policies=None, on_progress=None):
+    """
+    Применяет правила хранения и возвращает место файлу базы
+
+    Args:
+        policies: Список RetentionPolicy (по умолчанию — POLICIES)
+        on_progress: Корутина-функция (policy, удалено_всего), вызываемая после каждой порции
+
+    Returns:
+        dict: Имя правила -> количество удалённых строк
+    """
+    async with _lock:
+        results = {}
+        for policy in policies or POLICIES:
+            if policy.days <= 0:
+                continue
+            results[policy.name] = await _purge(policy, on_progress)
+            if results[policy.name]:
+                logger.info(f"Retention: deleted {results[policy.name]} {policy.name} older than {policy.days} days")
+        if any(results.values()):
+            await reclaim_space()
+        return results
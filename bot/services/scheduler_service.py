@@ -0,0 +1,166 @@
+from bot.database.crud import get_job_last_run, save_job_run
+import asyncio
+import datetime
+import random
+from loguru import logger
+
+# Пауза перед повторным чтением истории запусков, если БД недоступна: удваивается до предела, сек
+READ_RETRY_DELAY = 1.0
+READ_RETRY_MAX_DELAY = 300.0
+
+class CronSpec:
+    """
+    Расписание в формате cron: «минута час день месяц день_недели»
+
+    Поддерживаются *, числа, списки через запятую, диапазоны a-b и шаг */n или a-b/n.
+    День недели: 0 или 7 — воскресенье. Время считается в UTC.
+    """
+
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron spec must have 5 fields: {spec!r}")
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        )
+        # Как в cron: если заданы и день месяца, и день недели, подходит любой из них
+        self._day_or_weekday = fields[2] != '*' and fields[4] != '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-'))
+            else:
+                start = end = int(part)
+            if step and part != '*' and '-' not in part:
+                end = high
+            values.update(range(start, end + 1, int(step) if step else 1))
+        if high == 6:
+            # 7 — тоже воскресенье
+            values = {0 if value == 7 else value for value in values}
+        if not values or min(values) < low or max(values) > high:
+            raise ValueError(f"Cron field {field!r} out of range {low}-{high}")
+        return values
+
+    def _day_matches(self, moment):
+        # weekday(): понедельник = 0, в cron понедельник = 1, воскресенье = 0
+        weekday = (moment.weekday() + 1) % 7
+        if self._day_or_weekday:
+            return moment.day in self.days or weekday in self.weekdays
+        return moment.day in self.days and weekday in self.weekdays
+
+    def next_after(self, moment):
+        """Ближайший момент строго после moment, подходящий под расписание"""
+        moment = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months or not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron spec {self.spec!r} never matches")
+
+class Job:
+    """
+    Периодическая задача
+
+    Attributes:
+        name: Уникальное имя (ключ в таблице scheduled_jobs)
+        func: Корутина-функция без аргументов
+        cron: CronSpec
+        timeout: Максимальное время выполнения, сек
+        jitter: Максимальная случайная задержка запуска, сек
+    """
+
+    def __init__(self, name, func, cron, timeout, jitter=0.0):
+        self.name = name
+        self.func = func
+        self.cron = CronSpec(cron)
+        self.timeout = timeout
+        self.jitter = jitter
+
+class JobScheduler:
+    """
+    Запускает задачи по расписанию
+
+    Время последнего запуска хранится в БД: если бот был выключен в момент
+    запуска, задача выполняется один раз сразу после старта. Каждая задача
+    работает в своей asyncio-задаче с таймаутом, поэтому зависшая или упавшая
+    задача не мешает остальным.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = {}
+
+    def add(self, job):
+        self.jobs[job.name] = job
+
+    async def start(self):
+        for job in self.jobs.values():
+            if job.name not in self._tasks:
+                self._tasks[job.name] = asyncio.create_task(self._loop(job))
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    async def _last_run(self, job):
+        """Читает время последнего запуска, пока БД не ответит: без него задача не запустится вовсе"""
+        delay = READ_RETRY_DELAY
+        while True:
+            try:
+                return await get_job_last_run(job.name)
+            except Exception as e:
+                logger.error(f"Failed to read last run of job {job.name}, retrying in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, READ_RETRY_MAX_DELAY)
+
+    async def _loop(self, job):
+        last_run = await self._last_run(job)
+        # Без истории запусков ждём ближайшего момента по расписанию
+        due = job.cron.next_after(last_run or datetime.datetime.utcnow())
+        while True:
+            now = datetime.datetime.utcnow()
+            if due > now:
+                delay = (due - now).total_seconds() + random.uniform(0, job.jitter)
+                await asyncio.sleep(delay)
+            else:
+                logger.info(f"Job {job.name} missed its run at {due}, running now")
+            await self.run(job)
+            # Следующий запуск — от текущего момента, чтобы не догонять каждый пропуск по очереди
+            due = job.cron.next_after(datetime.datetime.utcnow())
+
+    async def run(self, job):
+        """Выполняет задачу один раз и сохраняет результат"""
+        started = datetime.datetime.utcnow()
+        try:
+            await asyncio.wait_for(job.func(), job.timeout)
+            status, error = 'ok', None
+            logger.info(f"Job {job.name} finished in {(datetime.datetime.utcnow() - started).total_seconds():.1f}s")
+        except asyncio.TimeoutError:
+            status, error = 'timeout', f"Timed out after {job.timeout}s"
+            logger.error(f"Job {job.name} timed out after {job.timeout}s")
+        except Exception as e:
+            status, error = 'error', str(e)
+            logger.error(f"Job {job.name} failed: {e}")
+        try:
+            await save_job_run(job.name, started, status, error)
+        except Exception as e:
+            logger.error(f"Failed to save run of job {job.name}: {e}")
+
+job_scheduler = JobScheduler()
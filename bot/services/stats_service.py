@@ -0,0 +1,137 @@
+from bot.database.crud import add_stat_aggregates_db, get_stat_aggregates_db, get_active_user_ids_since, count_users
+from bot.config import STATS_FLUSH_INTERVAL
+from bot.services.metrics_service import start_background_task
+from collections import Counter
+import asyncio
+import datetime
+from loguru import logger
+
+def day_period(at):
+    return at.strftime('%Y-%m-%d')
+
+def hour_period(at):
+    return at.strftime('%Y-%m-%dT%H')
+
+class StatsRecorder:
+    """
+    Счётчики событий по суткам и часам
+
+    События прибавляются к счётчикам в памяти и раз в flush_interval секунд
+    одной транзакцией прибавляются к таблице stat_aggregates, поэтому /stats
+    читает несколько готовых строк вместо подсчёта по сырым данным.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = Counter()
+        # Кто уже учтён в active_users за текущие сутки и час: период -> множество user_id
+        self._active = {}
+        self.users_total = 0
+        self._task = None
+
+    async def load(self):
+        """Читает общее число пользователей и активных за текущие сутки и час (при старте)"""
+        now = datetime.datetime.utcnow()
+        day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        hour_start = now.replace(minute=0, second=0, microsecond=0)
+        self.users_total = await count_users()
+        # last_active хранит последнюю активность, поэтому активные за сутки — это last_active >= начала суток
+        active_today = await get_active_user_ids_since(day_start)
+        self._active[day_period(now)] = set(active_today)
+        self._active[hour_period(now)] = set(await get_active_user_ids_since(hour_start))
+        logger.info(f"Stats loaded: {self.users_total} users, {len(active_today)} active today")
+
+    async def refresh_users_total(self):
+        """Перечитывает общее число пользователей (новых могли учесть другие процессы)"""
+        self.users_total = await count_users()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = start_background_task(self._run())
+
+    def record(self, metric, amount=1, at=None):
+        """Прибавляет amount к метрике за сутки и час момента at (по умолчанию — сейчас)"""
+        at = at or datetime.datetime.utcnow()
+        self._pending[(metric, day_period(at))] += amount
+        self._pending[(metric, hour_period(at))] += amount
+        if metric == 'new_users':
+            self.users_total += amount
+        self.start()
+
+    def mark_active(self, user_id):
+        """Учитывает пользователя в active_users, если он ещё не учтён за текущие сутки и час"""
+        now = datetime.datetime.utcnow()
+        current = (day_period(now), hour_period(now))
+        # Множества прошедших периодов больше не нужны
+        for period in list(self._active):
+            if period not in current:
+                del self._active[period]
+        for period in current:
+            seen = self._active.setdefault(period, set())
+            if user_id not in seen:
+                seen.add(user_id)
+                self._pending[('active_users', period)] += 1
+        self.start()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Прибавляет накопленные счётчики к таблице stat_aggregates"""
+        if not self._pending:
+            return
+        counts, self._pending = self._pending, Counter()
+        try:
+            await add_stat_aggregates_db(counts)
+        except Exception as e:
+            logger.error(f"Failed to flush stats: {e}")
+            # Возвращаем счётчики, чтобы прибавить их при следующей записи
+            self._pending.update(counts)
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает накопленное в БД"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+stats_recorder = StatsRecorder(STATS_FLUSH_INTERVAL)
+
+def record_event(metric, amount=1, at=None):
+    stats_recorder.record(metric, amount, at)
+
+def mark_active(user_id):
+    stats_recorder.mark_active(user_id)
+
+async def load_stats():
+    await stats_recorder.load()
+
+async def stop_stats():
+    await stats_recorder.stop()
+
+async def get_stats_series(days=30):
+    """
+    Возвращает дневные ряды метрик за последние days суток и значения за текущий час
+
+    Returns:
+        dict: {'days': [...периоды по возрастанию], 'series': {metric: [значения по дням]},
+               'hour': {metric: значение}, 'users_total': int}
+    """
+    await stats_recorder.flush()
+    now = datetime.datetime.utcnow()
+    periods = [day_period(now - datetime.timedelta(days=offset)) for offset in range(days - 1, -1, -1)]
+    current_hour = hour_period(now)
+    values = await get_stat_aggregates_db(periods + [current_hour])
+    metrics = {metric for metric, _ in values}
+    return {
+        'days': periods,
+        'series': {metric: [values.get((metric, period), 0) for period in periods] for metric in metrics},
+        'hour': {metric: values.get((metric, current_hour), 0) for metric in metrics},
+        'users_total': stats_recorder.users_total,
+    }
@@ -0,0 +1,86 @@
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from bot.config import STREAM_EDIT_INTERVAL
+import asyncio
+import time
+from loguru import logger
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _split_point(text, limit):
+    """Находит место разрыва не дальше limit символов: по абзацу, строке или пробелу"""
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, limit)
+        if position > limit // 2:
+            return position + len(separator)
+    return limit
+
+class StreamingReply:
+    """
+    Постепенно выводит ответ модели в одно сообщение Telegram
+
+    Фрагменты копятся в буфере, а сообщение редактируется не чаще чем раз в
+    edit_interval секунд, так что частые фрагменты склеиваются в одну правку.
+    Когда текст перерастает лимит Telegram, текущее сообщение фиксируется
+    и вывод продолжается в новом.
+    """
+
+    def __init__(self, message, reply_markup=None, edit_interval=STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.reply_markup = reply_markup
+        self.edit_interval = edit_interval
+        self._done_parts = []
+        self._current = ""
+        self._sent = None
+        self._sent_text = ""
+        self._next_edit_at = 0.0
+
+    @property
+    def text(self):
+        """Весь полученный на данный момент текст ответа"""
+        return "".join(self._done_parts) + self._current
+
+    async def feed(self, delta):
+        """Добавляет фрагмент ответа и при необходимости обновляет сообщение"""
+        self._current += delta
+        while len(self._current) > TELEGRAM_MESSAGE_LIMIT:
+            split = _split_point(self._current, TELEGRAM_MESSAGE_LIMIT)
+            part, self._current = self._current[:split], self._current[split:]
+            await self._show(part, force=True)
+            self._done_parts.append(part)
+            self._sent = None
+            self._sent_text = ""
+        await self._show(self._current)
+
+    async def finish(self):
+        """
+        Выводит остаток ответа без ограничения частоты
+
+        Returns:
+            str: Полный текст ответа
+        """
+        await self._show(self._current, force=True)
+        return self.text.strip()
+
+    async def _show(self, text, force=False):
+        text = text.strip()
+        if not text or text == self._sent_text:
+            return
+        if not force and time.monotonic() < self._next_edit_at:
+            return
+        try:
+            if self._sent is None:
+                self._sent = await self.message.answer(text, reply_markup=self.reply_markup)
+            else:
+                await self._sent.edit_text(text)
+            self._sent_text = text
+            self._next_edit_at = time.monotonic() + self.edit_interval
+        except TelegramRetryAfter as e:
+            # Пропускаем правку: накопленный текст уйдёт следующей после паузы
+            self._next_edit_at = time.monotonic() + e.retry_after
+            if force:
+                await asyncio.sleep(e.retry_after)
+                await self._show(text, force=True)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.error(f"Failed to update streaming reply: {e}")
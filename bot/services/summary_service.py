@@ -0,0 +1,71 @@
+from bot.database.crud import get_summary_state_db, get_messages_after_db, save_summary_db
+from bot.services.memory_service import count_messages_after
+from bot.services.openai_service import summarize_dialog
+from bot.services.metrics_service import start_background_task
+from bot.config import SUMMARY_EVERY_MESSAGES, SUMMARY_MAX_MESSAGES, SUMMARY_CONCURRENCY, SUMMARY_TRACKED_USERS
+from collections import OrderedDict
+import asyncio
+from loguru import logger
+
+# Сколько сообщений пользователя ещё не учтено в резюме. Пользователя нет в словаре,
+# пока счётчик не прочитан из БД (после обновления резюме он читается заново).
+# Хранится не больше SUMMARY_TRACKED_USERS счётчиков, первыми вытесняются давно не
+# писавшие пользователи: их счётчик при следующем сообщении перечитается из БД.
+_unsummarized = OrderedDict()
+# Пользователи, для которых резюме обновляется прямо сейчас
+_running = set()
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_tasks = set()
+_semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+def _remember_count(user_id, count):
+    _unsummarized[user_id] = count
+    _unsummarized.move_to_end(user_id)
+    while len(_unsummarized) > SUMMARY_TRACKED_USERS:
+        _unsummarized.popitem(last=False)
+
+def schedule_summary(user_id, new_messages=2):
+    """
+    Учитывает новые сообщения пользователя и при необходимости запускает обновление резюме
+
+    Не ждёт ни БД, ни OpenAI: всё тяжёлое выполняется в фоновой задаче.
+
+    Args:
+        user_id: ID пользователя
+        new_messages: Сколько сообщений добавилось (обычно вопрос и ответ)
+    """
+    if user_id in _unsummarized:
+        _remember_count(user_id, _unsummarized[user_id] + new_messages)
+        if _unsummarized[user_id] < SUMMARY_EVERY_MESSAGES:
+            return
+    if user_id in _running:
+        return
+    _running.add(user_id)
+    task = start_background_task(_update_summary(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def _update_summary(user_id):
+    """Дополняет резюме пользователя сообщениями, добавленными после его водяной отметки"""
+    try:
+        async with _semaphore:
+            summary, watermark = await get_summary_state_db(user_id)
+            if user_id not in _unsummarized:
+                # Вместе с сообщениями из журнала, которые ещё не записаны в БД
+                count = await count_messages_after(user_id, watermark)
+                _remember_count(user_id, count)
+                if count < SUMMARY_EVERY_MESSAGES:
+                    return
+
+            messages = await get_messages_after_db(user_id, watermark, SUMMARY_MAX_MESSAGES)
+            if not messages:
+                return
+            new_summary = await summarize_dialog(summary, messages)
+            if new_summary:
+                await save_summary_db(user_id, new_summary, messages[-1])
+            # Счётчик перечитается из БД: сообщения из журнала могли ещё не попасть в пачку
+            _unsummarized.pop(user_id, None)
+    except Exception as e:
+        logger.error(f"Error updating summary for user {user_id}: {e}")
+    finally:
+        _running.discard(user_id)
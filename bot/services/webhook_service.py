@@ -0,0 +1,133 @@
+from bot.config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_DRAIN_TIMEOUT
+)
+from bot.services.metrics_service import registry
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+import asyncio
+import signal
+from loguru import logger
+
+def _update_user_id(update):
+    """ID отправителя из «сырого» обновления (None для обновлений без пользователя)"""
+    for key, value in update.items():
+        if key != 'update_id' and isinstance(value, dict):
+            sender = value.get('from') or value.get('user')
+            if isinstance(sender, dict):
+                return sender.get('id')
+    return None
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограниченным числом принятых обновлений
+
+    Запрос от Telegram подтверждается сразу, обновление обрабатывается в
+    отдельной задаче, как при поллинге. Обновления одного пользователя
+    выстраиваются в цепочку: следующее ждёт завершения предыдущего, поэтому
+    их порядок сохраняется, а медленный обработчик задерживает только своего
+    пользователя. Одновременно выполняется не больше workers обработчиков.
+    Если принято queue_size ещё не обработанных обновлений или идёт остановка,
+    Telegram получает 503 и повторит доставку позже.
+    """
+
+    def __init__(self, dispatcher, bot, secret_token, workers, queue_size, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.queue_size = queue_size
+        self._semaphore = asyncio.Semaphore(workers)
+        # Последняя задача каждого пользователя: его следующее обновление ждёт её
+        self._last = {}
+        self._tasks = set()
+        self.draining = False
+
+    async def _process(self, update, previous):
+        if previous is not None:
+            # Исключения предыдущей задачи уже записаны в лог ею самой
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            try:
+                await self._background_feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.get('update_id')}: {e}")
+
+    def _finished(self, key, task):
+        self._tasks.discard(task)
+        if self._last.get(key) is task:
+            del self._last[key]
+
+    async def _handle_request_background(self, bot, request):
+        if self.draining:
+            return web.Response(body="Shutting down", status=503)
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except ValueError:
+            return web.Response(body="Bad request", status=400)
+        if len(self._tasks) >= self.queue_size:
+            logger.warning(f"Webhook queue is full, rejecting update {update.get('update_id')}")
+            return web.Response(body="Queue is full", status=503)
+        # Обновления без пользователя раскладываем по update_id
+        key = _update_user_id(update) or update.get('update_id', 0)
+        task = asyncio.create_task(self._process(update, self._last.get(key)))
+        self._last[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    def queued(self):
+        return len(self._tasks)
+
+    async def drain(self, timeout):
+        """Перестаёт принимать обновления и дожидается обработки уже принятых"""
+        self.draining = True
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"Webhook drain timed out, {len(pending)} updates dropped")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def run_webhook(dp, bot, stop_event=None):
+    """
+    Принимает обновления через вебхук до SIGTERM/SIGINT (или до stop_event)
+
+    Вебхук при остановке не удаляется: при перезапуске за балансировщиком
+    Telegram продолжает доставлять обновления другим экземплярам.
+    """
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = []
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+            signals.append(sig)
+        except (NotImplementedError, RuntimeError):
+            # Не главный поток или Windows: останавливаемся только по stop_event
+            pass
+
+    handler = QueuedRequestHandler(dp, bot, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    registry.gauge('bot_webhook_queue_depth', "Принятых через вебхук и ещё не обработанных обновлений", handler.queued)
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, **dp.workflow_data)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop_event.wait()
+        logger.info(f"Stopping webhook, draining {handler.queued()} queued updates")
+    finally:
+        await handler.drain(WEBHOOK_DRAIN_TIMEOUT)
+        # cleanup вызывает on_shutdown обработчика, который закрывает сессию бота
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, **dp.workflow_data)
+        for sig in signals:
+            loop.remove_signal_handler(sig)
@@ -0,0 +1,183 @@
+"""
+Запуск бота в несколько процессов
+
+Главный процесс (супервизор) получает обновления поллингом или вебхуком и
+раздаёт их рабочим процессам по user_id % BOT_WORKERS. Все обновления
+пользователя обрабатывает один процесс, поэтому его очередь сообщений,
+счётчик лимита и отметка активности остаются в памяти одного процесса.
+Общие данные, которые меняются из любого процесса (подписки, системный
+промпт, число пользователей), процессы перечитывают раз в WORKER_CACHE_REFRESH
+секунд. Массовые отправки (рассылки, уведомления) идут только из супервизора,
+чтобы общий лимит Telegram соблюдался одним ограничителем. Упавший процесс супервизор перезапускает; обновления, которые он
+не успел обработать, и его очередь теряются.
+"""
+from bot.config import (
+    BOT_TOKEN, BOT_WORKERS, WORKER_RESTART_DELAY, WORKER_QUEUE_SIZE, WORKER_STOP_TIMEOUT, WORKER_CACHE_REFRESH,
+    METRICS_PORT
+)
+from bot.services.metrics_service import registry, start_metrics_server, stop_metrics_server
+import asyncio
+import multiprocessing
+import queue
+import signal
+from loguru import logger
+
+class WorkerPool:
+    """Рабочие процессы и их очереди обновлений"""
+
+    def __init__(self, workers):
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self._processes = [None] * workers
+        self._monitor = None
+        self.stopping = False
+
+    def _spawn(self, index):
+        if self._processes[index] is not None:
+            # Процесс мог погибнуть, держа блокировку очереди: новому процессу — новая очередь
+            self._queues[index] = self._context.Queue(WORKER_QUEUE_SIZE)
+        process = self._context.Process(
+            target=run_worker, args=(index, self._queues[index]), name=f"bot-worker-{index}", daemon=False
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Worker {index} started, pid {process.pid}")
+
+    def start(self):
+        for index in range(len(self._queues)):
+            self._spawn(index)
+        self._monitor = asyncio.create_task(self._watch())
+        registry.gauge(
+            'bot_worker_queue_depth', "Обновлений в очереди рабочего процесса",
+            lambda: {str(index): worker_queue.qsize() for index, worker_queue in enumerate(self._queues)}, ('worker',)
+        )
+        registry.gauge(
+            'bot_worker_up', "Жив ли рабочий процесс",
+            lambda: {str(index): int(process.is_alive()) for index, process in enumerate(self._processes)}, ('worker',)
+        )
+
+    async def _watch(self):
+        """Перезапускает упавшие процессы"""
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self._processes):
+                if self.stopping or process.is_alive():
+                    continue
+                logger.error(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                             f"restarting in {WORKER_RESTART_DELAY}s")
+                await asyncio.sleep(WORKER_RESTART_DELAY)
+                if not self.stopping:
+                    self._spawn(index)
+
+    async def dispatch(self, key, update):
+        """Передаёт обновление процессу, обслуживающему key (user_id)"""
+        worker_queue = self._queues[key % len(self._queues)]
+        try:
+            worker_queue.put_nowait(update)
+        except queue.Full:
+            # Процесс не успевает: ждём места, притормаживая приём обновлений
+            logger.warning(f"Worker {key % len(self._queues)} queue is full, waiting")
+            await asyncio.get_running_loop().run_in_executor(None, worker_queue.put, update)
+
+    async def forward(self, handler, event, data):
+        """
+        Внешний middleware диспетчера супервизора: отправляет обновление рабочему процессу
+
+        Обработчики в супервизоре не вызываются.
+        """
+        user = data.get('event_from_user')
+        # Обновления без пользователя раскладываем по update_id
+        key = user.id if user else event.update_id
+        await self.dispatch(key, event.model_dump(mode='json', exclude_unset=True))
+
+    async def stop(self):
+        """Просит процессы доработать очереди и ждёт их завершения"""
+        self.stopping = True
+        if self._monitor is not None:
+            self._monitor.cancel()
+        loop = asyncio.get_running_loop()
+        for worker_queue in self._queues:
+            await loop.run_in_executor(None, worker_queue.put, None)
+        for index, process in enumerate(self._processes):
+            await loop.run_in_executor(None, process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.error(f"Worker {index} did not stop in {WORKER_STOP_TIMEOUT}s, killing")
+                process.kill()
+                await loop.run_in_executor(None, process.join)
+
+def run_worker(index, updates):
+    """Точка входа рабочего процесса"""
+    # Остановкой управляет супервизор через очередь, сигналы терминала и systemd не должны
+    # прерывать процесс посреди ответа
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_main(index, updates))
+
+async def _refresh_caches():
+    """Перечитывает данные, которые могли изменить другие процессы"""
+    from bot.services.memory_service import refresh_system_prompt_if_stale
+    from bot.services.payment_service import refresh_subscriptions
+    from bot.services.stats_service import stats_recorder
+    while True:
+        await asyncio.sleep(WORKER_CACHE_REFRESH)
+        try:
+            await refresh_system_prompt_if_stale()
+            await refresh_subscriptions()
+            await stats_recorder.refresh_users_total()
+        except Exception as e:
+            logger.error(f"Failed to refresh caches: {e}")
+
+async def _worker_main(index, updates):
+    # Импорт здесь: модуль загружается и супервизором, которому обработчики не нужны
+    from aiogram import Bot
+    from bot.main import create_dispatcher
+    from bot.handlers import user
+    from bot.services.memory_service import stop_journal
+    from bot.services.payment_service import load_subscriptions, subscription_registry
+    from bot.services.stats_service import load_stats, stop_stats
+    from bot.services.context_service import load_tokenizer
+    from bot.services.openai_service import scheduler
+    from bot.services import broadcast_service
+
+    logger.info(f"Worker {index} starting")
+    await load_subscriptions()
+    subscription_registry.shard = (index, BOT_WORKERS)
+    await load_stats()
+    load_tokenizer()
+    # Лимиты OpenAI общие на всех: каждому процессу достаётся своя доля
+    scheduler.share(BOT_WORKERS)
+    # Рассылки, запущенные здесь, отправляет супервизор
+    broadcast_service.run_campaigns = False
+    # У каждого процесса свои метрики и свой порт
+    await start_metrics_server(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
+    refresher = asyncio.create_task(_refresh_caches())
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def feed(update):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Worker {index} failed to process update {update.get('update_id')}: {e}")
+
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            # Как при поллинге: каждое обновление — отдельная задача
+            task = asyncio.create_task(feed(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        refresher.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await user.inbox.drain()
+        await stop_journal()
+        await stop_stats()
+        await bot.session.close()
+        await stop_metrics_server()
+        logger.info(f"Worker {index} stopped")
@@ -0,0 +1,17 @@
+"""
+Общие настройки тестов
+
+Конфигурация бота читается из окружения при импорте, поэтому переменные
+задаются здесь, до импорта модулей bot. База и лог — во временном каталоге.
+"""
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix='bot-tests-')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ['DB_PATH'] = os.path.join(_tmp, 'bot.db')
+os.environ['LOG_FILE'] = os.path.join(_tmp, 'bot.log')
+os.environ['ARCHIVE_DIR'] = os.path.join(_tmp, 'archive')
+# Тесты работают с SQLite; PostgreSQL проверяется отдельно по TEST_POSTGRES_URL
+os.environ.pop('DATABASE_URL', None)
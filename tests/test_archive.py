@@ -0,0 +1,76 @@
+"""Холодный архив сообщений: повторно выданные SQLite id не теряют сообщения"""
+from bot.database.models import init_db, SessionLocal, Message, User
+from bot.services.archive_service import archive_old_messages_chunk, iter_archived_messages, restore_user_messages
+from bot.config import ARCHIVE_DIR
+from sqlalchemy import delete, select
+import asyncio
+import datetime
+import shutil
+
+USER_ID = 777
+
+async def _reset():
+    await init_db()
+    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
+    async with SessionLocal() as session:
+        await session.execute(delete(Message))
+        await session.execute(delete(User).where(User.user_id == USER_ID))
+        session.add(User(user_id=USER_ID))
+        await session.commit()
+
+async def _add_messages(texts, created_at):
+    async with SessionLocal() as session:
+        session.add_all([
+            Message(user_id=USER_ID, role='user', content=text, token_count=1, created_at=created_at)
+            for text in texts
+        ])
+        await session.commit()
+
+async def _table_contents():
+    async with SessionLocal() as session:
+        result = await session.execute(select(Message.id, Message.content).order_by(Message.content))
+        return result.all()
+
+def test_archive_empty_table_archive_again_and_restore():
+    async def run():
+        await _reset()
+        cutoff = datetime.datetime.utcnow()
+        await _add_messages(['a1', 'a2', 'a3'], datetime.datetime(2024, 1, 10, 12, 0, 0))
+        assert await archive_old_messages_chunk(cutoff, 100) == 3
+
+        # Таблица пуста: SQLite снова начинает id с 1
+        await _add_messages(['b1', 'b2'], datetime.datetime(2024, 2, 10, 12, 0, 0))
+        ids = [row.id for row in await _table_contents()]
+        assert ids == [1, 2]
+        assert await archive_old_messages_chunk(cutoff, 100) == 2
+
+        archived = [row['content'] async for row in iter_archived_messages(USER_ID)]
+        assert sorted(archived) == ['a1', 'a2', 'a3', 'b1', 'b2']
+
+        # Живое сообщение занимает id 1, но восстановление ничего не теряет
+        await _add_messages(['c1'], datetime.datetime.utcnow())
+        assert await restore_user_messages(USER_ID) == 5
+        contents = await _table_contents()
+        assert sorted(content for _, content in contents) == ['a1', 'a2', 'a3', 'b1', 'b2', 'c1']
+        assert len({message_id for message_id, _ in contents}) == 6
+
+        # Повторное восстановление не создаёт дублей
+        assert await restore_user_messages(USER_ID) == 0
+
+    asyncio.run(run())
+
+def test_duplicate_archive_block_is_read_once():
+    async def run():
+        await _reset()
+        await _add_messages(['x1', 'x2'], datetime.datetime(2024, 3, 1))
+        async with SessionLocal() as session:
+            rows = [dict(row._mapping) for row in await session.execute(select(Message.__table__))]
+        # Сбой между записью архива и удалением: порция уходит в архив дважды
+        from bot.services.archive_service import _write_archive
+        await asyncio.to_thread(_write_archive, rows)
+        assert await archive_old_messages_chunk(datetime.datetime.utcnow(), 100) == 2
+
+        archived = [row['content'] async for row in iter_archived_messages(USER_ID)]
+        assert sorted(archived) == ['x1', 'x2']
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+"""Хранилище FSM: состояние без записи читается без запроса к БД"""
+from bot.database.models import init_db
+from bot.services.fsm_storage import SQLiteStorage
+from bot.services.metrics_service import count_queries
+from aiogram.fsm.storage.base import StorageKey
+import asyncio
+
+def _key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+def test_empty_state_does_not_query_db():
+    async def run():
+        await init_db()
+        storage = SQLiteStorage(ttl=3600, refresh=3600)
+        # Первое чтение загружает список ключей
+        assert await storage.get_state(_key(101)) is None
+
+        async def read_empty():
+            for _ in range(10):
+                assert await storage.get_state(_key(102)) is None
+
+        with count_queries('test_fsm') as counted:
+            await read_empty()
+        assert counted.count == [0]
+
+        await storage.set_state(_key(102), 'Form:prompt')
+        assert await storage.get_state(_key(102)) == 'Form:prompt'
+        await storage.set_data(_key(102), {'a': 1})
+        assert await storage.get_data(_key(102)) == {'a': 1}
+
+        # Другой процесс видит состояние после перечитывания списка ключей
+        other = SQLiteStorage(ttl=3600, refresh=3600)
+        assert await other.get_state(_key(102)) == 'Form:prompt'
+
+        await storage.set_state(_key(102), None)
+        await storage.set_data(_key(102), {})
+        assert await storage.get_state(_key(102)) is None
+        assert await other.get_state(_key(102)) is None
+        assert other.key_builder.build(_key(102)) not in other._keys
+
+    asyncio.run(run())
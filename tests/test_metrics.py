@@ -0,0 +1,85 @@
+"""Метрики: формат /metrics и подсчёт SQL-запросов обновления"""
+from bot.database.models import init_db, engine
+from bot.services.metrics_service import (
+    Registry, count_queries, db_queries, handler_seconds, instrument_dispatcher, start_background_task
+)
+from bot.handlers.admin import admin_only
+from bot.config import ADMIN_IDS
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Update
+from sqlalchemy import text
+import asyncio
+
+async def _query():
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+def _observed(scope):
+    counts, total = db_queries._series.get((scope,), ([0], 0.0))
+    return sum(counts), total
+
+def test_histogram_text_format():
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', "Тест", ('stage',), buckets=(0.1, 1))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.5, 'a')
+    lines = registry.render().splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 2' in lines
+    assert 'test_seconds_count{stage="a"} 2' in lines
+
+def test_background_task_queries_are_not_counted_in_update():
+    async def run():
+        await init_db()
+        release = asyncio.Event()
+
+        async def background():
+            await release.wait()
+            for _ in range(5):
+                await _query()
+
+        before = _observed('test_update')
+        with count_queries('test_update'):
+            task = start_background_task(background())
+            await _query()
+            # Фоновая задача выполняет запросы, пока обновление ещё не закончилось
+            release.set()
+            await task
+            await _query()
+        count, total = _observed('test_update')
+        assert count - before[0] == 1
+        assert total - before[1] == 2
+
+    asyncio.run(run())
+
+def test_decorated_handler_is_reported_under_its_own_name():
+    router = Router()
+    handled = []
+
+    @router.message()
+    @admin_only
+    async def secret_admin_command(message):
+        handled.append(message.text)
+
+    async def run():
+        dp = Dispatcher()
+        dp.include_router(router)
+        instrument_dispatcher(dp, [router])
+        bot = Bot('123456:TEST')
+        admin_id = ADMIN_IDS[0]
+        await dp.feed_update(bot, Update.model_validate({
+            'update_id': 1,
+            'message': {
+                'message_id': 1, 'date': 0, 'text': '/secret',
+                'chat': {'id': admin_id, 'type': 'private'},
+                'from': {'id': admin_id, 'is_bot': False, 'first_name': 'Admin'},
+            },
+        }))
+        await bot.session.close()
+
+    asyncio.run(run())
+    assert handled == ['/secret']
+    assert ('secret_admin_command',) in handler_seconds._series
+    assert ('wrapper',) not in handler_seconds._series
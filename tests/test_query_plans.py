@@ -0,0 +1,94 @@
+"""Горячие запросы (история, резюме, подписка) ищут по индексам, а не сканируют таблицы"""
+from bot.database.models import Base, init_db, engine, read_engine
+from bot.database.crud import get_last_messages, get_last_summary_db, get_user_subscription
+from bot.database.migrations import run_migrations
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+import asyncio
+import pytest
+
+def _captured(call):
+    """Выполняет call и возвращает SQL-запросы, которые он отправил в SQLite"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    async def run():
+        await init_db()
+        event.listen(read_engine.sync_engine, 'before_cursor_execute', capture)
+        try:
+            await call(42)
+        finally:
+            event.remove(read_engine.sync_engine, 'before_cursor_execute', capture)
+
+    asyncio.run(run())
+    return statements
+
+async def _explain(conn, statement, parameters):
+    result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+    return [row[-1] for row in result]
+
+def _plan(statement, parameters):
+    async def run():
+        async with engine.connect() as conn:
+            return await _explain(conn, statement, parameters)
+    return asyncio.run(run())
+
+# У резюме и подписок по одной строке на пользователя: SQLite выбирает любой индекс по user_id
+@pytest.mark.parametrize('call, indexes', [
+    (get_last_messages, ('ix_messages_user_id_created_at',)),
+    (get_last_summary_db, ('ix_summaries_user_id_created_at', 'ux_summaries_user_id')),
+    (get_user_subscription, ('ix_subscriptions_user_id_expires_at', 'ux_subscriptions_user_id')),
+])
+def test_lookup_uses_index(call, indexes):
+    statements = _captured(call)
+    assert len(statements) == 1
+    plan = _plan(*statements[0])
+    assert any(step.startswith('SEARCH') and any(index in step for index in indexes) for step in plan), plan
+    assert not any(step.startswith('SCAN') for step in plan), plan
+    # Сортировка берётся из индекса, без временного B-дерева
+    assert not any('TEMP B-TREE' in step for step in plan), plan
+
+# Индексы, которые создают миграции 1, 2 и 8, и сами эти миграции
+HOT_PATH_INDEXES = [
+    'ix_messages_user_id_created_at', 'ix_summaries_user_id_created_at', 'ux_summaries_user_id',
+    'ix_subscriptions_user_id_expires_at', 'ux_subscriptions_user_id',
+]
+HOT_PATH_MIGRATIONS = (1, 2, 8)
+
+def test_migrations_upgrade_existing_database(tmp_path):
+    """До миграций горячие запросы сканируют таблицы, после init_db на той же базе — ищут по индексам"""
+    statements = [_captured(call)[0] for call in (get_last_messages, get_last_summary_db, get_user_subscription)]
+
+    async def run():
+        old = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+        try:
+            # База, созданная до появления индексов
+            async with old.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(run_migrations)
+                for name in HOT_PATH_INDEXES:
+                    await conn.execute(text(f"DROP INDEX {name}"))
+                await conn.execute(text(
+                    f"DELETE FROM schema_migrations WHERE version IN {HOT_PATH_MIGRATIONS}"
+                ))
+            async with old.connect() as conn:
+                before = [await _explain(conn, *statement) for statement in statements]
+
+            # То же, что init_db при запуске бота: create_all существующие таблицы не меняет
+            async with old.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(run_migrations)
+            async with old.connect() as conn:
+                after = [await _explain(conn, *statement) for statement in statements]
+        finally:
+            await old.dispose()
+        return before, after
+
+    before, after = asyncio.run(run())
+    for plan in before:
+        assert any(step.startswith('SCAN') or 'TEMP B-TREE' in step for step in plan), plan
+    for plan in after:
+        assert any(step.startswith('SEARCH') and 'USING' in step and 'INDEX' in step for step in plan), plan
+        assert not any(step.startswith('SCAN') or 'TEMP B-TREE' in step for step in plan), plan
@@ -0,0 +1,179 @@
+"""Повторы и предохранитель OpenAI на поддельном HTTP-транспорте"""
+from bot.services.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_retry
+from contextlib import asynccontextmanager
+from openai import AsyncOpenAI
+import asyncio
+import httpx
+import openai
+import pytest
+
+MODERATION = {"id": "modr-1", "model": "omni-moderation-latest", "results": []}
+
+def make_client(responses):
+    """
+    Клиент OpenAI, которому отвечает транспорт из списка responses
+
+    Элемент списка — httpx.Response, исключение httpx (будет выброшено) или
+    число (секунды, которые транспорт «висит» перед успешным ответом).
+    """
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(response, (int, float)):
+            await asyncio.sleep(response)
+            return httpx.Response(200, json=MODERATION)
+        return response
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    client = AsyncOpenAI(api_key='sk-test', max_retries=0, http_client=http_client)
+    return client, requests
+
+def policy(attempts=3, deadline=5):
+    return RetryPolicy(attempts, base_delay=0.01, max_delay=0.5, deadline=deadline)
+
+def ok():
+    return httpx.Response(200, json=MODERATION)
+
+def status(code, headers=None):
+    return httpx.Response(code, json={"error": {"message": "error", "type": "error"}}, headers=headers)
+
+def test_rate_limit_waits_for_retry_after():
+    client, requests = make_client([status(429, {'retry-after-ms': '50'}), ok()])
+    reported = []
+
+    async def run():
+        started = asyncio.get_running_loop().time()
+        await call_with_retry(lambda: client.moderations.create(input=["hi"]), policy(), on_retry_after=reported.append)
+        return asyncio.get_running_loop().time() - started
+
+    elapsed = asyncio.run(run())
+    assert len(requests) == 2
+    assert reported == [0.05]
+    assert elapsed >= 0.05
+
+def test_insufficient_quota_is_not_retried():
+    error = httpx.Response(429, json={"error": {"message": "quota", "type": "insufficient_quota", "code": "insufficient_quota"}})
+    client, requests = make_client([error, ok()])
+
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(call_with_retry(lambda: client.moderations.create(input=["hi"]), policy()))
+    assert len(requests) == 1
+
+def test_server_error_is_retried_and_counted_by_breaker():
+    client, requests = make_client([status(500), status(503), ok()])
+    breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=60)
+
+    asyncio.run(call_with_retry(lambda: client.moderations.create(input=["hi"]), policy(), breaker))
+    assert len(requests) == 3
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+def test_bad_request_is_not_retried():
+    client, requests = make_client([status(400), ok()])
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(call_with_retry(lambda: client.moderations.create(input=["hi"]), policy(), breaker))
+    assert len(requests) == 1
+    assert breaker.state == 'closed'
+
+def test_transport_timeout_is_retried():
+    client, requests = make_client([httpx.ReadTimeout("timeout"), ok()])
+    breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=60)
+
+    asyncio.run(call_with_retry(lambda: client.moderations.create(input=["hi"]), policy(), breaker))
+    assert len(requests) == 2
+
+def test_deadline_expiry_does_not_open_breaker():
+    client, requests = make_client([1.0])
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(call_with_retry(lambda: client.moderations.create(input=["hi"]), policy(deadline=0.1), breaker))
+    assert breaker.state == 'closed'
+
+def test_waiting_for_slot_is_not_part_of_deadline():
+    client, requests = make_client([ok()])
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    held = []
+
+    @asynccontextmanager
+    async def slow_slot():
+        # Очередь бота дольше, чем весь срок вызова
+        await asyncio.sleep(0.3)
+        held.append(True)
+        yield
+        held.pop()
+
+    asyncio.run(call_with_retry(
+        lambda: client.moderations.create(input=["hi"]), policy(deadline=0.2), breaker, slot=slow_slot
+    ))
+    assert len(requests) == 1
+    assert held == []
+    assert breaker.state == 'closed'
+
+def test_keep_slot_holds_slot_until_released():
+    client, _ = make_client([ok()])
+    held = []
+
+    @asynccontextmanager
+    async def slot():
+        held.append(True)
+        yield
+        held.pop()
+
+    async def run():
+        _, release = await call_with_retry(
+            lambda: client.moderations.create(input=["hi"]), policy(), slot=slot, keep_slot=True
+        )
+        assert held == [True]
+        await release()
+
+    asyncio.run(run())
+    assert held == []
+
+def test_breaker_opens_half_opens_and_closes():
+    client, requests = make_client([status(500), status(500), ok()])
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.1)
+    single = policy(attempts=1)
+
+    def call():
+        return call_with_retry(lambda: client.moderations.create(input=["hi"]), single, breaker)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(openai.InternalServerError):
+                await call()
+        assert breaker.state == 'open'
+
+        # Пока цепь разомкнута, запрос до транспорта не доходит
+        with pytest.raises(CircuitOpenError):
+            await call()
+        assert len(requests) == 2
+
+        await asyncio.sleep(0.15)
+        await call()
+
+    asyncio.run(run())
+    assert len(requests) == 3
+    assert breaker.state == 'closed'
+
+def test_failed_probe_reopens_breaker():
+    client, requests = make_client([status(500), status(500)])
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.1)
+    single = policy(attempts=1)
+
+    async def run():
+        with pytest.raises(openai.InternalServerError):
+            await call_with_retry(lambda: client.moderations.create(input=["hi"]), single, breaker)
+        await asyncio.sleep(0.15)
+        # Пробный запрос тоже неудачен — цепь снова размыкается
+        with pytest.raises(openai.InternalServerError):
+            await call_with_retry(lambda: client.moderations.create(input=["hi"]), single, breaker)
+
+    asyncio.run(run())
+    assert len(requests) == 2
+    assert breaker.state == 'open'
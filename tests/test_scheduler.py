@@ -0,0 +1,38 @@
+"""Планировщик: правило дней cron и повтор чтения истории запусков"""
+from bot.services import scheduler_service
+from bot.services.scheduler_service import CronSpec, Job, JobScheduler
+import asyncio
+import datetime
+
+def test_day_of_month_or_weekday():
+    # 13-е число или пятница
+    cron = CronSpec('0 0 13 * 5')
+    moment = datetime.datetime(2026, 3, 1)
+    runs = []
+    for _ in range(4):
+        moment = cron.next_after(moment)
+        runs.append(moment.date())
+    assert runs == [datetime.date(2026, 3, 6), datetime.date(2026, 3, 13),
+                    datetime.date(2026, 3, 20), datetime.date(2026, 3, 27)]
+    # С одним ограниченным полем второе ничего не добавляет
+    assert CronSpec('0 0 * * 5').next_after(datetime.datetime(2026, 3, 7)).date() == datetime.date(2026, 3, 13)
+
+def test_last_run_is_retried_until_db_answers(monkeypatch):
+    calls = []
+    last_run = datetime.datetime(2026, 3, 1)
+
+    async def get_job_last_run(name):
+        calls.append(name)
+        if len(calls) < 3:
+            raise OSError("database is locked")
+        return last_run
+
+    monkeypatch.setattr(scheduler_service, 'get_job_last_run', get_job_last_run)
+    monkeypatch.setattr(scheduler_service, 'READ_RETRY_DELAY', 0.01)
+
+    async def noop():
+        pass
+
+    job = Job('test', noop, '* * * * *', timeout=1)
+    assert asyncio.run(JobScheduler()._last_run(job)) == last_run
+    assert calls == ['test'] * 3
@@ -0,0 +1,82 @@
+"""Резюме: счётчик новых сообщений учитывает журнал, не растёт без предела и переживает очистку messages"""
+from bot.database.models import init_db, engine
+from bot.services import summary_service
+from bot.services import memory_service
+from bot.services.memory_service import MessageJournal, save_message
+from sqlalchemy import text
+import asyncio
+import pytest
+
+@pytest.fixture
+def message_journal(monkeypatch):
+    """Свой журнал на каждый тест: события asyncio привязываются к циклу, в котором их ждали"""
+    journal = MessageJournal(flush_interval=0.2, batch_size=100)
+    monkeypatch.setattr(memory_service, 'message_journal', journal)
+    return journal
+
+def test_first_count_includes_journal(monkeypatch, message_journal):
+    summarized = []
+
+    async def summarize_dialog(summary, messages):
+        summarized.append([m.content for m in messages])
+        return "резюме"
+
+    monkeypatch.setattr(summary_service, 'summarize_dialog', summarize_dialog)
+    monkeypatch.setattr(summary_service, 'SUMMARY_EVERY_MESSAGES', 4)
+
+    async def run():
+        await init_db()
+        for i in range(2):
+            await save_message(7001, 'user', f"записано {i}")
+        await message_journal.flush()
+        # Ещё два сообщения только в журнале: вместе с записанными их уже достаточно
+        for i in range(2):
+            await save_message(7001, 'user', f"в журнале {i}")
+        summary_service.schedule_summary(7001)
+        await asyncio.gather(*summary_service._tasks)
+        await message_journal.stop()
+
+    asyncio.run(run())
+    assert summarized == [["записано 0", "записано 1"]]
+    # После обновления резюме счётчик перечитывается из БД
+    assert 7001 not in summary_service._unsummarized
+
+def test_counters_are_bounded(monkeypatch):
+    monkeypatch.setattr(summary_service, '_unsummarized', summary_service.OrderedDict())
+    monkeypatch.setattr(summary_service, 'SUMMARY_TRACKED_USERS', 3)
+    for user_id in range(5):
+        summary_service._remember_count(user_id, 1)
+    summary_service._remember_count(2, 2)
+    assert list(summary_service._unsummarized) == [3, 4, 2]
+
+def test_summaries_resume_after_messages_table_is_emptied(monkeypatch, message_journal):
+    summarized = []
+
+    async def summarize_dialog(summary, messages):
+        summarized.append([m.content for m in messages])
+        return "резюме"
+
+    monkeypatch.setattr(summary_service, 'summarize_dialog', summarize_dialog)
+    monkeypatch.setattr(summary_service, 'SUMMARY_EVERY_MESSAGES', 2)
+
+    async def summarize(texts):
+        for content in texts:
+            await save_message(7002, 'user', content)
+        await message_journal.flush()
+        summary_service.schedule_summary(7002, len(texts))
+        await asyncio.gather(*summary_service._tasks)
+
+    async def run():
+        await init_db()
+        # Сообщения других пользователей поднимают id выше будущих новых id пользователя
+        for i in range(5):
+            await save_message(7003, 'user', f"чужое {i}")
+        await summarize(["до очистки 0", "до очистки 1"])
+        # Очистка всей таблицы (/clean_db 0, архивирование): SQLite снова выдаёт id с 1
+        async with engine.begin() as conn:
+            await conn.execute(text("DELETE FROM messages"))
+        await summarize(["после очистки 0", "после очистки 1"])
+        await message_journal.stop()
+
+    asyncio.run(run())
+    assert summarized == [["до очистки 0", "до очистки 1"], ["после очистки 0", "после очистки 1"]]
@@ -0,0 +1,105 @@
+"""Вебхук: проверка секрета, 503 при заполненной очереди, порядок обработки и дообработка при остановке"""
+from bot.services.webhook_service import QueuedRequestHandler
+from aiogram import Bot, Dispatcher, Router
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+import asyncio
+
+SECRET = 's3cret'
+
+def _update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+        },
+    }
+
+async def _serve(test, workers=2, queue_size=4, slow=lambda message: True):
+    """
+    Запускает обработчик вебхука с фиктивным ботом; test(client, handler, processed, release)
+
+    Сообщения, для которых slow(message) истинно, обрабатываются только после release.set().
+    """
+    processed = []
+    release = asyncio.Event()
+    router = Router()
+
+    @router.message()
+    async def on_message(message):
+        if slow(message):
+            await release.wait()
+        processed.append(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    # Обработчик ничего не отправляет в Telegram, токен только для конструктора
+    bot = Bot('123456:TEST')
+    handler = QueuedRequestHandler(dp, bot, SECRET, workers, queue_size)
+    app = web.Application()
+    handler.register(app, path='/webhook')
+    async with TestClient(TestServer(app)) as client:
+        try:
+            await test(client, handler, processed, release)
+        finally:
+            release.set()
+            await handler.drain(5)
+            await bot.session.close()
+
+async def _post(client, update, secret=SECRET):
+    response = await client.post('/webhook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+    return response.status
+
+def test_wrong_secret_is_rejected():
+    async def test(client, handler, processed, release):
+        assert await _post(client, _update(1, 2, 'a'), secret='wrong') == 401
+        assert await _post(client, _update(2, 2, 'b'), secret='') == 401
+        assert handler.queued() == 0
+        release.set()
+
+    asyncio.run(_serve(test))
+
+def test_full_queue_returns_503():
+    async def test(client, handler, processed, release):
+        # Принимается не больше трёх необработанных обновлений
+        statuses = [await _post(client, _update(10 + i, 2 + i % 2, f"m{i}")) for i in range(5)]
+        assert statuses == [200, 200, 200, 503, 503]
+        release.set()
+        await handler.drain(5)
+        assert sorted(processed) == ['m0', 'm1', 'm2']
+
+    asyncio.run(_serve(test, workers=1, queue_size=3))
+
+def test_drain_finishes_queued_updates():
+    async def test(client, handler, processed, release):
+        for i in range(4):
+            assert await _post(client, _update(20 + i, 2 + i % 2, f"m{i}")) == 200
+        drain = asyncio.create_task(handler.drain(5))
+        await asyncio.sleep(0.05)
+        # Во время остановки новые обновления не принимаются
+        assert await _post(client, _update(30, 3, 'late')) == 503
+        assert not drain.done()
+        release.set()
+        await drain
+        assert sorted(processed) == ['m0', 'm1', 'm2', 'm3']
+
+    asyncio.run(_serve(test))
+
+def test_slow_user_does_not_delay_others():
+    async def test(client, handler, processed, release):
+        assert await _post(client, _update(40, 2, 'slow')) == 200
+        assert await _post(client, _update(41, 2, 'after slow')) == 200
+        assert await _post(client, _update(42, 4, 'other user')) == 200
+        for _ in range(100):
+            if processed:
+                break
+            await asyncio.sleep(0.01)
+        # Другой пользователь обработан, следующее сообщение медленного ждёт своей очереди
+        assert processed == ['other user']
+        release.set()
+        await handler.drain(5)
+        assert processed == ['other user', 'slow', 'after slow']
+
+    asyncio.run(_serve(test, slow=lambda message: message.text == 'slow'))